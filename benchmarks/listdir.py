@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""Benchmark listing a directory tree recursively.
+
+Compares the former util.listdir, which walks with os.walk and then calls
+util.file_info (lexists, islink, isdir, isfile, and stat) for every entry,
+with the current one, which reads each os.DirEntry with a single lstat, and
+with the current one scanning subdirectories in a thread pool.
+
+Use --latency to add a delay to every directory read, which simulates a
+network filesystem.
+"""
+import sys
+import os
+import argparse
+import tempfile
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrapbook import util
+
+
+def listdir_legacy(base, recursive=False):
+    if not recursive:
+        for entry in os.scandir(base):
+            info = util.file_info(entry.path)
+            if info.type is None: continue
+            yield info
+
+    else:
+        for root, dirs, files in os.walk(base):
+            for dir in dirs:
+                file = os.path.join(root, dir)
+                info = util.file_info(file, base)
+                if info.type is None: continue
+                yield info
+            for file in files:
+                file = os.path.join(root, file)
+                info = util.file_info(file, base)
+                if info.type is None: continue
+                yield info
+
+
+def make_tree(root, depth, dirs, files):
+    count = 0
+    stack = [(root, 0)]
+    while stack:
+        path, level = stack.pop()
+        for i in range(files):
+            with open(os.path.join(path, 'file{}.html'.format(i)), 'wb') as fh:
+                fh.write(b'x' * i)
+            count += 1
+        if files:
+            os.symlink('file0.html', os.path.join(path, 'link.html'))
+            count += 1
+        if level < depth:
+            for i in range(dirs):
+                subpath = os.path.join(path, 'dir{}'.format(i))
+                os.mkdir(subpath)
+                stack.append((subpath, level + 1))
+                count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', type=int, default=4,
+        help="""depth of the tree (default: %(default)s)""")
+    parser.add_argument('--dirs', type=int, default=6,
+        help="""number of subdirectories of each directory (default: %(default)s)""")
+    parser.add_argument('--files', type=int, default=20,
+        help="""number of files in each directory (default: %(default)s)""")
+    parser.add_argument('--dir', default=None,
+        help="""list this directory instead of generating one, e.g. on NFS""")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="""number of times to list (default: %(default)s)""")
+    parser.add_argument('--workers', default='4,16',
+        help="""comma separated numbers of threads to scan with (default: %(default)s)""")
+    parser.add_argument('--latency', type=float, default=0,
+        help="""seconds to delay every directory read (default: %(default)s)""")
+    args = parser.parse_args()
+
+    if args.latency:
+        scandir = os.scandir
+        def slow_scandir(*a, **kw):
+            time.sleep(args.latency)
+            return scandir(*a, **kw)
+        os.scandir = slow_scandir
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = args.dir
+        if root is None:
+            root = tmpdir
+            print('Generated {} entries.'.format(make_tree(root, args.depth, args.dirs, args.files)))
+
+        cases = [('os.walk + file_info', listdir_legacy), ('scandir', util.listdir)]
+        for workers in (int(w) for w in args.workers.split(',')):
+            executor = ThreadPoolExecutor(workers)
+            cases.append(('scandir workers={}'.format(workers),
+                    functools.partial(util.listdir, executor=executor, workers=workers)))
+
+        expected = list(listdir_legacy(root, True))
+        for _, func in cases:
+            assert list(func(root, True)) == expected
+
+        for label, func in cases:
+            times = []
+            for _ in range(args.repeat):
+                t = time.perf_counter()
+                count = sum(1 for _ in func(root, True))
+                times.append(time.perf_counter() - t)
+            print('{:<22} {:>8} entries  best {:>8.3f}s'.format(label, count, min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Benchmark peak memory of a recursive directory listing in each format.
+
+util.listdir is replaced with a generator of synthetic entries, so that a
+listing of a million entries can be measured without creating them on disk.
+The former JSON output, which collects all entries in a list and dumps it at
+once, is measured for comparison.
+"""
+import sys
+import os
+import argparse
+import json
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrapbook import util
+from webscrapbook.app import make_app
+
+
+def fake_listdir(count):
+    def listdir(base, recursive=False):
+        for i in range(count):
+            yield util.FileInfo(name='dir{}/sub{}/file{}.html'.format(i // 10000, i // 100, i),
+                    type='file', size=i, last_modified=1600000000.0 + i)
+    return listdir
+
+
+def legacy_json(count):
+    data = []
+    for entry in fake_listdir(count)(None, True):
+        data.append({
+                'name': entry.name,
+                'type': entry.type,
+                'size': entry.size,
+                'last_modified': entry.last_modified,
+                })
+    body = json.dumps({'success': True, 'data': data}, ensure_ascii=False)
+    yield body.encode('UTF-8')
+
+
+def measure(label, gen):
+    tracemalloc.start()
+    t = time.perf_counter()
+    size = 0
+    for chunk in gen:
+        size += len(chunk)
+    t = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<20} {:>10} output  {:>10} peak  {:>8.2f}s'.format(
+            label, util.format_filesize(size), util.format_filesize(peak), t))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000000,
+        help="""number of entries (default: %(default)s)""")
+    args = parser.parse_args()
+
+    util.listdir = fake_listdir(args.count)
+    client = make_app(os.path.dirname(os.path.abspath(__file__))).test_client()
+
+    measure('json (former)', legacy_json(args.count))
+    for label, query in (
+            ('json', 'f=json'),
+            ('ndjson', 'f=ndjson'),
+            ('sse', 'f=sse'),
+            ('sse batch=1000', 'f=sse&batch=1000'),
+            ):
+        response = client.get('/?a=list&recursive=1&' + query, buffered=False)
+        measure(label, response.response)
+
+
+if __name__ == '__main__':
+    main()
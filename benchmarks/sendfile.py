@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Benchmark serving a large file with the built-in server on loopback.
+
+Compares werkzeug's request handler, which copies the file through Python
+with read and write calls, with SendfileRequestHandler and
+SendfileMiddleware, which send it with os.sendfile. A file in a directory,
+a range of it, and a stored member of an HTZ file are downloaded. The CPU
+time is of the whole process, including the client.
+"""
+import sys
+import os
+import argparse
+import hashlib
+import http.client
+import logging
+import tempfile
+import time
+import zipfile
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from werkzeug.serving import WSGIRequestHandler, make_server
+from webscrapbook.app import make_app
+from webscrapbook.server import SendfileMiddleware, SendfileRequestHandler
+
+
+def start_server(app, request_handler):
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    srv = make_server('127.0.0.1', 0, app, threaded=True, request_handler=request_handler)
+    Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def download(port, path, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    h = hashlib.sha1()
+    size = 0
+    while True:
+        chunk = response.read(1048576)
+        if not chunk:
+            break
+        h.update(chunk)
+        size += len(chunk)
+    conn.close()
+    return response.status, size, h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=512,
+        help="""size of the file in MiB (default: %(default)s)""")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="""number of times to download (default: %(default)s)""")
+    args = parser.parse_args()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as root:
+        file = os.path.join(root, 'video.mp4')
+        with open(file, 'wb') as fh:
+            for _ in range(args.size):
+                fh.write(os.urandom(1048576))
+        with zipfile.ZipFile(os.path.join(root, 'item.htz'), 'w', zipfile.ZIP_STORED) as zip:
+            zip.write(file, 'video.mp4')
+
+        size = args.size * 1048576
+        half = size // 2
+        cases = [
+            ('file', '/video.mp4', None, size),
+            ('range', '/video.mp4', {'Range': 'bytes={}-'.format(half)}, size - half),
+            ('zip member', '/item.htz!/video.mp4', None, size),
+            ]
+
+        app = make_app(root)
+        servers = [
+            ('werkzeug', start_server(app, WSGIRequestHandler)),
+            ('sendfile', start_server(SendfileMiddleware(app), SendfileRequestHandler)),
+            ]
+
+        print('{:<12} {:<10} {:>10} {:>12} {:>10}'.format('', '', 'time', 'throughput', 'cpu'))
+        for label, path, headers, length in cases:
+            expected = None
+            for name, srv in servers:
+                times = []
+                cpus = []
+                for _ in range(args.repeat):
+                    t = time.perf_counter()
+                    cpu = time.process_time()
+                    result = download(srv.server_port, path, headers)
+                    cpus.append(time.process_time() - cpu)
+                    times.append(time.perf_counter() - t)
+                    assert result[1] == length, result
+                    assert expected is None or result == expected, result
+                    expected = result
+                t = min(times)
+                print('{:<12} {:<10} {:>9.3f}s {:>7.1f} MB/s {:>9.3f}s'.format(
+                        label, name, t, length / t / 1e6, min(cpus)))
+
+        for _, srv in servers:
+            srv.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Benchmark packing a directory into a ZIP archive.
+
+Compares the serial path of zipfile, which deflates every member one at a
+time, with util.ZipPacker, which deflates blocks of members in a thread pool
+and stores already compressed types.
+"""
+import sys
+import os
+import argparse
+import random
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrapbook import util
+
+
+def make_directory(root, count, size, media):
+    random.seed(0)
+    words = [b'<div class="item">', b'</div>', b'<p>', b'</p>', b'lorem', b'ipsum',
+            b'dolor', b'sit', b'amet', b'consectetur', b'adipiscing', b'elit', b'\n']
+    os.makedirs(os.path.join(root, 'res'))
+    for i in range(count):
+        data = b' '.join(random.choice(words) for _ in range(size // 6))
+        with open(os.path.join(root, 'res', '{}.html'.format(i)), 'wb') as fh:
+            fh.write(data)
+    for i in range(media):
+        with open(os.path.join(root, 'res', '{}.jpg'.format(i)), 'wb') as fh:
+            fh.write(os.urandom(size))
+
+
+def pack_serial(root, file, level):
+    with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as zip:
+        for info in util.listdir(root, recursive=True):
+            zip.write(os.path.join(root, info.name), info.name)
+
+
+def pack_packer(root, file, level, workers):
+    with zipfile.ZipFile(file, 'w') as zip, util.ZipPacker(zip, level, workers) as packer:
+        for info in util.listdir(root, recursive=True):
+            packer.add_file(os.path.join(root, info.name), info.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200,
+        help="""number of compressible files (default: %(default)s)""")
+    parser.add_argument('--media', type=int, default=20,
+        help="""number of incompressible media files (default: %(default)s)""")
+    parser.add_argument('--size', type=int, default=1048576,
+        help="""size of each file in bytes (default: %(default)s)""")
+    parser.add_argument('--level', type=int, default=6,
+        help="""compression level (default: %(default)s)""")
+    parser.add_argument('--workers', default='0,2,4,{}'.format(os.cpu_count() or 1),
+        help="""comma separated numbers of threads for ZipPacker (default: %(default)s)""")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = os.path.join(tmpdir, 'item')
+        file = os.path.join(tmpdir, 'bench.htz')
+        print('Generating {} + {} files of {}...'.format(
+                args.count, args.media, util.format_filesize(args.size)))
+        make_directory(root, args.count, args.size, args.media)
+        total = (args.count + args.media) * args.size
+
+        cases = [('zipfile (serial)', lambda: pack_serial(root, file, args.level))]
+        for workers in (int(w) for w in args.workers.split(',')):
+            cases.append(('ZipPacker workers={}'.format(workers),
+                    lambda workers=workers: pack_packer(root, file, args.level, workers)))
+
+        print('{:<24} {:>10} {:>12} {:>12}'.format('', 'time', 'throughput', 'archive'))
+        for label, func in cases:
+            t = time.perf_counter()
+            func()
+            t = time.perf_counter() - t
+            print('{:<24} {:>9.3f}s {:>9.1f} MB/s {:>12}'.format(
+                    label, t, total / t / 1e6, util.format_filesize(os.stat(file).st_size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Benchmark random byte-range reads of a large ZIP member.
+
+Compares seeking a ZipExtFile, which inflates a deflated member from the
+start for every backward seek, with util.ZipDeflatedReader, which resumes
+from the nearest checkpoint, and util.FileSlice for a stored member.
+"""
+import sys
+import os
+import argparse
+import random
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrapbook import util
+
+
+def make_archive(file, size):
+    # half random and half repetitive data, like a media file with headers
+    block = os.urandom(512 * 1024) + b'\0' * (512 * 1024)
+    with zipfile.ZipFile(file, 'w') as zip:
+        for name, compress_type in (('deflated.bin', zipfile.ZIP_DEFLATED), ('stored.bin', zipfile.ZIP_STORED)):
+            info = zipfile.ZipInfo(name, time.localtime())
+            info.compress_type = compress_type
+            info._compresslevel = 1
+            with zip.open(info, 'w', force_zip64=True) as fh:
+                written = 0
+                while written < size:
+                    chunk = block[:size - written]
+                    fh.write(chunk)
+                    written += len(chunk)
+
+
+def bench(open_reader, size, ranges, length):
+    fh = open_reader()
+    try:
+        times = []
+        for start in ranges:
+            t = time.perf_counter()
+            fh.seek(start)
+            fh.read(length)
+            times.append(time.perf_counter() - t)
+        return times
+    finally:
+        fh.close()
+
+
+def report(label, times):
+    times = sorted(times)
+    print('{:<28} {:>5} ranges  median {:>9.4f}s  max {:>9.4f}s  total {:>9.3f}s'.format(
+            label, len(times), times[len(times) // 2], times[-1], sum(times)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1024,
+        help="""uncompressed size of the member in MiB (default: %(default)s)""")
+    parser.add_argument('--ranges', type=int, default=50,
+        help="""number of random ranges to read (default: %(default)s)""")
+    parser.add_argument('--baseline-ranges', type=int, default=5,
+        help="""number of random ranges to read with ZipExtFile (default: %(default)s)""")
+    parser.add_argument('--length', type=int, default=256 * 1024,
+        help="""length of each range in bytes (default: %(default)s)""")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    random.seed(0)
+    ranges = [random.randrange(0, size - args.length) for _ in range(args.ranges)]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file = os.path.join(tmpdir, 'bench.htz')
+        print('Generating a {} MiB member...'.format(args.size))
+        make_archive(file, size)
+
+        with zipfile.ZipFile(file) as zip:
+            deflated = zip.getinfo('deflated.bin')
+            stored = zip.getinfo('stored.bin')
+
+            def open_deflated_reader():
+                fh = util.zip_open_data(zip, deflated)
+                return util.ZipDeflatedReader(fh, deflated, util.zip_checkpoints(zip, deflated))
+
+            def open_stored_reader():
+                fh = util.zip_open_data(zip, stored)
+                return util.FileSlice(fh, fh.tell(), stored.file_size)
+
+            report('deflated ZipExtFile', bench(lambda: zip.open(deflated), size, ranges[:args.baseline_ranges], args.length))
+            report('deflated (cold checkpoints)', bench(open_deflated_reader, size, ranges, args.length))
+            report('deflated (warm checkpoints)', bench(open_deflated_reader, size, ranges, args.length))
+            report('stored ZipExtFile', bench(lambda: zip.open(stored), size, ranges, args.length))
+            report('stored FileSlice', bench(open_stored_reader, size, ranges, args.length))
+
+
+if __name__ == '__main__':
+    main()
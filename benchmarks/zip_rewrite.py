@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Benchmark rewriting a ZIP archive when one member is replaced.
+
+Compares the former approach, which decompresses and recompresses every
+member at level 9, with util.zip_rewrite, which copies untouched members
+verbatim. The time of the former grows with the total compressed work, while
+the latter grows only with the archive size in bytes.
+"""
+import sys
+import os
+import argparse
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from webscrapbook import util
+
+
+def make_archive(file, count, size):
+    chunk = b''.join(b'line %d of a compressible resource\n' % i for i in range(size // 32 + 1))
+    with zipfile.ZipFile(file, 'w') as zip:
+        zip.writestr('index.html', b'<!DOCTYPE html>', compress_type=zipfile.ZIP_DEFLATED)
+        for i in range(count):
+            zip.writestr('res/{}.css'.format(i), chunk[:size],
+                    compress_type=zipfile.ZIP_DEFLATED, compresslevel=9)
+
+
+def rewrite_recompress(file):
+    temp_path = file + '.tmp'
+    with zipfile.ZipFile(file) as zip0, zipfile.ZipFile(temp_path, 'w') as zip:
+        info = zipfile.ZipInfo('index.html', time.localtime())
+        zip.writestr(info, b'<!DOCTYPE html><p>edited', compress_type=zipfile.ZIP_DEFLATED, compresslevel=9)
+        for info in zip0.infolist():
+            if info.filename == 'index.html':
+                continue
+            zip.writestr(info, zip0.read(info),
+                    compress_type=info.compress_type,
+                    compresslevel=None if info.compress_type == zipfile.ZIP_STORED else 9)
+    os.replace(temp_path, file)
+
+
+def rewrite_raw(file):
+    info = zipfile.ZipInfo('index.html', time.localtime())
+    with util.zip_rewrite(file, exclude=lambda i: i.filename == 'index.html') as zip:
+        zip.writestr(info, b'<!DOCTYPE html><p>edited', compress_type=zipfile.ZIP_DEFLATED, compresslevel=9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=200,
+        help="""number of members in the archive (default: %(default)s)""")
+    parser.add_argument('--sizes', default='16384,65536,262144,1048576',
+        help="""comma separated uncompressed sizes of each member (default: %(default)s)""")
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>14} {:>12}'.format('member', 'archive', 'recompress', 'raw copy'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file = os.path.join(tmpdir, 'bench.htz')
+        for size in (int(s) for s in args.sizes.split(',')):
+            make_archive(file, args.count, size)
+            archive_size = os.stat(file).st_size
+
+            t = time.perf_counter()
+            rewrite_recompress(file)
+            t_recompress = time.perf_counter() - t
+
+            t = time.perf_counter()
+            rewrite_raw(file)
+            t_raw = time.perf_counter() - t
+
+            print('{:>10} {:>12} {:>13.3f}s {:>11.3f}s'.format(
+                    util.format_filesize(size),
+                    util.format_filesize(archive_size),
+                    t_recompress, t_raw))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,6 @@ setup(
         "Operating System :: OS Independent",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
@@ -30,7 +29,7 @@ setup(
         "Topic :: Database",
         "Topic :: Internet",
         ],
-    python_requires='~=3.5',
+    python_requires='~=3.6',
     install_requires=[
         'flask >= 1.1',
         'werkzeug',
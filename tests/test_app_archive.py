@@ -0,0 +1,167 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+from unittest import mock
+
+from webscrapbook import Config
+from webscrapbook import util
+from webscrapbook.app import make_app
+
+
+class FailingReader(io.BytesIO):
+    """A file object that fails after reading fail_after bytes."""
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise OSError('read failed')
+        return super().read(size)
+
+
+class TestArchivePath(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.file = os.path.join(self.root, 'page.htz')
+        with zipfile.ZipFile(self.file, 'w') as zip:
+            zip.writestr('index.html', '<p>page</p>')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_resolve_once(self):
+        """The archive file is not resolved again after get_archive_path,
+        which could give a different result once the cache is invalidated.
+        """
+        is_zipfile = zipfile.is_zipfile
+
+        def is_zipfile_once(filename):
+            if filename != self.file:
+                return is_zipfile(filename)
+
+            # invalidate the cached result for any later resolution
+            if calls:
+                return False
+            calls.append(filename)
+            stat = os.stat(self.root)
+            os.utime(self.root, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            return True
+
+        for url in ('/page.htz!/index.html', '/page.htz!/index.html?a=source', '/page.htz!/?a=download'):
+            with self.subTest(url=url):
+                calls = []
+                app = make_app(self.root)
+                with app.test_client() as client, \
+                        mock.patch.object(zipfile, 'is_zipfile', is_zipfile_once):
+                    response = client.get(url)
+                    response.get_data()
+                self.assertEqual(response.status_code, 200)
+
+
+class TestZipAppendMode(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.file = os.path.join(self.root, 'page.htz')
+        with zipfile.ZipFile(self.file, 'w') as zip:
+            zip.writestr('index.html', '<p>page</p>')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_app(self, ratio):
+        config = Config()
+        config.load(self.root)
+        config['app']['zip_append_mode'] = 'true'
+        config['app']['zip_compact_ratio'] = str(ratio)
+        return make_app(self.root, config)
+
+    def save(self, client, data):
+        token = client.get('/?a=token').get_data(as_text=True)
+        response = client.post('/page.htz!/image.bin?a=save&f=json&token=' + token,
+                data={'upload': (io.BytesIO(data), 'image.bin')})
+        self.assertEqual(response.status_code, 200)
+
+    def dead_space(self):
+        with zipfile.ZipFile(self.file) as zip:
+            return util.zip_dead_space(zip)
+
+    def test_save_append_compact(self):
+        app = self.make_app(2)
+        data = [os.urandom(4096) for _ in range(3)]
+        with app.test_client() as client:
+            self.save(client, data[0])
+            self.assertEqual(self.dead_space(), 0)
+            size0 = os.stat(self.file).st_size
+
+            # replaced members are left as dead space
+            self.save(client, data[1])
+            self.save(client, data[2])
+            self.assertGreater(os.stat(self.file).st_size, size0)
+
+            with zipfile.ZipFile(self.file) as zip:
+                self.assertIsNone(zip.testzip())
+                self.assertEqual(zip.namelist(), ['index.html', 'image.bin'])
+                self.assertEqual(zip.read('image.bin'), data[2])
+
+            dead = self.dead_space()
+            self.assertEqual(util.zip_compact(self.file), dead)
+            self.assertEqual(os.stat(self.file).st_size, size0)
+
+            with zipfile.ZipFile(self.file) as zip:
+                self.assertIsNone(zip.testzip())
+                self.assertEqual(zip.read('image.bin'), data[2])
+                self.assertEqual(zip.read('index.html'), b'<p>page</p>')
+
+    def test_save_failed(self):
+        """A save failed partway keeps the replaced member."""
+        app = self.make_app(2)
+        data = os.urandom(4096)
+        with app.test_client() as client:
+            self.save(client, data)
+            size0 = os.stat(self.file).st_size
+
+            add_stream = util.ZipPacker.add_stream
+
+            def add_stream_failing(packer, info, stream, *args, **kwargs):
+                stream = FailingReader(stream.read(), util.ZipPacker.BLOCK_SIZE * 2)
+                return add_stream(packer, info, stream, *args, **kwargs)
+
+            token = client.get('/?a=token').get_data(as_text=True)
+            with mock.patch.object(util.ZipPacker, 'add_stream', add_stream_failing):
+                response = client.post('/page.htz!/image.bin?a=save&f=json&token=' + token,
+                        data={'upload': (io.BytesIO(os.urandom(util.ZipPacker.BLOCK_SIZE * 3)), 'image.bin')})
+            self.assertEqual(response.status_code, 500)
+
+        self.assertEqual(os.stat(self.file).st_size, size0)
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ['index.html', 'image.bin'])
+            self.assertEqual(zip.read('image.bin'), data)
+            self.assertEqual(zip.read('index.html'), b'<p>page</p>')
+
+    def test_compact_in_background(self):
+        app = self.make_app(0.4)
+        data = [os.urandom(4096) for _ in range(2)]
+        with app.test_client() as client:
+            self.save(client, data[0])
+            size0 = os.stat(self.file).st_size
+            self.save(client, data[1])
+
+        deadline = time.monotonic() + 10
+        while os.stat(self.file).st_size != size0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read('image.bin'), data[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import gzip
+import os
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Request, Response
+
+from webscrapbook import Config
+from webscrapbook.app import CompressionMiddleware, make_app
+
+
+TEXT = 'Lorem ipsum dolor sit amet. ' * 100
+
+
+@Request.application
+def app(request):
+    if request.path == '/stream':
+        def gen():
+            yield 'chunk1 ' * 50
+            yield 'chunk2 ' * 50
+        return Response(gen(), mimetype='text/plain')
+
+    if request.path == '/image.png':
+        response = Response(TEXT, mimetype='image/png')
+    elif request.path == '/small.txt':
+        response = Response('small', mimetype='text/plain')
+    else:
+        response = Response(TEXT, mimetype='text/plain')
+
+    if request.path == '/weak.txt':
+        response.set_etag('file', weak=True)
+    else:
+        response.set_etag('file')
+
+    return response.make_conditional(request)
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.middleware = CompressionMiddleware(app)
+        self.client = Client(self.middleware)
+
+    def get(self, path, encoding='gzip', **kwargs):
+        headers = kwargs.pop('headers', {})
+        if encoding is not None:
+            headers['Accept-Encoding'] = encoding
+        return self.client.get(path, headers=headers, **kwargs)
+
+    def test_negotiation(self):
+        response = self.get('/file.txt')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.get_data()).decode('UTF-8'), TEXT)
+
+        for encoding in (None, 'identity', 'gzip;q=0', 'compress'):
+            with self.subTest(encoding=encoding):
+                response = self.get('/file.txt', encoding=encoding)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(response.get_data(as_text=True), TEXT)
+
+        # not compressible
+        for path in ('/image.png', '/small.txt'):
+            with self.subTest(path=path):
+                response = self.get(path)
+                self.assertNotIn('Content-Encoding', response.headers)
+                self.assertNotIn('Vary', response.headers)
+
+    def test_etag(self):
+        response = self.get('/file.txt')
+        etag = response.headers['ETag']
+        self.assertEqual(etag, '"file-gzip"')
+
+        response = self.get('/file.txt', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"file-gzip"')
+
+        # the original ETag still matches
+        response = self.get('/file.txt', encoding=None, headers={'If-None-Match': '"file"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], '"file"')
+
+        response = self.get('/file.txt', headers={'If-None-Match': '"other-gzip"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_weak_etag(self):
+        response = self.get('/weak.txt')
+        etag = response.headers['ETag']
+        self.assertEqual(etag, 'W/"file-gzip"')
+        self.assertEqual(self.middleware._cache, {})
+
+        response = self.get('/weak.txt', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], 'W/"file-gzip"')
+
+    def test_head(self):
+        response = self.client.head('/file.txt', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], '"file-gzip"')
+        self.assertNotIn('Accept-Ranges', response.headers)
+        self.assertEqual(response.get_data(), b'')
+
+    def test_stream(self):
+        response = self.get('/stream')
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', response.headers)
+
+        # each chunk is flushed and can be decompressed once received
+        chunks = list(response.response)
+        decompressor = zlib.decompressobj(31)
+        self.assertEqual(decompressor.decompress(chunks[0]), b'chunk1 ' * 50)
+        self.assertEqual(decompressor.decompress(chunks[1]), b'chunk2 ' * 50)
+        self.assertEqual(decompressor.decompress(b''.join(chunks[2:])), b'')
+        self.assertTrue(decompressor.eof)
+
+        # not cached
+        self.assertEqual(self.middleware._cache, {})
+
+    def test_cache(self):
+        data = self.get('/file.txt').get_data()
+        self.assertEqual(list(self.middleware._cache), [('/file.txt', '', 'file', 'gzip')])
+
+        with mock.patch.object(self.middleware, '_compress') as compress:
+            response = self.get('/file.txt')
+        compress.assert_not_called()
+        self.assertEqual(response.get_data(), data)
+        self.assertEqual(int(response.headers['Content-Length']), len(data))
+
+        # keyed by the query too
+        self.get('/file.txt?a=source').get_data()
+        self.assertEqual(list(self.middleware._cache), [
+            ('/file.txt', '', 'file', 'gzip'),
+            ('/file.txt', 'a=source', 'file', 'gzip'),
+            ])
+
+    def test_cache_size(self):
+        self.middleware.cache_size = len(self.get('/file.txt').get_data()) * 2
+        self.get('/file2.txt').get_data()
+        self.get('/file.txt').get_data()
+        self.get('/file3.txt').get_data()
+        self.assertEqual([k[0] for k in self.middleware._cache], ['/file.txt', '/file3.txt'])
+        self.assertLessEqual(self.middleware._cache_used, self.middleware.cache_size)
+
+
+class TestCompressConfig(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        with open(os.path.join(self.root, 'file.txt'), 'w') as fh:
+            fh.write(TEXT)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get(self, config=None):
+        with make_app(self.root, config).test_client() as client:
+            return client.get('/file.txt', headers={'Accept-Encoding': 'gzip'})
+
+    def test_default(self):
+        self.assertNotIn('Content-Encoding', self.get().headers)
+
+    def test_enabled(self):
+        config = Config()
+        config.load(self.root)
+        config['app']['compress'] = 'true'
+        self.assertEqual(self.get(config).headers['Content-Encoding'], 'gzip')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import io
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from webscrapbook import util
+from webscrapbook.app import make_app
+
+
+class TestDownload(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.dir = os.path.join(self.root, 'folder')
+        os.makedirs(self.dir)
+        with open(os.path.join(self.dir, 'index.html'), 'w') as fh:
+            fh.write('<p>hello</p>')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def download(self):
+        app = make_app(self.root)
+        with app.test_client() as client:
+            response = client.get('/folder/?a=download')
+            data = response.get_data()
+        self.assertEqual(response.status_code, 200)
+        return zipfile.ZipFile(io.BytesIO(data))
+
+    def test_mtime_before_1980(self):
+        file = os.path.join(self.dir, 'old.txt')
+        with open(file, 'w') as fh:
+            fh.write('old')
+        os.utime(file, (0, 0))
+
+        with self.download() as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.read('folder/old.txt'), b'old')
+            self.assertEqual(zip.getinfo('folder/old.txt').date_time, (1980, 1, 1, 0, 0, 0))
+            self.assertEqual(zip.read('folder/index.html'), b'<p>hello</p>')
+
+    def test_file_removed_during_walk(self):
+        file = os.path.join(self.dir, 'gone.txt')
+        with open(file, 'w') as fh:
+            fh.write('gone')
+
+        listdir = util.listdir
+
+        def listdir_and_remove(*args, **kwargs):
+            for info in listdir(*args, **kwargs):
+                if info.name == 'gone.txt':
+                    os.remove(file)
+                yield info
+
+        with mock.patch.object(util, 'listdir', listdir_and_remove):
+            zip = self.download()
+
+        with zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ['folder/', 'folder/index.html'])
+
+
+if __name__ == '__main__':
+    unittest.main()
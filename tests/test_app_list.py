@@ -0,0 +1,104 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from webscrapbook import util
+from webscrapbook.app import make_app
+
+
+class TestList(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for i in range(3):
+            with open(os.path.join(self.root, 'file{}.txt'.format(i)), 'w') as fh:
+                fh.write('file{}'.format(i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get(self, url, **kwargs):
+        app = make_app(self.root)
+        with app.test_client() as client:
+            return client.get(url, **kwargs)
+
+    def test_meta_refresh(self):
+        with open(os.path.join(self.root, 'link.htm'), 'w') as fh:
+            fh.write('<meta http-equiv="refresh" content="0; url=image.png">')
+
+        # resolved for the HTML index
+        response = self.get('/')
+        self.assertIn('data-target="image.png"', response.get_data(as_text=True))
+
+        # not resolved for a listing, which may be huge
+        with mock.patch.object(util, 'parse_meta_refresh') as parse_meta_refresh:
+            for url in ('/?a=list&f=json', '/?a=list&f=json&recursive=1'):
+                with self.subTest(url=url):
+                    response = self.get(url)
+                    data = json.loads(response.get_data(as_text=True))['data']
+                    entry = next(d for d in data if d['name'] == 'link.htm')
+                    self.assertNotIn('target', entry)
+                    self.assertEqual(entry['mime'], 'text/html')
+                    self.assertEqual(entry['media'], 'html')
+        parse_meta_refresh.assert_not_called()
+
+    def test_etag(self):
+        for url in ('/?a=list&f=json', '/?a=list&f=sse', '/'):
+            with self.subTest(url=url):
+                etag = self.get(url).headers['ETag']
+
+                # validated without listing the entries
+                with mock.patch.object(util, 'listdir') as listdir:
+                    response = self.get(url, headers={'If-None-Match': etag})
+                self.assertEqual(response.status_code, 304)
+                listdir.assert_not_called()
+
+    def test_etag_entry_added(self):
+        """An added entry invalidates the listing, even if the mtime of the
+        directory is not changed, e.g. on a file system with a coarse
+        timestamp resolution.
+        """
+        url = '/?a=list&f=json'
+        etag = self.get(url).headers['ETag']
+
+        stat = os.stat(self.root)
+        with open(os.path.join(self.root, 'file3.txt'), 'w') as fh:
+            fh.write('file3')
+        os.utime(self.root, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        response = self.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_etag_recursive(self):
+        """A recursive listing is streamed without walking the tree for a
+        validator first.
+        """
+        with mock.patch.object(util, 'dir_fingerprint') as dir_fingerprint:
+            response = self.get('/?a=list&f=json&recursive=1')
+        dir_fingerprint.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+    def test_sse_batch(self):
+        response = self.get('/?a=list&f=sse')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True).count('data: {'), 3)
+
+        response = self.get('/?a=list&f=sse&batch=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True).count('data: ['), 2)
+
+    def test_sse_batch_invalid(self):
+        for batch in ('abc', '', '0', '-1', '1.5'):
+            with self.subTest(batch=batch):
+                response = self.get('/?a=list&f=sse&batch=' + batch)
+                self.assertEqual(response.status_code, 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+from werkzeug.test import Client
+
+from webscrapbook import server
+from webscrapbook.app import make_app
+from webscrapbook.server import SendfileMiddleware, SendfileWrapper
+
+
+class MockSocket():
+    def __init__(self):
+        self.sent = []
+
+    def sendfile(self, file, offset=0, count=None):
+        file.seek(offset)
+        self.sent.append(file.read(count))
+
+
+class TestSendfileMiddleware(unittest.TestCase):
+    DATA = bytes(range(256)) * 64
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        with open(os.path.join(self.root, 'image.png'), 'wb') as fh:
+            fh.write(self.DATA)
+        with zipfile.ZipFile(os.path.join(self.root, 'page.htz'), 'w') as zip:
+            zip.writestr('index.html', 'index', compress_type=zipfile.ZIP_DEFLATED)
+            zip.writestr('image.png', self.DATA, compress_type=zipfile.ZIP_STORED)
+
+        self.client = Client(SendfileMiddleware(make_app(self.root)))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get(self, path, headers=None):
+        sock = MockSocket()
+        response = self.client.get(path, headers=headers, environ_overrides={
+            'wsgi.file_wrapper': SendfileWrapper,
+            'webscrapbook.socket': sock,
+            })
+        data = response.get_data()
+        return response, data, sock.sent
+
+    def test_full(self):
+        for path in ('/image.png', '/page.htz!/image.png'):
+            with self.subTest(path=path):
+                response, data, sent = self.get(path)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(data, b'')
+                self.assertEqual(sent, [self.DATA])
+
+    def test_range(self):
+        for path in ('/image.png', '/page.htz!/image.png'):
+            with self.subTest(path=path):
+                response, data, sent = self.get(path, headers={'Range': 'bytes=100-1099'})
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(data, b'')
+                self.assertEqual(sent, [self.DATA[100:1100]])
+
+    def test_range_without_range_wrapper(self):
+        with mock.patch.object(server, '_RangeWrapper', None):
+            response, data, sent = self.get('/page.htz!/image.png', headers={'Range': 'bytes=100-1099'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(data, self.DATA[100:1100])
+        self.assertEqual(sent, [])
+
+    def test_deflated(self):
+        response, data, sent = self.get('/page.htz!/index.html')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data, b'index')
+        self.assertEqual(sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+from threading import Thread
+from unittest import mock
+from urllib.request import Request, urlopen
+
+from werkzeug.test import Client
+
+from webscrapbook import server
+from webscrapbook.app import make_app
+from webscrapbook.server import ViewerMiddleware
+
+
+class TestViewerMiddleware(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        for name in ('page.htz', 'other.htz'):
+            with zipfile.ZipFile(os.path.join(self.root, name), 'w') as zip:
+                zip.writestr('index.html', '<p>{}</p>'.format(name))
+                zip.writestr('sub/file.txt', 'sub')
+        with open(os.path.join(self.root, 'secret.txt'), 'w') as fh:
+            fh.write('secret')
+
+        self.cache_dir = tempfile.TemporaryDirectory()
+        app = make_app(self.root, cache_dir=self.cache_dir.name)
+        self.viewer = ViewerMiddleware(app, self.root, 'token')
+        self.viewer.hosts.add('localhost')
+        self.client = Client(self.viewer)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+        self.tmpdir.cleanup()
+
+    def get(self, path, **kwargs):
+        return self.client.get(path, base_url='http://localhost', **kwargs)
+
+    def register(self, name):
+        return self.client.post('/token', base_url='http://localhost', data=name.encode('UTF-8'))
+
+    def test_registered_archive(self):
+        response = self.register('page.htz')
+        self.assertEqual(response.status_code, 200)
+        token = response.get_data(as_text=True)
+
+        response = self.get('/{}/page.htz!/index.html'.format(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), b'<p>page.htz</p>')
+
+        response = self.get('/{}/page.htz!/sub/file.txt?a=source'.format(token))
+        self.assertEqual(response.status_code, 200)
+
+    def test_unregistered_paths(self):
+        token = self.register('page.htz').get_data(as_text=True)
+
+        for path in (
+                '/{}/secret.txt',
+                '/{}/other.htz!/index.html',
+                '/{}/',
+                '/{}/page.htz!/',
+                '/{}/page.htz!/sub/',
+                '/{}/page.htz!/../secret.txt',
+                '/{}/page.htz!/index.html?a=list',
+                '/other/page.htz!/index.html',
+                '/token/page.htz!/index.html',
+                ):
+            with self.subTest(path=path):
+                self.assertIn(self.get(path.format(token)).status_code, (403, 404))
+
+        self.assertEqual(self.get('/{}/page.htz!/index.html'.format(token),
+                headers={'Host': 'example.com'}).status_code, 404)
+
+    def test_register_invalid(self):
+        for name in ('secret.txt', 'missing.htz', '../page.htz', '', '.'):
+            with self.subTest(name=name):
+                self.assertEqual(self.register(name).status_code, 400)
+
+    def test_no_cache_under_root(self):
+        token = self.register('page.htz').get_data(as_text=True)
+        self.get('/{}/page.htz!/index.html'.format(token))
+        self.assertFalse(os.path.lexists(os.path.join(self.root, '.wsb')))
+
+
+class TestViewerServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'root')
+        os.makedirs(self.root)
+        with zipfile.ZipFile(os.path.join(self.root, 'page.htz'), 'w') as zip:
+            zip.writestr('index.html', '<p>page</p>')
+        self.state_file = os.path.join(self.tmpdir.name, 'server.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def start_server(self, timeout):
+        thread = Thread(target=server.serve_viewer, args=(self.root, self.state_file, timeout), daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.state_file):
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        return thread
+
+    def test_reuse_state_file(self):
+        self.start_server(2)
+        with open(self.state_file, encoding='UTF-8') as f:
+            state = json.load(f)
+        self.assertEqual(state['pid'], os.getpid())
+
+        # a running server is reused rather than starting another one
+        with mock.patch.object(server.subprocess, 'Popen') as popen:
+            url = server.get_viewer_url(self.root, 'page.htz', self.state_file)
+        popen.assert_not_called()
+        self.assertTrue(url.startswith('http://127.0.0.1:{}/'.format(state['port'])))
+        self.assertTrue(url.endswith('/page.htz!/'))
+
+        with urlopen(url + 'index.html', timeout=5) as r:
+            self.assertEqual(r.read(), b'<p>page</p>')
+
+        # the token of the server is required
+        url2 = 'http://127.0.0.1:{}/page.htz!/index.html'.format(state['port'])
+        with self.assertRaises(OSError):
+            urlopen(url2, timeout=5)
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'requires os.getuid')
+    def test_state_file_of_another_user(self):
+        self.start_server(2)
+
+        # a state file not owned by the current user is not trusted, and a
+        # new server is started instead
+        popen = mock.Mock()
+        popen.return_value.poll.return_value = 1
+        with mock.patch.object(server.os, 'getuid', return_value=os.getuid() + 1), \
+                mock.patch.object(server.subprocess, 'Popen', popen), \
+                mock.patch.object(server, 'urlopen') as urlopen_:
+            with self.assertRaises(RuntimeError):
+                server.get_viewer_url(self.root, 'page.htz', self.state_file)
+        popen.assert_called_once()
+        urlopen_.assert_not_called()
+
+    def test_config_not_applied(self):
+        """Authorization, offloading, and compression of the book are not
+        applied to the viewer, which is not behind a reverse proxy.
+        """
+        os.makedirs(os.path.join(self.root, '.wsb'))
+        with open(os.path.join(self.root, '.wsb', 'config.ini'), 'w', encoding='UTF-8') as fh:
+            fh.write("""[app]
+offload = x-accel-redirect
+offload_zip = true
+compress = true
+
+[auth "user"]
+user = user
+pw = pass
+""")
+        page = '<p>page</p>' * 200
+        with zipfile.ZipFile(os.path.join(self.root, 'page.htz'), 'w') as zip:
+            zip.writestr('index.html', page)
+
+        self.start_server(2)
+        url = server.get_viewer_url(self.root, 'page.htz', self.state_file)
+
+        req = Request(url + 'index.html', headers={'Accept-Encoding': 'gzip'})
+        with urlopen(req, timeout=5) as r:
+            self.assertEqual(r.status, 200)
+            self.assertIsNone(r.headers['Content-Encoding'])
+            self.assertIsNone(r.headers['X-Accel-Redirect'])
+            self.assertEqual(r.read().decode('UTF-8'), page)
+
+    def test_timeout(self):
+        thread = self.start_server(1)
+        server.get_viewer_url(self.root, 'page.htz', self.state_file)
+
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(os.path.exists(self.state_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import base64
+import json
+import unittest
+
+from webscrapbook import util
+
+
+def make_cursor(obj):
+    return base64.urlsafe_b64encode(json.dumps(obj).encode('ASCII')).decode('ASCII')
+
+
+class TestPaginateListing(unittest.TestCase):
+    def setUp(self):
+        self.infos = [
+            util.FileInfo(name='file{}.txt'.format(i), type='file', size=i, last_modified=1000 + i)
+            for i in range(5)
+            ]
+
+    def test_pages(self):
+        page, cursor = util.paginate_listing(iter(self.infos), limit=2, sort='size')
+        self.assertEqual([i.size for i in page], [0, 1])
+        page, cursor = util.paginate_listing(iter(self.infos), limit=2, sort='size', cursor=cursor)
+        self.assertEqual([i.size for i in page], [2, 3])
+        page, cursor = util.paginate_listing(iter(self.infos), limit=2, sort='size', cursor=cursor)
+        self.assertEqual([i.size for i in page], [4])
+        self.assertIsNone(cursor)
+
+    def test_invalid_cursor(self):
+        for sort, cursor in (
+                ('name', 'not a cursor'),
+                ('name', make_cursor({'a': 1})),
+                ('name', make_cursor(['name', 'asc', 1])),
+                ('name', make_cursor(['name', 'asc', [1, 2]])),
+                ('name', make_cursor(['name', 'asc', ['a']])),
+                ('size', make_cursor(['size', 'asc', ['a', 'b']])),
+                ('size', make_cursor(['size', 'asc', [True, 'b']])),
+                ('mtime', make_cursor(['mtime', 'asc', [None, 'b']])),
+                ('size', make_cursor(['name', 'asc', ['a', 'b']])),
+                ):
+            with self.subTest(sort=sort, cursor=cursor):
+                with self.assertRaises(ValueError):
+                    page, _ = util.paginate_listing(iter(self.infos), limit=2, sort=sort, cursor=cursor)
+                    list(page)
+
+
+if __name__ == '__main__':
+    unittest.main()
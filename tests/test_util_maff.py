@@ -0,0 +1,76 @@
+import gc
+import os
+import tempfile
+import time
+import unittest
+import weakref
+import zipfile
+from unittest import mock
+
+from webscrapbook import util
+
+
+class TestMaffPagesCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmpdir.name, 'cache', 'maff.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_maff(self, name, count):
+        file = os.path.join(self.tmpdir.name, name)
+        with zipfile.ZipFile(file, 'w') as zip:
+            for i in range(count):
+                zip.writestr('{}/index.html'.format(i), '<p>{}</p>'.format(i))
+        return file
+
+    def test_batch_save(self):
+        files = [self.make_maff('{}.maff'.format(i), 1) for i in range(3)]
+        cache = util.MaffPagesCache(self.cache_file, save_delay=0.2)
+        with mock.patch.object(cache, 'save', wraps=cache.save) as save:
+            for file in files:
+                self.assertEqual(len(cache.get(file)), 1)
+            self.assertFalse(os.path.exists(self.cache_file))
+
+            time.sleep(0.5)
+            self.assertEqual(save.call_count, 1)
+
+        cache2 = util.MaffPagesCache(self.cache_file)
+        cache2.load()
+        self.assertEqual(set(cache2._entries), {os.path.realpath(f) for f in files})
+
+    def test_flush(self):
+        file = self.make_maff('a.maff', 1)
+        cache = util.MaffPagesCache(self.cache_file, save_delay=60)
+        cache.get(file)
+        cache.flush()
+        self.assertTrue(os.path.exists(self.cache_file))
+
+    def test_flush_at_exit(self):
+        file = self.make_maff('a.maff', 1)
+        cache = util.MaffPagesCache(self.cache_file, save_delay=60)
+        cache.get(file)
+        cache._timer.cancel()
+        util._flush_maff_pages_caches()
+        self.assertTrue(os.path.exists(self.cache_file))
+
+    def test_not_held_for_exit(self):
+        cache = util.MaffPagesCache(self.cache_file)
+        self.assertIn(cache, util._maff_pages_caches)
+        ref = weakref.ref(cache)
+        del cache
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_max_pages(self):
+        files = [self.make_maff('{}.maff'.format(i), 3) for i in range(3)]
+        cache = util.MaffPagesCache(max_pages=7)
+        for file in files:
+            cache.get(file)
+        self.assertEqual(list(cache._entries), [os.path.realpath(f) for f in files[1:]])
+        self.assertEqual(cache._pages, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from webscrapbook import util
+
+
+class TestMarkdownCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'cache')
+        self.file = os.path.join(self.tmpdir.name, 'note.md')
+        with open(self.file, 'w', encoding='UTF-8') as fh:
+            fh.write('hello')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def cache_files(self):
+        return [os.path.join(dirpath, f) for dirpath, _, files in os.walk(self.root) for f in files]
+
+    def test_modified_during_reading(self):
+        def render(text):
+            # modify the file after it has been read
+            with open(self.file, 'a', encoding='UTF-8') as fh:
+                fh.write(' world')
+            return text
+
+        cache = util.MarkdownCache(self.root, render=render)
+        stat = os.stat(self.file)
+        self.assertEqual(cache.get(self.file, stat), 'hello')
+        self.assertEqual(cache._entries, {})
+        self.assertEqual(self.cache_files(), [])
+
+    def test_prune(self):
+        cache = util.MarkdownCache(self.root, render=str.upper)
+        self.assertEqual(cache.get(self.file), 'HELLO')
+        self.assertEqual(len(self.cache_files()), 1)
+
+        # load from a persisted fragment after a restart
+        cache = util.MarkdownCache(self.root, render=None)
+        self.assertEqual(cache.get(self.file), 'HELLO')
+        self.assertEqual(cache.prune(), 0)
+
+        # a newer version replaces the former one
+        with open(self.file, 'w', encoding='UTF-8') as fh:
+            fh.write('hello world')
+        cache = util.MarkdownCache(self.root, render=str.upper)
+        self.assertEqual(cache.get(self.file), 'HELLO WORLD')
+        self.assertEqual(len(self.cache_files()), 1)
+
+        os.remove(self.file)
+        cache = util.MarkdownCache(self.root)
+        self.assertEqual(cache.prune(), 1)
+        self.assertEqual(os.listdir(self.root), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr
+from io import StringIO
+from unittest import mock
+
+from webscrapbook import util
+
+
+def crash(file, dest, size, member=None):
+    os._exit(1)
+
+
+@unittest.skipIf(util.Image is None, 'requires Pillow')
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'thumbs')
+        self.file = os.path.join(self.tmpdir.name, 'image.png')
+        util.Image.new('RGB', (64, 32)).save(self.file)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        thumbnail = cache.get(self.file, 16)
+        with util.Image.open(thumbnail) as im:
+            self.assertEqual(im.size, (16, 8))
+        self.assertEqual(cache.get(self.file, 16), thumbnail)
+
+    def test_broken_pool(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        stderr = StringIO()
+        with mock.patch.object(util, 'make_thumbnail', crash), redirect_stderr(stderr):
+            with self.assertRaises(BrokenProcessPool):
+                cache.get(self.file, 16)
+        self.assertIn('Restarting', stderr.getvalue())
+
+        # a new pool is created for the next request
+        thumbnail = cache.get(self.file, 16)
+        self.assertTrue(os.path.isfile(thumbnail))
+
+    def test_start_method(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        cache.get(self.file, 16)
+        self.assertIn(cache._executor._mp_context.get_start_method(), ('forkserver', 'spawn'))
+
+    def test_zip_member(self):
+        file = os.path.join(self.tmpdir.name, 'image.zip')
+        with zipfile.ZipFile(file, 'w', zipfile.ZIP_DEFLATED) as zip:
+            zip.write(self.file, 'image.png')
+
+        dest = os.path.join(self.tmpdir.name, 'thumb')
+        with mock.patch.object(zipfile.ZipFile, 'read', side_effect=AssertionError('read in memory')):
+            thumbnail = util.make_thumbnail(file, dest, 16, 'image.png')
+        with util.Image.open(thumbnail) as im:
+            self.assertEqual(im.size, (16, 8))
+
+    def make_thumbnails(self, cache, count):
+        thumbnails = []
+        for i in range(count):
+            thumbnails.append(cache.get(self.file, 16 + i))
+            # distinct access times
+            t = time.time() - 1000 + i
+            os.utime(thumbnails[-1], (t, t))
+        return thumbnails
+
+    def test_prune_size(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        thumbnails = self.make_thumbnails(cache, 4)
+        sizes = [os.stat(t).st_size for t in thumbnails]
+
+        self.assertEqual(cache.prune(max_size=sum(sizes[2:])), 2)
+        self.assertEqual([os.path.exists(t) for t in thumbnails], [False, False, True, True])
+        self.assertEqual(cache._size, sum(sizes[2:]))
+
+    def test_prune_expire(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        thumbnails = self.make_thumbnails(cache, 3)
+        t = time.time() - 10000
+        os.utime(thumbnails[1], (t, t))
+
+        self.assertEqual(cache.prune(expire=5000), 1)
+        self.assertEqual([os.path.exists(t) for t in thumbnails], [True, False, True])
+
+    def test_prune_background(self):
+        cache = util.ThumbnailCache(self.root, 1)
+        thumbnails = self.make_thumbnails(cache, 2)
+        cache.max_size = sum(os.stat(t).st_size for t in thumbnails)
+        self.assertEqual(cache.prune(), 0)
+
+        # exceeding max_size triggers a prune of the least recently accessed
+        cache.get(self.file, 64)
+        deadline = time.monotonic() + 10
+        while cache._pruning:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.05)
+        self.assertFalse(os.path.exists(thumbnails[0]))
+        self.assertLessEqual(cache._size, cache.max_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
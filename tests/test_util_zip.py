@@ -0,0 +1,390 @@
+import io
+import os
+import struct
+import tempfile
+import unittest
+import zipfile
+import zlib
+from unittest import mock
+
+from webscrapbook import util
+
+
+class TestZipIndex(unittest.TestCase):
+    def setUp(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zip:
+            zip.writestr('index.html', 'index')
+            zip.writestr('a/', '')
+            zip.writestr('a/b/c.txt', 'c')
+            zip.writestr('a/d.txt', 'd')
+            zip.writestr('e/f/', '')
+            zip.writestr(zipfile.ZipInfo('g.txt', (2001, 2, 3, 4, 5, 6)), 'g')
+        self.zip = zipfile.ZipFile(buf)
+
+    def tearDown(self):
+        self.zip.close()
+
+    def test_scan_index_matches(self):
+        index = util.ZipIndex(self.zip)
+        scan = util.ZipScanIndex(self.zip)
+
+        for path in ('', 'a', 'a/b', 'e', 'e/f', 'index.html', 'a/d.txt', 'x', 'a/x'):
+            with self.subTest(path=path):
+                self.assertEqual(scan.has_dir(path), index.has_dir(path))
+                for check_missing_dir in (False, True):
+                    self.assertEqual(scan.file_info(path, check_missing_dir), index.file_info(path, check_missing_dir))
+                if index.has_dir(path):
+                    self.assertEqual(list(scan.listdir(path)), list(index.listdir(path)))
+                else:
+                    with self.assertRaises(util.ZipDirNotFoundError):
+                        list(scan.listdir(path))
+
+    def test_uncached_zip(self):
+        self.assertIsInstance(util.zip_index(self.zip), util.ZipScanIndex)
+
+
+def make_source_zip(seekable=False):
+    """Make a ZIP file with members of various header features.
+
+    Data descriptors are used unless seekable.
+    """
+    buf = io.BytesIO() if seekable else util.StreamBuffer()
+    with zipfile.ZipFile(buf, 'w') as zip:
+        zip.writestr(zipfile.ZipInfo('stored.txt', (2001, 2, 3, 4, 5, 6)), 'stored' * 100)
+        info = zipfile.ZipInfo('deflated.txt', (2001, 2, 3, 4, 5, 6))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zip.writestr(info, 'deflated' * 100)
+        info = zipfile.ZipInfo('中文/ファイル.txt', (2001, 2, 3, 4, 5, 6))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        zip.writestr(info, 'utf-8' * 100)
+        info = zipfile.ZipInfo('zip64.txt', (2001, 2, 3, 4, 5, 6))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zip.open(info, 'w', force_zip64=True) as fh:
+            fh.write(b'zip64' * 100)
+    return buf if seekable else io.BytesIO(buf.pop())
+
+
+class TestZipCopy(unittest.TestCase):
+    seekable = False
+
+    def setUp(self):
+        self.buf = make_source_zip(self.seekable)
+        self.zsrc = zipfile.ZipFile(self.buf)
+
+    def tearDown(self):
+        self.zsrc.close()
+
+    def raw_data(self, zip, fh, info):
+        fh = util.zip_open_data(zip, info) if fh is None else fh
+        fh.seek(info.header_offset)
+        _, filename_length, extra_length = util._zip_read_file_header(fh, info)
+        fh.seek(filename_length + extra_length, 1)
+        return fh.read(info.compress_size)
+
+    def check_copy(self, zdst, dst, arcnames):
+        for info in self.zsrc.infolist():
+            self.assertEqual(bool(info.flag_bits & 0x08), not self.seekable)
+            util.zip_copy(self.zsrc, zdst, info, arcnames.get(info.filename), fsrc=self.buf)
+        zdst.close()
+
+        with zipfile.ZipFile(dst) as zip:
+            self.assertIsNone(zip.testzip())
+            for info in self.zsrc.infolist():
+                name = arcnames.get(info.filename, info.filename)
+                with self.subTest(name=name):
+                    zinfo = zip.getinfo(name)
+                    self.assertEqual(zip.read(zinfo), self.zsrc.read(info))
+                    self.assertEqual(zinfo.compress_type, info.compress_type)
+                    self.assertEqual(zinfo.date_time, info.date_time)
+
+                    # the data is copied as-is
+                    self.assertEqual(self.raw_data(zip, dst, zinfo), self.raw_data(self.zsrc, self.buf, info))
+
+                    # the data descriptor is dropped
+                    self.assertFalse(zinfo.flag_bits & 0x08)
+
+    def test_copy(self):
+        dst = io.BytesIO()
+        self.check_copy(zipfile.ZipFile(dst, 'w'), dst, {})
+
+    def test_copy_renamed(self):
+        dst = io.BytesIO()
+        self.check_copy(zipfile.ZipFile(dst, 'w'), dst, {
+            'stored.txt': 'renamed/stored.txt',
+            'deflated.txt': '改名.txt',
+            '中文/ファイル.txt': 'ascii.txt',
+            'zip64.txt': 'zip64-renamed.txt',
+            })
+
+    def test_copy_zip64_header(self):
+        info = self.zsrc.getinfo('zip64.txt')
+
+        # the header with a ZIP64 extra field is copied verbatim, or
+        # regenerated without it if not needed
+        for arcname, expected in ((None, 20 if self.seekable else 0), ('renamed.txt', 0)):
+            with self.subTest(arcname=arcname):
+                dst = io.BytesIO()
+                with zipfile.ZipFile(dst, 'w') as zdst:
+                    util.zip_copy(self.zsrc, zdst, info, arcname, fsrc=self.buf)
+
+                dst.seek(0)
+                _, _, extra_length = util._zip_read_file_header(dst, info)
+                self.assertEqual(extra_length, expected)
+                with zipfile.ZipFile(dst) as zip:
+                    self.assertIsNone(zip.testzip())
+                    self.assertEqual(zip.read(arcname or info.filename), b'zip64' * 100)
+
+    def test_copy_to_stream(self):
+        buf = util.StreamBuffer()
+        zdst = zipfile.ZipFile(buf, 'w')
+        for info in self.zsrc.infolist():
+            util.zip_copy(self.zsrc, zdst, info, fsrc=self.buf)
+        zdst.close()
+
+        with zipfile.ZipFile(io.BytesIO(buf.pop())) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), self.zsrc.namelist())
+
+    def test_strip_extra(self):
+        extra = struct.pack('<HH', 1, 4) + b'abcd' + struct.pack('<HH', 0x5455, 1) + b'e'
+        self.assertEqual(util._zip_strip_extra(extra, (1,)), struct.pack('<HH', 0x5455, 1) + b'e')
+        self.assertEqual(util._zip_strip_extra(extra, (2,)), extra)
+        self.assertEqual(util._zip_strip_extra(b'', (1,)), b'')
+
+    def test_unsupported_zipfile(self):
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zdst, \
+                mock.patch.object(util, '_ZIP_WRITE_ATTRS', util._ZIP_WRITE_ATTRS + ('_missing',)):
+            with self.assertRaises(RuntimeError):
+                util.zip_copy(self.zsrc, zdst, self.zsrc.infolist()[0], fsrc=self.buf)
+
+
+class TestZipCopySeekable(TestZipCopy):
+    """Copy members without data descriptors, whose headers are copied
+    verbatim unless renamed.
+    """
+    seekable = True
+
+
+class FailingReader(io.BytesIO):
+    """A file object that fails after reading fail_after bytes."""
+    def __init__(self, data, fail_after):
+        super().__init__(data)
+        self.fail_after = fail_after
+
+    def read(self, size=-1):
+        if self.tell() >= self.fail_after:
+            raise OSError('read failed')
+        return super().read(size)
+
+
+class TestZipPacker(unittest.TestCase):
+    BLOCK_SIZE = 4096
+
+    def setUp(self):
+        # compressible data that spans many blocks and back-references
+        # across block boundaries
+        words = [('word%d ' % i).encode('ASCII') for i in range(500)]
+        self.data = b''.join(words[(i * 7919) % len(words)] for i in range(20000))
+        self.assertGreater(len(self.data), self.BLOCK_SIZE * 20)
+
+    def raw_data(self, zip, info):
+        with util.zip_open_data(zip, info) as fh:
+            return fh.read(info.compress_size)
+
+    def pack(self, fp, workers):
+        with zipfile.ZipFile(fp, 'w') as zip:
+            with util.ZipPacker(zip, 6, workers, block_size=self.BLOCK_SIZE) as packer:
+                packer.add_dir('dir/')
+                packer.add_data(zipfile.ZipInfo('dir/data.txt'), self.data)
+                packer.add_data(zipfile.ZipInfo('image.png'), self.data)
+                packer.add_data(zipfile.ZipInfo('empty.txt'), b'')
+                packer.add_data(zipfile.ZipInfo('level.txt'), self.data, compresslevel=1)
+
+    def test_multi_block(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for workers in (None, 0, 3):
+                with self.subTest(workers=workers):
+                    file = os.path.join(tmpdir, 'packed{}.zip'.format(workers))
+                    self.pack(file, workers)
+
+                    with zipfile.ZipFile(file) as zip:
+                        self.assertIsNone(zip.testzip())
+                        self.assertEqual(zip.namelist(), ['dir/', 'dir/data.txt', 'image.png', 'empty.txt', 'level.txt'])
+
+                        # a single deflate stream of the blocks
+                        info = zip.getinfo('dir/data.txt')
+                        self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                        self.assertEqual(zlib.decompress(self.raw_data(zip, info), -15), self.data)
+                        self.assertLess(info.compress_size, len(self.data) / 4)
+
+                        info = zip.getinfo('level.txt')
+                        self.assertEqual(zlib.decompress(self.raw_data(zip, info), -15), self.data)
+
+                        # an already compressed type is stored
+                        info = zip.getinfo('image.png')
+                        self.assertEqual(info.compress_type, zipfile.ZIP_STORED)
+                        self.assertEqual(self.raw_data(zip, info), self.data)
+
+                        self.assertEqual(zip.read('empty.txt'), b'')
+
+    def test_same_as_serial(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            file0 = os.path.join(tmpdir, 'serial.zip')
+            file1 = os.path.join(tmpdir, 'parallel.zip')
+            self.pack(file0, 0)
+            self.pack(file1, 3)
+            with open(file0, 'rb') as fh0, open(file1, 'rb') as fh1:
+                self.assertEqual(fh0.read(), fh1.read())
+
+    def test_unseekable(self):
+        buf = util.StreamBuffer()
+        self.pack(buf, 2)
+        with zipfile.ZipFile(io.BytesIO(buf.pop())) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertTrue(zip.getinfo('dir/data.txt').flag_bits & 0x08)
+            self.assertEqual(zip.read('dir/data.txt'), self.data)
+
+    def test_abort(self):
+        for seekable in (True, False):
+            with self.subTest(seekable=seekable):
+                buf = io.BytesIO() if seekable else util.StreamBuffer()
+                zip = zipfile.ZipFile(buf, 'w')
+                with self.assertRaises(OSError):
+                    with util.ZipPacker(zip, 6, 2, block_size=self.BLOCK_SIZE) as packer:
+                        packer.add_data(zipfile.ZipInfo('done.txt'), self.data)
+                        packer.add_stream(zipfile.ZipInfo('failed.txt'),
+                                FailingReader(self.data, self.BLOCK_SIZE * 12))
+
+                # the failed member is partially written
+                self.assertGreater(buf.tell() if seekable else len(b''.join(buf.chunks)),
+                        zip.start_dir if seekable else 0)
+                self.assertFalse(zip._writing)
+
+                zip.writestr('after.txt', 'after')
+                zip.close()
+
+                data = buf.getvalue() if seekable else buf.pop()
+                with zipfile.ZipFile(io.BytesIO(data)) as zip:
+                    self.assertIsNone(zip.testzip())
+                    self.assertEqual(zip.namelist(), ['done.txt', 'after.txt'])
+                    self.assertEqual(zip.read('done.txt'), self.data)
+
+    def test_abort_keeps_other_writer(self):
+        with zipfile.ZipFile(io.BytesIO(), 'w') as zip:
+            with zip.open('other.txt', 'w') as fh:
+                packer = util.ZipPacker(zip, 6, 0)
+                packer.abort()
+                self.assertTrue(zip._writing)
+                fh.write(b'other')
+
+
+class TestZipAppend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmpdir.name, 'test.zip')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def dead_space(self):
+        with zipfile.ZipFile(self.file) as zip:
+            return util.zip_dead_space(zip)
+
+    def test_no_dead_space(self):
+        # local headers with a ZIP64 extra field or a data descriptor, which
+        # the central directory doesn't have
+        for seekable in (True, False):
+            with self.subTest(seekable=seekable):
+                with open(self.file, 'wb') as fh:
+                    fh.write(make_source_zip(seekable).getvalue())
+                self.assertEqual(self.dead_space(), 0)
+
+    def test_append_and_compact(self):
+        with zipfile.ZipFile(self.file, 'w') as zip:
+            zip.writestr('a.txt', 'a' * 1000)
+            zip.writestr('b.txt', os.urandom(1000))
+            zip.writestr('c.txt', 'c' * 1000)
+        with zipfile.ZipFile(self.file) as zip:
+            info_b = zip.getinfo('b.txt')
+            info_c = zip.getinfo('c.txt')
+
+        # replace b.txt in place
+        with util.zip_append(self.file, exclude=lambda i: i.filename == 'b.txt') as zip:
+            with zip.open(zipfile.ZipInfo('b.txt'), 'w', force_zip64=True) as fh:
+                fh.write(b'new b')
+        self.assertEqual(self.dead_space(), info_c.header_offset - info_b.header_offset)
+
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ['a.txt', 'c.txt', 'b.txt'])
+            self.assertEqual(zip.read('b.txt'), b'new b')
+
+        # delete c.txt
+        with util.zip_append(self.file, exclude=lambda i: i.filename == 'c.txt'):
+            pass
+        dead = self.dead_space()
+        self.assertEqual(dead, info_c.header_offset - info_b.header_offset +
+                zipfile.sizeFileHeader + len('c.txt') + info_c.compress_size)
+
+        size = os.stat(self.file).st_size
+        self.assertEqual(util.zip_compact(self.file), dead)
+        self.assertEqual(os.stat(self.file).st_size, size - dead)
+        self.assertEqual(self.dead_space(), 0)
+
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ['a.txt', 'b.txt'])
+            self.assertEqual(zip.read('a.txt'), b'a' * 1000)
+            self.assertEqual(zip.read('b.txt'), b'new b')
+
+    def test_append_failed(self):
+        with zipfile.ZipFile(self.file, 'w') as zip:
+            zip.writestr('a.txt', 'a' * 1000)
+            zip.writestr('b.txt', 'b' * 1000)
+        size = os.stat(self.file).st_size
+
+        with self.assertRaises(OSError):
+            with util.zip_append(self.file, exclude=lambda i: i.filename == 'b.txt') as zip:
+                with util.ZipPacker(zip, workers=0, block_size=4096) as packer:
+                    packer.add_stream(zipfile.ZipInfo('b.txt'),
+                            FailingReader(os.urandom(16384), 8192), zipfile.ZIP_DEFLATED)
+
+        self.assertEqual(os.stat(self.file).st_size, size)
+        self.assertEqual(self.dead_space(), 0)
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertIsNone(zip.testzip())
+            self.assertEqual(zip.namelist(), ['a.txt', 'b.txt'])
+            self.assertEqual(zip.read('b.txt'), b'b' * 1000)
+
+        # still appendable
+        with util.zip_append(self.file) as zip:
+            zip.writestr('c.txt', 'c')
+        with zipfile.ZipFile(self.file) as zip:
+            self.assertEqual(zip.namelist(), ['a.txt', 'b.txt', 'c.txt'])
+
+
+class TestZipCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = util.ZipCache(max_entries=8, max_size=1 << 30)
+
+    def test_add_size(self):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as zip:
+            zip.writestr('index.html', 'index')
+        entry = util.ZipCacheEntry('key', zipfile.ZipFile(buf), 100)
+        self.cache._entries['key'] = entry
+        self.cache.size = 100
+
+        self.assertTrue(self.cache.is_cached(entry.zip))
+        self.cache.add_size(entry.zip, 50)
+        self.assertEqual(entry.size, 150)
+        self.assertEqual(self.cache.size, 150)
+
+        # not held by the cache
+        self.cache.add_size(zipfile.ZipFile(buf), 50)
+        self.assertEqual(self.cache.size, 150)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -101,11 +101,27 @@ class Config():
         data['app']['allowed_x_host'] = self._conf['app'].getint('allowed_x_host')
         data['app']['allowed_x_port'] = self._conf['app'].getint('allowed_x_port')
         data['app']['allowed_x_prefix'] = self._conf['app'].getint('allowed_x_prefix')
+        data['app']['zip_cache_entries'] = self._conf['app'].getint('zip_cache_entries')
+        data['app']['zip_cache_size'] = self._conf['app'].getint('zip_cache_size')
+        data['app']['zip_append_mode'] = self._conf['app'].getboolean('zip_append_mode')
+        data['app']['zip_compact_ratio'] = self._conf['app'].getfloat('zip_compact_ratio')
+        data['app']['maff_cache_persist'] = self._conf['app'].getboolean('maff_cache_persist')
+        data['app']['markdown_cache_persist'] = self._conf['app'].getboolean('markdown_cache_persist')
+        data['app']['markdown_cache_size'] = self._conf['app'].getint('markdown_cache_size')
+        data['app']['thumbnail_workers'] = self._conf['app'].getint('thumbnail_workers')
+        data['app']['thumbnail_cache_size'] = self._conf['app'].getint('thumbnail_cache_size')
+        data['app']['thumbnail_cache_expire'] = self._conf['app'].getint('thumbnail_cache_expire')
+        data['app']['listdir_workers'] = self._conf['app'].getint('listdir_workers')
+        data['app']['compress'] = self._conf['app'].getboolean('compress')
+        data['app']['compress_cache_size'] = self._conf['app'].getint('compress_cache_size')
+        data['app']['offload_zip'] = self._conf['app'].getboolean('offload_zip')
         data['server']['port'] = self._conf['server'].getint('port')
         data['server']['ssl_on'] = self._conf['server'].getboolean('ssl_on')
         data['server']['browse'] = self._conf['server'].getboolean('browse')
         data['browser']['cache_expire'] = self._conf['browser'].getint('cache_expire')
         data['browser']['use_jar'] = self._conf['browser'].getboolean('use_jar')
+        data['browser']['use_server'] = self._conf['browser'].getboolean('use_server')
+        data['browser']['server_timeout'] = self._conf['browser'].getint('server_timeout')
         for ss in data['book']:
             data['book'][ss]['no_tree'] = self._conf['book "{}"'.format(ss)].getboolean('no_tree')
 
@@ -160,6 +176,22 @@ class Config():
         conf['app']['allowed_x_host'] = '0'
         conf['app']['allowed_x_port'] = '0'
         conf['app']['allowed_x_prefix'] = '0'
+        conf['app']['zip_cache_entries'] = '32'
+        conf['app']['zip_cache_size'] = '64'
+        conf['app']['zip_append_mode'] = 'false'
+        conf['app']['zip_compact_ratio'] = '0.5'
+        conf['app']['maff_cache_persist'] = 'false'
+        conf['app']['markdown_cache_persist'] = 'true'
+        conf['app']['markdown_cache_size'] = '16'
+        conf['app']['thumbnail_workers'] = '2'
+        conf['app']['thumbnail_cache_size'] = '256'
+        conf['app']['thumbnail_cache_expire'] = '2592000'
+        conf['app']['listdir_workers'] = '0'
+        conf['app']['compress'] = 'false'
+        conf['app']['compress_cache_size'] = '16'
+        conf['app']['offload'] = ''
+        conf['app']['offload_prefix'] = '/_wsb_offload'
+        conf['app']['offload_zip'] = 'false'
         conf['server'] = {}
         conf['server']['port'] = '8080'
         conf['server']['host'] = 'localhost'
@@ -174,6 +206,8 @@ class Config():
         conf['browser']['cache_prefix'] = 'webscrapbook.'
         conf['browser']['cache_expire'] = '259200'
         conf['browser']['use_jar'] = 'false'
+        conf['browser']['use_server'] = 'false'
+        conf['browser']['server_timeout'] = '600'
         conf['book ""'] = {}
         conf['book ""']['name'] = 'scrapbook'
         conf['book ""']['top_dir'] = ''
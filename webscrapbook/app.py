@@ -12,17 +12,26 @@ import time
 import hashlib
 import json
 import functools
-from urllib.parse import urlsplit, urlunsplit, urljoin, quote, unquote, parse_qs
+import zlib
+from urllib.parse import urlsplit, urlunsplit, urljoin, quote, unquote, parse_qs, urlencode
 from pathlib import Path
 from zlib import adler32
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections.abc import Iterator
 
 # dependency
 from flask import Flask
 from flask import request, Response, redirect, abort, render_template, send_from_directory, send_file, jsonify
+from flask import stream_with_context
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.http import is_resource_modified
+from werkzeug.http import is_resource_modified, quote_etag
 from werkzeug.http import http_date
 from werkzeug.http import parse_options_header, dump_options_header
+from werkzeug.http import parse_accept_header, unquote_etag
+from werkzeug.wsgi import wrap_file, ClosingIterator
+from werkzeug.datastructures import Headers
 import jinja2
 import commonmark
 
@@ -32,17 +41,179 @@ from . import __version__
 from . import Config
 from . import util
 
-try:
-    from time import time_ns
-except ImportError:
-    from .lib.shim.time import time_ns
-
 # see: https://url.spec.whatwg.org/#percent-encoded-bytes
 quote_path = functools.partial(quote, safe=":/[]@!$&'()*+,;=")
 quote_path.__doc__ = "Escape reserved chars for the path part of a URL."
 
 
-def make_app(root=".", config=None):
+class CompressionMiddleware():
+    """Compress responses in gzip, or brotli if installed, as the client
+    accepts.
+
+    A 200 response is compressed unless it has a Content-Encoding, is of a
+    generally compressed type like an image, or is smaller than MIN_SIZE.
+    A response without Content-Length, such as a listing or an SSE stream,
+    is flushed after every chunk, so that it's streamed as before.
+
+    The ETag of a compressed response is suffixed with the encoding. A
+    response with a strong ETag and Content-Length, which is generally a
+    static file, is compressed at a higher level and kept in an LRU cache
+    keyed by the URL and ETag, so that a repeated request doesn't cost
+    compressing again.
+    """
+    MIN_SIZE = 256
+    MAX_CACHE_ENTRY_SIZE = 1048576
+
+    def __init__(self, app, cache_size=16777216):
+        self.app = app
+        self.encodings = ['br', 'gzip'] if util.brotli is not None else ['gzip']
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_used = 0
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        encoding = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING')).best_match(self.encodings)
+
+        # also match the ETag of a compressed response with the original one
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        client_suffix = None
+        if if_none_match:
+            m = re.search(r'-(gzip|br)"', if_none_match)
+            if m:
+                client_suffix = m.group(0)[:-1]
+                environ['HTTP_IF_NONE_MATCH'] = if_none_match + ', ' + re.sub(r'-(?:gzip|br)"', '"', if_none_match)
+
+        state = {}
+
+        def _start_response(status, headers, exc_info=None):
+            headers = Headers(headers)
+            code = int(status.split(None, 1)[0])
+
+            if code == 304:
+                etag, weak = unquote_etag(headers.get('ETag'))
+                if etag and client_suffix and not re.search(r'-(?:gzip|br)$', etag):
+                    headers['ETag'] = quote_etag(etag + client_suffix, weak)
+
+            elif code == 200 and self._is_compressible(headers):
+                vary = headers.get('Vary')
+                if not vary:
+                    headers['Vary'] = 'Accept-Encoding'
+                elif 'accept-encoding' not in vary.lower():
+                    headers['Vary'] = vary + ', Accept-Encoding'
+
+                if encoding:
+                    self._prepare(environ, headers, encoding, state)
+
+            return start_response(status, headers.to_wsgi_list(), exc_info)
+
+        app_iter = self.app(environ, _start_response)
+
+        if not state or environ['REQUEST_METHOD'] == 'HEAD':
+            return app_iter
+
+        if 'body' in state:
+            body = [state['body']]
+        else:
+            body = self._compress(app_iter, encoding, state)
+
+        return ClosingIterator(body, getattr(app_iter, 'close', None))
+
+    def _is_compressible(self, headers):
+        if headers.get('Content-Encoding', 'identity') != 'identity':
+            return False
+
+        # the body is to be sent by the reverse proxy
+        if 'X-Accel-Redirect' in headers or 'X-Sendfile' in headers:
+            return False
+
+        mimetype, _ = parse_options_header(headers.get('Content-Type'))
+        if not mimetype or util.is_compressed_mimetype(mimetype):
+            return False
+
+        if 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+
+        length = headers.get('Content-Length', type=int)
+        if length is not None and length < self.MIN_SIZE:
+            return False
+
+        return True
+
+    def _prepare(self, environ, headers, encoding, state):
+        """Update headers for the compressed response and set up state.
+        """
+        length = headers.get('Content-Length', type=int)
+        etag, weak = unquote_etag(headers.get('ETag'))
+
+        state['flush'] = length is None
+        if length is not None and length <= self.MAX_CACHE_ENTRY_SIZE and etag and not weak:
+            key = (environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                    environ.get('QUERY_STRING', ''), etag, encoding)
+            with self._lock:
+                body = self._cache.get(key)
+                if body is not None:
+                    self._cache.move_to_end(key)
+                    state['body'] = body
+            state['key'] = key
+
+        del headers['Content-Length']
+        if 'body' in state:
+            headers['Content-Length'] = len(state['body'])
+        headers['Content-Encoding'] = encoding
+        if etag:
+            headers['ETag'] = quote_etag(etag + '-' + encoding, weak)
+        # a range of the original response doesn't apply
+        del headers['Accept-Ranges']
+
+    def _compress(self, app_iter, encoding, state):
+        key = state.get('key')
+        if encoding == 'br':
+            compressor = util.brotli.Compressor(quality=9 if key else 4)
+            compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            compressor = zlib.compressobj(9 if key else 6, zlib.DEFLATED, 31)
+            compress, finish = compressor.compress, compressor.flush
+            flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+
+        chunks = [] if key else None
+        for chunk in app_iter:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('UTF-8')
+            data = compress(chunk)
+            if state['flush']:
+                data += flush()
+            if data:
+                if chunks is not None:
+                    chunks.append(data)
+                yield data
+
+        data = finish()
+        yield data
+
+        if chunks is not None:
+            chunks.append(data)
+            self._cache_put(key, b''.join(chunks))
+
+    def _cache_put(self, key, body):
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self._cache_used -= len(old)
+            self._cache[key] = body
+            self._cache_used += len(body)
+            while self._cache_used > self.cache_size:
+                _, old = self._cache.popitem(last=False)
+                self._cache_used -= len(old)
+
+
+def make_app(root=".", config=None, cache_dir=None):
+    """Create the app.
+
+    Args:
+        cache_dir: the directory for persistent caches, or None for
+            .wsb/cache under the root
+    """
     if not config:
         config = Config()
         config.load(root)
@@ -53,6 +224,7 @@ def make_app(root=".", config=None):
     if not os.path.isabs(runtime['root']):
         runtime['root'] = os.path.abspath(os.path.join(root, runtime['root']))
     runtime['name'] = config['app']['name']
+    runtime['cache'] = cache_dir or os.path.join(runtime['root'], WSB_DIR, 'cache')
 
     # add path for themes
     runtime['themes'] = [
@@ -61,6 +233,55 @@ def make_app(root=".", config=None):
         ]
     runtime['statics'] = [os.path.join(t, 'static') for t in runtime['themes']]
     runtime['templates'] = [os.path.join(t, 'templates') for t in runtime['themes']]
+    runtime['static_assets'] = util.load_static_assets(runtime['statics'])
+
+    runtime['offload'] = config['app']['offload'].lower()
+    if runtime['offload'] not in ('', 'x-accel-redirect', 'x-sendfile'):
+        raise ValueError('Unsupported offload mode: "{}"'.format(config['app']['offload']))
+    runtime['offload_prefix'] = config['app']['offload_prefix'].rstrip('/')
+    runtime['offload_zip'] = runtime['offload'] == 'x-accel-redirect' and config['app'].getboolean('offload_zip')
+
+    runtime['zip_append_mode'] = config['app'].getboolean('zip_append_mode')
+    runtime['zip_compact_ratio'] = config['app'].getfloat('zip_compact_ratio')
+    runtime['zip_compacting'] = set()
+    runtime['zip_compacting_lock'] = Lock()
+
+    # cache for resolving archive files in request paths
+    runtime['archive_paths'] = OrderedDict()
+    runtime['archive_paths_lock'] = Lock()
+    runtime['archive_paths_max'] = 4096
+
+    # cache for pages of MAFF files
+    runtime['maff_cache'] = util.MaffPagesCache(
+            os.path.join(runtime['cache'], 'maff.json')
+            if config['app'].getboolean('maff_cache_persist') else None)
+
+    # thread pool for scanning subdirectories concurrently in a recursive listing
+    runtime['listdir_workers'] = config['app'].getint('listdir_workers')
+    runtime['listdir_executor'] = (ThreadPoolExecutor(runtime['listdir_workers'])
+            if runtime['listdir_workers'] > 0 else None)
+
+    # cache for rendered markdown files
+    runtime['markdown_cache'] = util.MarkdownCache(
+            os.path.join(runtime['cache'], 'markdown')
+            if config['app'].getboolean('markdown_cache_persist') else None,
+            max_size=config['app'].getint('markdown_cache_size') * 1024 * 1024,
+            render=commonmark.commonmark)
+
+    # remove fragments of markdown files changed or removed since last run
+    if runtime['markdown_cache'].root is not None:
+        Thread(target=runtime['markdown_cache'].prune, daemon=True).start()
+
+    # cache for thumbnails of images
+    runtime['thumbnail_cache'] = util.ThumbnailCache(
+            os.path.join(runtime['cache'], 'thumbs'),
+            config['app'].getint('thumbnail_workers'),
+            max_size=config['app'].getint('thumbnail_cache_size') * 1024 * 1024,
+            expire=config['app'].getint('thumbnail_cache_expire') or None)
+
+    # remove thumbnails beyond the limits since last run
+    if runtime['thumbnail_cache'].available:
+        Thread(target=runtime['thumbnail_cache'].prune, daemon=True).start()
 
     runtime['tokens'] = os.path.join(runtime['root'], WSB_DIR, 'server', 'tokens')
     runtime['locks'] = os.path.join(runtime['root'], WSB_DIR, 'server', 'locks')
@@ -68,6 +289,10 @@ def make_app(root=".", config=None):
     # init token_handler
     token_handler = util.TokenHandler(runtime['tokens'])
 
+    # configure the process-wide ZIP cache
+    util.zip_cache.max_entries = config['app'].getint('zip_cache_entries')
+    util.zip_cache.max_size = config['app'].getint('zip_cache_size') * 1024 * 1024
+
     # main app instance
     app = Flask(__name__, root_path=runtime['root'])
 
@@ -82,6 +307,10 @@ def make_app(root=".", config=None):
     if any(v for v in xheaders.values()):
         app.wsgi_app = ProxyFix(app.wsgi_app, **xheaders)
 
+    if config['app'].getboolean('compress'):
+        app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                cache_size=config['app'].getint('compress_cache_size') * 1024 * 1024)
+
     app.jinja_loader = jinja2.FileSystemLoader(runtime['templates'])
     app.jinja_env.globals.update({
             'os': os,
@@ -94,12 +323,132 @@ def make_app(root=".", config=None):
     def static_file(filepath, root=None, mimetype=None):
         """Wrap send_file for customized behaviors.
         """
-        response = send_from_directory(root or runtime['root'], filepath, mimetype=mimetype)
+        root = root or runtime['root']
+        response = send_from_directory(root, filepath, mimetype=mimetype)
         response.headers.set('Accept-Ranges', 'bytes')
         response.headers.set('Cache-Control', 'no-cache')
+        offload_file(response, os.path.join(root, filepath))
         return response
 
 
+    def offload_file(response, file, offset=None, length=None):
+        """Have the reverse proxy send a file under the root, if configured.
+
+        The body of a 200 or 206 response is replaced with an X-Accel-Redirect
+        or X-Sendfile header, while the other headers are kept. A range
+        request is then handled by the proxy.
+
+        Args:
+            offset, length: the part of the file to send, which is passed to
+                the internal location of X-Accel-Redirect as query parameters
+
+        Returns:
+            True if offloaded
+        """
+        mode = runtime['offload']
+        if not mode or response.status_code not in (200, 206):
+            return False
+
+        # an archive file is given as a real path
+        file = os.path.abspath(file)
+        subpath = None
+        for root in (runtime['root'], os.path.realpath(runtime['root'])):
+            try:
+                subpath = os.path.relpath(file, root)
+            except ValueError:
+                # on a different drive
+                continue
+            if subpath == os.pardir or subpath.startswith(os.pardir + os.sep):
+                subpath = None
+                continue
+            break
+        if subpath is None:
+            return False
+
+        if mode == 'x-accel-redirect':
+            header = 'X-Accel-Redirect'
+            value = runtime['offload_prefix'] + '/' + quote_path(subpath.replace(os.sep, '/'))
+            if offset is not None:
+                value += '?' + urlencode({'offset': offset, 'length': length})
+        else:
+            if offset is not None:
+                return False
+            header = 'X-Sendfile'
+            value = file
+            try:
+                value.encode('latin-1')
+            except UnicodeEncodeError:
+                return False
+
+        response.close()
+        response.response = []
+        response.status_code = 200
+        del response.headers['Content-Length']
+        del response.headers['Content-Range']
+        response.headers[header] = value
+        return True
+
+
+    def static_url(filename):
+        """Get the URL of a theme static file, fingerprinted if it's loaded
+        in memory.
+        """
+        url = quote_path(request.script_root) + '/' + quote_path(filename) + '?a=static'
+        asset = runtime['static_assets'].get(filename)
+        if asset is not None:
+            url += '&v=' + asset.etag
+        return url
+
+    app.jinja_env.globals['static_url'] = static_url
+
+
+    def static_asset(asset):
+        """Serve a theme static file loaded in memory.
+
+        A fingerprinted URL is cached immutably, as a file of another version
+        gets another URL.
+        """
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Last-Modified': http_date(asset.last_modified),
+            }
+
+        if request.values.get('v') == asset.etag:
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+
+        body = asset.data
+        etag = asset.etag
+        if asset.encodings:
+            headers['Vary'] = 'Accept-Encoding'
+
+            # range requests are served with the identity encoding
+            if 'Range' not in request.headers:
+                for encoding, data in asset.encodings:
+                    if request.accept_encodings[encoding]:
+                        headers['Content-Encoding'] = encoding
+                        body = data
+                        etag = asset.etag + '-' + encoding
+                        break
+
+        response = Response(body, headers=headers, mimetype=asset.mimetype)
+        response.set_etag(etag)
+        response.make_conditional(request.environ, accept_ranges=True, complete_length=len(body))
+        return response
+
+
+    def stream_template(template_name, **context):
+        """Render a template as a generator of chunks.
+
+        Chunks are sent as the template is rendered, so that the page head
+        reaches the client before a long loop is done.
+        """
+        app.update_template_context(context)
+        template = app.jinja_env.get_template(template_name)
+        return stream_with_context(util.iter_chunks(template.generate(context), 8192))
+
+
     def http_response(body='', status=None, headers=None, format=None):
         """Handle formatted response.
 
@@ -108,16 +457,38 @@ def make_app(root=".", config=None):
         if not format:
             mimetype = None
 
-        # expect body to be a JSON-serializable object
+        # expect body to be a JSON-serializable object, or an iterator of
+        # JSON-serializable objects to be streamed as an array
         elif format == 'json':
             mimetype = 'application/json'
 
-            body = {
-                'success': True,
-                'data': body,
-                }
+            if isinstance(body, Iterator):
+                def wrapper(gen):
+                    yield '{"success": true, "data": ['
+                    sep = ''
+                    for data in gen:
+                        yield sep + json.dumps(data, ensure_ascii=False)
+                        sep = ', '
+                    yield ']}'
 
-            body = json.dumps(body, ensure_ascii=False)
+                body = util.iter_chunks(wrapper(body))
+            else:
+                body = {
+                    'success': True,
+                    'data': body,
+                    }
+
+                body = json.dumps(body, ensure_ascii=False)
+
+        # expect body to be an iterator of JSON-serializable objects
+        elif format == 'ndjson':
+            mimetype = 'application/x-ndjson'
+
+            def wrapper(gen):
+                for data in gen:
+                    yield json.dumps(data, ensure_ascii=False) + "\n"
+
+            body = util.iter_chunks(wrapper(body))
 
         # expect body to be a generator of text (mostly JSON) data
         elif format == 'sse':
@@ -174,19 +545,91 @@ def make_app(root=".", config=None):
           ...
 
         Returns:
-            a tuple (archivefile, subarchivepath).
+            a tuple (archivefile, subarchivepath, realpath), where realpath
+            is the real path of archivefile resolved along with it.
         """
         if not os.path.lexists(localpath):
             for m in re.finditer(r'![/\\]', filepath, flags=re.I):
                 archivefile = os.path.join(runtime['root'], filepath[:m.start(0)].strip('/\\'))
-                if os.path.isdir(archivefile + '!'):
-                    return (None, None)
+                is_dir, is_zip, realpath = resolve_archive_file(archivefile)
+                if is_dir:
+                    return (None, None, None)
 
-                if zipfile.is_zipfile(archivefile):
+                if is_zip:
                     subarchivepath = filepath[m.end(0):].rstrip('/')
-                    return (archivefile, subarchivepath)
+                    return (archivefile, subarchivepath, realpath)
+
+        return (None, None, None)
+
+
+    def resolve_archive_file(archivefile):
+        """Check a possible archive file, with the result cached.
+
+        A cached result is validated by the last modified time of the parent
+        directory, which changes when the archive file or the
+        "<archivefile>!" directory is created, removed or replaced.
+
+        Returns:
+            a tuple (is_dir, is_zip, realpath), where is_dir means a
+            "<archivefile>!" directory exists, and realpath is the real path
+            of the archive file if is_zip.
+        """
+        cache = runtime['archive_paths']
+
+        try:
+            mtime = os.stat(os.path.dirname(archivefile)).st_mtime_ns
+        except OSError:
+            mtime = None
+        else:
+            with runtime['archive_paths_lock']:
+                entry = cache.get(archivefile)
+                if entry is not None and entry[0] == mtime:
+                    cache.move_to_end(archivefile)
+                    return entry[1]
+
+        if os.path.isdir(archivefile + '!'):
+            result = (True, False, None)
+        elif zipfile.is_zipfile(archivefile):
+            result = (False, True, os.path.realpath(archivefile))
+        else:
+            result = (False, False, None)
 
-        return (None, None)
+        if mtime is not None:
+            with runtime['archive_paths_lock']:
+                cache[archivefile] = (mtime, result)
+                cache.move_to_end(archivefile)
+                while len(cache) > runtime['archive_paths_max']:
+                    cache.popitem(last=False)
+
+        return result
+
+
+    def check_zip_compaction(archivefile, zip):
+        """Compact a ZIP file in the background if it has too much dead space.
+
+        Args:
+            zip: the ZipFile that has just been written to archivefile
+        """
+        size = os.stat(archivefile).st_size
+        if not size or util.zip_dead_space(zip) / size < runtime['zip_compact_ratio']:
+            return
+
+        realpath = os.path.realpath(archivefile)
+        with runtime['zip_compacting_lock']:
+            if realpath in runtime['zip_compacting']:
+                return
+            runtime['zip_compacting'].add(realpath)
+
+        def compact():
+            try:
+                util.zip_compact(realpath)
+            except:
+                traceback.print_exc()
+            finally:
+                with runtime['zip_compacting_lock']:
+                    runtime['zip_compacting'].discard(realpath)
+
+        Thread(target=compact, daemon=True).start()
 
 
     def is_local_access():
@@ -234,7 +677,7 @@ def make_app(root=".", config=None):
                     return True
 
             elif permission == 'view':
-                if action in ('view', 'source', 'static'):
+                if action in ('view', 'source', 'static', 'thumbnail'):
                     return True
                 else:
                     return False
@@ -250,6 +693,69 @@ def make_app(root=".", config=None):
             return response
 
 
+    def get_entry_meta(info, base=None):
+        """Get the mimetype and media class of a listed entry.
+
+        For a .htm file with a meta refresh under base, they are of the
+        target, which its URL is redirected to, and the target URL
+        (relative to the file) is also provided.
+
+        Returns:
+            a dict with 'mime', 'media', and optionally 'target'
+        """
+        mime, _ = mimetypes.guess_type(info.name)
+        meta = {'mime': mime}
+
+        if (base is not None and info.type in ('file', 'link') and
+                info.name.lower().endswith('.htm')):
+            target = util.parse_meta_refresh(os.path.join(base, info.name)).target
+            if target is not None:
+                meta['target'] = target
+                mime, _ = mimetypes.guess_type(unquote(urlsplit(target).path))
+                meta['mime'] = mime
+
+        meta['media'] = util.media_class(meta['mime'])
+        return meta
+
+
+    def get_listing_page(subentries):
+        """Filter, sort, and paginate listed entries according to the query.
+
+        Returns:
+            a tuple (subentries, next_url)
+
+        Raises:
+            ValueError: if the query is invalid
+        """
+        query = request.values
+
+        limit = query.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise ValueError('Limit must be a positive integer.') from None
+
+        types = query.get('type')
+        types = set(types.split(',')) if types else None
+
+        subentries = util.filter_listing(subentries, name=query.get('name'), types=types)
+        subentries, next_cursor = util.paginate_listing(subentries,
+                limit=limit,
+                cursor=query.get('cursor'),
+                sort=query.get('sort'),
+                order=query.get('order'),
+                )
+
+        next_url = None
+        if next_cursor:
+            args = request.args.copy()
+            args['cursor'] = next_cursor
+            next_url = '?' + urlencode(list(args.items(multi=True)))
+
+        return subentries, next_url
+
+
     def handle_directory_listing(localpath, recursive=False, format=None):
         """List contents in a directory.
         """
@@ -272,46 +778,90 @@ def make_app(root=".", config=None):
             return http_error(403, "You do not have permission to view this directory.", format=format)
 
         # headers
-        headers = {}
-        headers['Cache-Control'] = 'no-store'
-        stats = os.stat(localpath)
-        headers['Last-Modified'] = http_date(stats.st_mtime)
+        headers = {
+            'Cache-Control': 'no-cache',
+            }
+
+        # A recursive listing is not validated, since a change in a
+        # subdirectory can only be detected by walking the whole tree, which
+        # would delay the streamed response.
+        if not recursive:
+            fingerprint, last_modified = util.dir_fingerprint(localpath)
+            last_modified = http_date(last_modified)
+            etag = '{}-{}'.format(fingerprint, format or 'html')
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return http_response(status=304, headers=headers)
+
+            headers.update({
+                'Last-Modified': last_modified,
+                'ETag': quote_etag(etag),
+                })
 
         # output index
-        subentries = util.listdir(localpath, recursive)
+        subentries = util.listdir(localpath, recursive,
+                runtime['listdir_executor'], runtime['listdir_workers'])
+
+        try:
+            subentries, next_url = get_listing_page(subentries)
+        except ValueError as exc:
+            return http_error(400, str(exc), format=format)
+
+        if next_url:
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+        def gen_data():
+            for entry in subentries:
+                data = {
+                    'name': entry.name,
+                    'type': entry.type,
+                    'size': entry.size,
+                    'last_modified': entry.last_modified,
+                    }
+                if entry.type != 'dir':
+                    # don't read each .htm file for a meta refresh target,
+                    # which the client resolves on demand
+                    data.update(get_entry_meta(entry))
+                yield data
 
         if format == 'sse':
-            def gen():
-                for entry in subentries:
-                    data = {
-                        'name': entry.name,
-                        'type': entry.type,
-                        'size': entry.size,
-                        'last_modified': entry.last_modified,
-                        }
+            batch = 1
+            if 'batch' in request.values:
+                batch = request.values.get('batch', type=int)
+                if batch is None or batch <= 0:
+                    return http_error(400, "Batch must be a positive integer.", format=format)
 
+            def gen():
+                if batch == 1:
+                    for data in gen_data():
+                        yield json.dumps(data, ensure_ascii=False)
+                    return
+
+                # pack entries as an array per event
+                data = []
+                for d in gen_data():
+                    data.append(d)
+                    if len(data) >= batch:
+                        yield json.dumps(data, ensure_ascii=False)
+                        data = []
+                if data:
                     yield json.dumps(data, ensure_ascii=False)
 
             return http_response(gen(), format=format, headers=headers)
 
-        elif format == 'json':
-            data = []
-            for entry in subentries:
-                data.append({
-                        'name': entry.name,
-                        'type': entry.type,
-                        'size': entry.size,
-                        'last_modified': entry.last_modified,
-                        })
-            return http_response(data, format=format, headers=headers)
+        elif format in ('json', 'ndjson'):
+            return http_response(gen_data(), format=format, headers=headers)
 
-        body = render_template('index.html',
+        body = stream_template('index.html',
                 sitename=runtime['name'],
                 is_local=is_local_access(),
                 base=request.script_root,
                 path=request.path,
                 subarchivepath=None,
                 subentries=subentries,
+                get_meta=functools.partial(get_entry_meta, base=localpath),
+                paginated='limit' in request.values,
+                next_url=next_url,
                 )
 
         return http_response(body, format=format, headers=headers)
@@ -352,20 +902,35 @@ def make_app(root=".", config=None):
             'ETag': etag,
             })
 
-        subentries = util.zip_listdir(zip, subarchivepath)
+        # The listing is generated from the index of the ZIP file, which is
+        # held in memory after the ZIP file is released, during streaming.
+        index = util.zip_index(zip)
+        subpath = subarchivepath.rstrip('/')
+        if not index.has_dir(subpath):
+            return http_error(404, "File does not exist.")
+
+        subentries = index.listdir(subpath)
 
         try:
-            body = render_template('index.html',
-                    sitename=runtime['name'],
-                    is_local=is_local_access(),
-                    base=request.script_root,
-                    path=request.path,
-                    subarchivepath=subarchivepath,
-                    subentries=subentries,
-                    )
-            return http_response(body, headers=headers)
-        except util.ZipDirNotFoundError:
-            return http_error(404, "File does not exist.")
+            subentries, next_url = get_listing_page(subentries)
+        except ValueError as exc:
+            return http_error(400, str(exc))
+
+        if next_url:
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+        body = stream_template('index.html',
+                sitename=runtime['name'],
+                is_local=is_local_access(),
+                base=request.script_root,
+                path=request.path,
+                subarchivepath=subarchivepath,
+                subentries=subentries,
+                get_meta=get_entry_meta,
+                paginated='limit' in request.values,
+                next_url=next_url,
+                )
+        return http_response(body, headers=headers)
 
 
     def handle_subarchive_path(archivefile, subarchivepath, mimetype=None, list_directory=True):
@@ -375,10 +940,11 @@ def make_app(root=".", config=None):
             return http_error(403, "You do not have permission to access this file.")
 
         try:
-            zip = zipfile.ZipFile(archivefile)
+            zh = util.zip_cache.acquire(archivefile)
         except:
             return http_error(500, "Unable to open the ZIP file.")
 
+        zip = zh.zip
         try:
             # KeyError is raised if subarchivepath does not exist
             info = zip.getinfo(subarchivepath)
@@ -390,8 +956,6 @@ def make_app(root=".", config=None):
 
             return handle_zip_directory_listing(zip, archivefile, subarchivepath)
         else:
-            fh = zip.open(info, 'r')
-
             lm = info.date_time
             lm = int(time.mktime((lm[0], lm[1], lm[2], lm[3], lm[4], lm[5], 0, 0, -1)))
             last_modified = http_date(lm)
@@ -409,11 +973,178 @@ def make_app(root=".", config=None):
                 'ETag': etag,
                 }
 
-            response = Response(fh, headers=headers, mimetype=mimetype)
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                headers['Vary'] = 'Accept-Encoding'
+
+                # Send the deflated data as-is in gzip encoding if acceptable.
+                # Range requests are served with the identity encoding.
+                if (not info.flag_bits & 0x01 and
+                        'Range' not in request.headers and
+                        request.accept_encodings['gzip']):
+                    fh = util.zip_open_data(zip, info)
+                    headers.update({
+                        'Content-Encoding': 'gzip',
+                        'Content-Length': util.zip_gzip_size(info),
+                        'ETag': etag + '-gzip',
+                        })
+                    response = Response(util.zip_gzip_stream(fh, info), headers=headers, mimetype=mimetype)
+                    response.call_on_close(fh.close)
+                    response.make_conditional(request.environ)
+                    return response
+
+            # Open a seekable reader so that a range request doesn't need to
+            # decompress from the start of the member.
+            if info.flag_bits & 0x01:
+                fh = zip.open(info, 'r')
+            elif info.compress_type == zipfile.ZIP_STORED:
+                fh = util.zip_open_data(zip, info)
+                fh = util.FileSlice(fh, fh.tell(), info.file_size)
+            elif info.compress_type == zipfile.ZIP_DEFLATED and 'Range' in request.headers:
+                fh = util.zip_open_data(zip, info)
+                fh = util.ZipDeflatedReader(fh, info, util.zip_checkpoints(zip, info))
+            else:
+                fh = zip.open(info, 'r')
+
+            headers['Content-Length'] = info.file_size
+            response = Response(wrap_file(request.environ, fh), headers=headers, mimetype=mimetype,
+                    direct_passthrough=True)
             response.make_conditional(request.environ, accept_ranges=True, complete_length=info.file_size)
+
+            # A range of the member can't be mapped to a range of the
+            # archive file for the proxy, and is served as above.
+            if (runtime['offload_zip'] and isinstance(fh, util.FileSlice) and
+                    'Range' not in request.headers):
+                offload_file(response, archivefile, fh.offset, info.file_size)
+
             return response
         finally:
-            zip.close()
+            util.zip_cache.release(zh)
+
+
+    def handle_download(localpath, archivefile=None, subarchivepath=None):
+        """Stream a directory, or a directory in a ZIP file, as a ZIP file.
+
+        The ZIP file is generated on the fly with data descriptors, so that
+        no temporary file is needed no matter how large the directory is.
+        """
+        type = request.values.get('type', 'zip')
+        if type not in ('zip', 'htz'):
+            return http_error(400, 'Download type "{}" is not supported.'.format(type))
+
+        level = request.values.get('level', 6, type=int)
+        if level is None or not 0 <= level <= 9:
+            return http_error(400, "Compression level must be an integer between 0 and 9.")
+
+        if archivefile:
+            if not os.access(archivefile, os.R_OK):
+                return http_error(403, "You do not have permission to access this file.")
+
+            try:
+                zh = util.zip_cache.acquire(archivefile)
+            except:
+                return http_error(500, "Unable to open the ZIP file.")
+
+            base = subarchivepath.strip('/')
+            if not util.zip_index(zh.zip).has_dir(base):
+                util.zip_cache.release(zh)
+                return http_error(400, "This is not a directory.")
+
+            name = os.path.basename(base) or os.path.splitext(os.path.basename(archivefile))[0]
+        else:
+            if not os.path.isdir(localpath):
+                return http_error(400, "This is not a directory.")
+
+            zh = None
+            name = os.path.basename(localpath) or 'download'
+            is_root = os.path.normcase(localpath) == os.path.normcase(os.path.realpath(runtime['root']))
+
+        # HTZ requires index.html at the root, while a ZIP wraps the files in
+        # a folder like most archivers do.
+        prefix = '' if type == 'htz' else name + '/'
+
+        def gen_dir():
+            stream = util.ZipStream(compresslevel=level)
+            if prefix:
+                yield from stream.add_dir(prefix)
+            for info in util.listdir(localpath, recursive=True,
+                    executor=runtime['listdir_executor'], workers=runtime['listdir_workers']):
+                # never expose the configs and tokens of the book
+                if is_root and (info.name == WSB_DIR or info.name.startswith(WSB_DIR + '/')):
+                    continue
+                file = os.path.join(localpath, info.name)
+                if info.type == 'dir':
+                    yield from stream.add_dir(prefix + info.name)
+                elif info.type == 'file' or (info.type == 'link' and os.path.isfile(file)):
+                    # skip a file removed or unreadable during the walk,
+                    # since the response can no longer turn into an error
+                    try:
+                        chunks = stream.add_file(file, prefix + info.name)
+                    except OSError:
+                        continue
+                    yield from chunks
+            yield from stream.close()
+
+        def gen_zip():
+            zip = zh.zip
+            stream = util.ZipStream(compresslevel=level)
+            if prefix:
+                yield from stream.add_dir(prefix)
+            base_prefix = base + '/' if base else ''
+            with open(zip.filename, 'rb') as fh:
+                for info in zip.infolist():
+                    if not info.filename.startswith(base_prefix) or info.filename == base_prefix:
+                        continue
+                    arcname = prefix + info.filename[len(base_prefix):]
+                    yield from stream.add_zip_member(zip, info, arcname, fh)
+            yield from stream.close()
+
+        headers = {
+            'Cache-Control': 'no-store',
+            'Content-Disposition': "attachment; filename*=UTF-8''" + quote(name + '.' + type),
+            }
+        mimetype = 'application/html+zip' if type == 'htz' else 'application/zip'
+
+        response = Response(gen_zip() if zh else gen_dir(), headers=headers, mimetype=mimetype)
+        if zh:
+            response.call_on_close(lambda: util.zip_cache.release(zh))
+        return response
+
+
+    def handle_thumbnail(filepath, localpath, mimetype, archivefile=None, subarchivepath=None):
+        """Show a thumbnail of an image file or an image in a zip file.
+
+        The image itself is shown if a thumbnail cannot be generated, e.g.
+        for an SVG image or if Pillow is not installed.
+        """
+        size = request.values.get('size', 256, type=int)
+        if size is None or not 16 <= size <= 1024:
+            return http_error(400, "Thumbnail size must be an integer between 16 and 1024.")
+
+        cache = runtime['thumbnail_cache']
+        thumbnail = None
+        if cache.available and mimetype in util.THUMBNAIL_MIMETYPES:
+            try:
+                if archivefile:
+                    with util.zip_cache.open(archivefile) as zip:
+                        info = zip.getinfo(subarchivepath)
+                    if not info.flag_bits & 0x01:
+                        thumbnail = cache.get(archivefile, size, info)
+                else:
+                    thumbnail = cache.get(localpath, size)
+            except KeyError:
+                return http_error(404)
+            except Exception as exc:
+                # e.g. a corrupted or unsupported image
+                print('Warning: Unable to generate a thumbnail of "{}": {}'.format(
+                        filepath, exc or type(exc).__name__), file=sys.stderr)
+
+        if thumbnail is None:
+            if archivefile:
+                return handle_subarchive_path(archivefile, subarchivepath, mimetype, list_directory=False)
+            return static_file(filepath, root=runtime['root'], mimetype=mimetype)
+
+        thumbmime = 'image/png' if thumbnail.endswith('.png') else 'image/jpeg'
+        return static_file(os.path.basename(thumbnail), root=os.path.dirname(thumbnail), mimetype=thumbmime)
 
 
     def handle_archive_viewing(localpath, mimetype):
@@ -422,13 +1153,13 @@ def make_app(root=".", config=None):
         def list_maff_pages(pages):
             """List available web pages in a MAFF file.
             """
-            return render_template('maff_index.html',
+            return http_response(stream_template('maff_index.html',
                     sitename=runtime['name'],
                     is_local=is_local_access(),
                     base=request.script_root,
                     path=request.path,
                     pages=pages,
-                    )
+                    ))
 
         if not os.access(localpath, os.R_OK):
             return http_error(403, "You do not have permission to access this file.")
@@ -436,7 +1167,7 @@ def make_app(root=".", config=None):
         if mimetype == "application/html+zip":
             subpath = "index.html"
         else:
-            pages = util.get_maff_pages(localpath)
+            pages = runtime['maff_cache'].get(localpath)
 
             if len(pages) > 1:
                 # multiple index files
@@ -482,16 +1213,12 @@ def make_app(root=".", config=None):
             })
 
         # output processed content
-        with open(filename, 'r', encoding='UTF-8') as f:
-            body = f.read()
-            f.close()
-        
         body = render_template('markdown.html',
                 sitename=runtime['name'],
                 is_local=is_local_access(),
                 base=request.script_root,
                 path=request.path,
-                content=commonmark.commonmark(body),
+                content=runtime['markdown_cache'].get(filename, stats),
                 )
 
         return http_response(body, headers=headers)
@@ -523,13 +1250,16 @@ def make_app(root=".", config=None):
         #
         # filepath: the URL path below app base (not percent encoded)
         # localpath: the file system path corresponding to filepath
-        # localtargetpath: localpath with symbolic link resolved
-        # mimetype: the mimetype from localtargetpath
         # archivefile: the file system path of the ZIP archive file, or None
         # subarchivepath: the URL path below archivefile (not percent encoded)
+        # archiverealpath: the real path of archivefile, or None
+        # localtargetpath: localpath with symbolic link resolved (localpath
+        #     if archivefile, as it doesn't exist and only the extension
+        #     matters)
+        # mimetype: the mimetype from localtargetpath
         localpath = os.path.abspath(os.path.join(runtime['root'], filepath.strip('/\\')))
-        localtargetpath = os.path.realpath(localpath)
-        archivefile, subarchivepath = get_archive_path(filepath, localpath)
+        archivefile, subarchivepath, archiverealpath = get_archive_path(filepath, localpath)
+        localtargetpath = localpath if archivefile else os.path.realpath(localpath)
         mimetype, _ = mimetypes.guess_type(localtargetpath)
 
         # handle action
@@ -537,6 +1267,11 @@ def make_app(root=".", config=None):
             if format:
                 return http_error(400, "Action not supported.", format=format)
 
+            asset = runtime['static_assets'].get(filepath)
+            if asset is not None:
+                return static_asset(asset)
+
+            # a file not loaded, e.g. a large file
             for i in runtime['statics']:
                 f = os.path.join(i, filepath)
                 if os.path.lexists(f):
@@ -549,7 +1284,7 @@ def make_app(root=".", config=None):
                 return http_error(400, "Action not supported.", format=format)
 
             if archivefile:
-                response = handle_subarchive_path(os.path.realpath(archivefile), subarchivepath, mimetype, list_directory=False)
+                response = handle_subarchive_path(archiverealpath, subarchivepath, mimetype, list_directory=False)
             else:
                 response = static_file(filepath, root=runtime['root'], mimetype=mimetype)
 
@@ -594,6 +1329,27 @@ def make_app(root=".", config=None):
 
             return http_error(400, "This is not a directory.", format=format)
 
+        elif action == 'download':
+            if format:
+                return http_error(400, "Action not supported.", format=format)
+
+            if archivefile:
+                return handle_download(localpath, archiverealpath, subarchivepath)
+
+            return handle_download(localtargetpath)
+
+        elif action == 'thumbnail':
+            if format:
+                return http_error(400, "Action not supported.", format=format)
+
+            if archivefile:
+                return handle_thumbnail(filepath, localpath, mimetype, archiverealpath, subarchivepath)
+
+            if os.path.isfile(localpath):
+                return handle_thumbnail(filepath, localtargetpath, mimetype)
+
+            return http_error(404)
+
         elif action == 'config':
             if not format:
                 return http_error(400, "Action not supported.", format=format)
@@ -621,7 +1377,7 @@ def make_app(root=".", config=None):
                 return http_error(400, "Found a non-file here.", format=format)
 
             if archivefile:
-                with zipfile.ZipFile(archivefile, 'r') as zip:
+                with util.zip_cache.open(archivefile) as zip:
                     try:
                         info = zip.getinfo(subarchivepath)
                     except:
@@ -667,7 +1423,7 @@ def make_app(root=".", config=None):
                 return http_error(400, "This is not an HTML file.", format=format)
 
             if archivefile:
-                with zipfile.ZipFile(archivefile, 'r') as zip:
+                with util.zip_cache.open(archivefile) as zip:
                     try:
                         info = zip.getinfo(subarchivepath)
                     except:
@@ -775,15 +1531,16 @@ def make_app(root=".", config=None):
 
                 if archivefile:
                     try:
-                        zip = zipfile.ZipFile(archivefile, 'a')
-                        subarchivepath = subarchivepath + '/'
+                        with util.zip_write_lock(archivefile), util.zip_append(archivefile) as zip:
+                            subarchivepath = subarchivepath + '/'
 
-                        try:
-                            info = zip.getinfo(subarchivepath)
-                        except KeyError:
-                            # subarchivepath does not exist
-                            info = zipfile.ZipInfo(subarchivepath, time.localtime())
-                            zip.writestr(info, b'', compress_type=zipfile.ZIP_STORED)
+                            try:
+                                info = zip.getinfo(subarchivepath)
+                            except KeyError:
+                                # subarchivepath does not exist
+                                info = zipfile.ZipInfo(subarchivepath, time.localtime())
+                                with util.ZipPacker(zip) as packer:
+                                    packer.add_dir(info)
                     except:
                         traceback.print_exc()
                         return http_error(500, "Unable to write to this ZIP file.", format=format)
@@ -800,62 +1557,47 @@ def make_app(root=".", config=None):
                     return http_error(400, "Found a non-file here.", format=format)
 
                 if archivefile:
-                    try:
-                        zip0 = zip = zipfile.ZipFile(archivefile, 'a')
-
-                        try:
-                            # if subarchivepath exists, open a new zip file for writing.
-                            try:
-                                info = zip.getinfo(subarchivepath)
-                            except KeyError:
-                                info = zipfile.ZipInfo(subarchivepath, time.localtime())
+                    def write_member(zip, info, compress_type=None):
+                        # compress in the shared thread pool, and store
+                        # already compressed types unless replacing a member
+                        with util.ZipPacker(zip) as packer:
+                            file = request.files.get('upload')
+                            if file is not None:
+                                packer.add_stream(info, file.stream, compress_type, force_zip64=True)
                             else:
-                                info.date_time = time.localtime()
-                                temp_path = archivefile + '.' + str(time_ns())
-                                zip = zipfile.ZipFile(temp_path, 'w')
+                                bytes = query.get('text', '').encode('ISO-8859-1')
+                                packer.add_data(info, bytes, zipfile.ZIP_DEFLATED, compresslevel=9)
 
-                            try:
-                                # write to the zip file
-                                file = request.files.get('upload')
-                                if file is not None:
-                                    with zip.open(info, 'w', force_zip64=True) as fp:
-                                        stream = file.stream
-                                        while True:
-                                            s = stream.read(8192)
-                                            if not s: break
-                                            fp.write(s)
-                                        fp.close()
-                                else:
-                                    bytes = query.get('text', '').encode('ISO-8859-1')
-                                    zip.writestr(info, bytes, compress_type=zipfile.ZIP_DEFLATED, compresslevel=9)
-
-                                # copy zip0 content to zip
-                                if zip is not zip0:
-                                    for info in zip0.infolist():
-                                        if info.filename == subarchivepath:
-                                            continue
-                                        zip.writestr(info, zip0.read(info),
-                                                compress_type=info.compress_type,
-                                                compresslevel=None if info.compress_type == zipfile.ZIP_STORED else 9)
-                            except:
-                                # remove the generated zip file if writing fails
-                                if zip is not zip0:
-                                    zip.close()
-                                    os.remove(zip.filename)
+                    try:
+                        with util.zip_write_lock(archivefile):
+                            with util.zip_cache.open(archivefile) as zip:
+                                try:
+                                    info0 = zip.getinfo(subarchivepath)
+                                except KeyError:
+                                    info0 = None
+
+                            info = zipfile.ZipInfo(subarchivepath, time.localtime())
 
-                                raise
+                            if info0 is None:
+                                with util.zip_append(archivefile) as zip:
+                                    write_member(zip, info)
                             else:
-                                # replace zip0 with the generated zip file
-                                if zip is not zip0:
-                                    zip0.close()
-                                    zip.close()
-
-                                    temp_path = archivefile + '.' + str(time_ns() + 1)
-                                    os.rename(archivefile, temp_path)
-                                    os.rename(zip.filename, archivefile)
-                                    os.remove(temp_path)
-                        finally:
-                            zip0.close()
+                                compress_type = info0.compress_type
+                                info.external_attr = info0.external_attr
+
+                                if runtime['zip_append_mode']:
+                                    # append the new member and leave the
+                                    # replaced one as dead space
+                                    with util.zip_append(archivefile,
+                                            exclude=lambda i: i.filename == subarchivepath) as zip:
+                                        write_member(zip, info, compress_type)
+                                    check_zip_compaction(archivefile, zip)
+                                else:
+                                    # rewrite the zip file with other members
+                                    # copied as-is
+                                    with util.zip_rewrite(archivefile,
+                                            exclude=lambda i: i.filename == subarchivepath) as zip:
+                                        write_member(zip, info, compress_type)
                     except:
                         traceback.print_exc()
                         return http_error(500, "Unable to write to this ZIP file.", format=format)
@@ -882,45 +1624,32 @@ def make_app(root=".", config=None):
 
             elif action == 'delete':
                 if archivefile:
-                    try:
-                        zip0 = zipfile.ZipFile(archivefile, 'r')
-                        temp_path = archivefile + '.' + str(time_ns())
-                        zip = zipfile.ZipFile(temp_path, 'w')
+                    def is_deleted(info):
+                        return (info.filename == subarchivepath or
+                                info.filename.startswith(subarchivepath + '/'))
 
-                        try:
-                            deleted = False
-                            for info in zip0.infolist():
-                                if (info.filename == subarchivepath or
-                                        info.filename.startswith(subarchivepath + '/')):
-                                    deleted = True
-                                    continue
-
-                                zip.writestr(info, zip0.read(info),
-                                        compress_type=info.compress_type,
-                                        compresslevel=None if info.compress_type == zipfile.ZIP_STORED else 9)
-                        except:
-                            # remove the generated zip file if writing fails
-                            zip.close()
-                            os.remove(zip.filename)
-
-                            raise
-                        else:
-                            zip0.close()
-                            zip.close()
-
-                            if not deleted:
-                                os.remove(zip.filename)
-                                return http_error(404, "Entry does not exist in this ZIP file.", format=format)
-
-                            # replace zip0 with the generated zip file
-                            temp_path = archivefile + '.' + str(time_ns() + 1)
-                            os.rename(archivefile, temp_path)
-                            os.rename(zip.filename, archivefile)
-                            os.remove(temp_path)
+                    try:
+                        with util.zip_write_lock(archivefile):
+                            with util.zip_cache.open(archivefile) as zip:
+                                deleted = any(is_deleted(info) for info in zip.infolist())
+
+                            if deleted:
+                                if runtime['zip_append_mode']:
+                                    # drop the members from the central
+                                    # directory and leave them as dead space
+                                    with util.zip_append(archivefile, exclude=is_deleted) as zip:
+                                        pass
+                                    check_zip_compaction(archivefile, zip)
+                                else:
+                                    with util.zip_rewrite(archivefile, exclude=is_deleted):
+                                        pass
                     except:
                         traceback.print_exc()
                         return http_error(500, "Unable to write to this ZIP file.", format=format)
 
+                    if not deleted:
+                        return http_error(404, "Entry does not exist in this ZIP file.", format=format)
+
                 else:
                     if not os.path.lexists(localpath):
                         return http_error(404, "File does not exist.", format=format)
@@ -970,7 +1699,7 @@ def make_app(root=".", config=None):
                 if os.path.lexists(targetpath):
                     return http_error(400, 'Found something at target "{}".'.format(target), format=format)
 
-                ta, tsa = get_archive_path(target, targetpath)
+                ta, tsa, _ = get_archive_path(target, targetpath)
                 if ta:
                     return http_error(400, "Move target is inside an archive file.", format=format)
 
@@ -1002,7 +1731,7 @@ def make_app(root=".", config=None):
                 if os.path.lexists(targetpath):
                     return http_error(400, 'Found something at target "{}".'.format(target), format=format)
 
-                ta, tsa = get_archive_path(target, targetpath)
+                ta, tsa, _ = get_archive_path(target, targetpath)
                 if ta:
                     return http_error(400, "Copy target is inside an archive file.", format=format)
 
@@ -1065,7 +1794,7 @@ def make_app(root=".", config=None):
 
             # handle sub-archive path
             elif archivefile:
-                response = handle_subarchive_path(os.path.realpath(archivefile), subarchivepath, mimetype)
+                response = handle_subarchive_path(archiverealpath, subarchivepath, mimetype)
 
             else:
                 return http_error(404)
@@ -8,6 +8,7 @@ import json
 from getpass import getpass
 import time
 import traceback
+import zipfile
 
 # this package
 from . import __package_name__, __version__
@@ -161,6 +162,104 @@ def cmd_help(args):
         print(text)
 
 
+def cmd_cache(args):
+    """Generate cache for the served directory."""
+    config.load(args['root'])
+    root = config['app']['root']
+    if not os.path.isabs(root):
+        root = os.path.join(args['root'], root)
+    root = os.path.abspath(root)
+
+    if args['maff']:
+        cache = util.MaffPagesCache(os.path.join(root, WSB_DIR, 'cache', 'maff.json'))
+        print('Caching pages of MAFF files under "{}"...'.format(root))
+        count = cache.prewarm(root)
+        print('Cached {} MAFF file(s).'.format(count))
+        if not config['app'].getboolean('maff_cache_persist'):
+            print('Warning: The cache is not used unless maff_cache_persist is set true.', file=sys.stderr)
+
+
+def cmd_compact(args):
+    """Reclaim dead space of archive file(s) saved under zip_append_mode."""
+    for file in args['files']:
+        try:
+            with zipfile.ZipFile(file) as zip:
+                size = os.stat(file).st_size
+                dead = util.zip_dead_space(zip)
+        except (OSError, zipfile.BadZipFile) as exc:
+            print('Error: Unable to read "{}": {}'.format(file, exc), file=sys.stderr)
+            continue
+
+        if not dead or dead / size < args['ratio']:
+            print('Skipped "{}": {} of dead space.'.format(file, util.format_filesize(dead)))
+            continue
+
+        try:
+            reclaimed = util.zip_compact(file)
+        except:
+            traceback.print_exc()
+            print('Error: Unable to compact "{}".'.format(file), file=sys.stderr)
+            continue
+
+        print('Compacted "{}": {} reclaimed.'.format(file, util.format_filesize(reclaimed)))
+
+
+def cmd_pack(args):
+    """Pack a directory into an archive file (HTZ, MAFF, or ZIP)."""
+    src = os.path.abspath(args['dir'])
+    if not os.path.isdir(src):
+        print('Error: "{}" is not a directory.'.format(args['dir']), file=sys.stderr)
+        sys.exit(1)
+
+    output = args['output'] or src + '.htz'
+    if os.path.lexists(output) and not args['force']:
+        print('Error: "{}" already exists.'.format(output), file=sys.stderr)
+        sys.exit(1)
+
+    # a MAFF file contains each page in a top-level directory
+    prefix = os.path.basename(src) + '/' if output.lower().endswith('.maff') else ''
+
+    print('Packing "{}" into "{}"...'.format(src, output))
+    t = time.perf_counter()
+    temp_path = output + '.' + str(time_ns())
+    try:
+        with zipfile.ZipFile(temp_path, 'w') as zip, \
+                util.ZipPacker(zip, args['level'], args['jobs']) as packer:
+            if prefix:
+                packer.add_dir(prefix)
+            for info in util.listdir(src, recursive=True):
+                file = os.path.join(src, info.name)
+                if info.type == 'dir' or os.path.isfile(file):
+                    packer.add_file(file, prefix + info.name)
+        os.replace(temp_path, output)
+    except:
+        traceback.print_exc()
+        print('Error: Unable to pack "{}".'.format(src), file=sys.stderr)
+        if os.path.lexists(temp_path):
+            os.remove(temp_path)
+        sys.exit(1)
+
+    print('Packed {} in {:.3f}s.'.format(
+            util.format_filesize(os.stat(output).st_size), time.perf_counter() - t))
+
+
+def cmd_repack(args):
+    """Recompress archive file(s) in parallel, storing already compressed types."""
+    for file in args['files']:
+        t = time.perf_counter()
+        try:
+            reduced = util.zip_repack(file, args['level'], args['jobs'])
+        except:
+            traceback.print_exc()
+            print('Error: Unable to repack "{}".'.format(file), file=sys.stderr)
+            continue
+
+        print('Repacked "{}" in {:.3f}s: {} {}.'.format(
+                file, time.perf_counter() - t,
+                util.format_filesize(abs(reduced)),
+                'reduced' if reduced >= 0 else 'increased'))
+
+
 def cmd_view(args):
     """View archive file(s) in the browser."""
     config.load(args['root'])
@@ -174,78 +273,71 @@ def view_archive_files(files):
     them in the browser directly.
     """
     import tempfile
-    import zipfile
     import hashlib
-    import time
     import mimetypes
     import webbrowser
-    import shutil
-    from urllib.parse import urljoin
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import quote
     from urllib.request import pathname2url
 
     cache_prefix = config['browser']['cache_prefix']
     cache_expire = config['browser'].getint('cache_expire') * 10 ** 9
     use_jar = config['browser'].getboolean('use_jar')
+    use_server = config['browser'].getboolean('use_server')
+    server_timeout = config['browser'].getint('server_timeout')
     browser = webbrowser.get(config['browser']['command'] or None)
 
-    temp_dir = tempfile.gettempdir()
-    urls = []
-
+    entries = []
     for file in files:
         mime, _ = mimetypes.guess_type(file)
         if not mime in ("application/html+zip", "application/x-maff"):
             continue
+        entries.append((file, mime))
+
+    def get_urls(base_url, file, mime):
+        if mime == "application/html+zip":
+            return [base_url + 'index.html']
+        elif mime == "application/x-maff":
+            return [base_url + quote(f.indexfilename) for f in util.get_maff_pages(file)]
+
+    urls = []
 
-        if use_jar:
+    if use_jar:
+        for file, mime in entries:
             base_url = 'jar:file:' + pathname2url(os.path.abspath(file)) + '!/'
-            if mime == "application/html+zip":
-                urls.append(base_url + 'index.html')
-            elif mime == "application/x-maff":
-                urls.extend([base_url + f.indexfilename for f in util.get_maff_pages(file)])
-            continue
+            urls.extend(get_urls(base_url, file, mime))
+
+    elif use_server:
+        # view each archive file with a loopback server of its directory,
+        # which reads members on demand
+        for file, mime in entries:
+            file = os.path.realpath(file)
+            root = os.path.dirname(file)
+            state_file = os.path.join(tempfile.gettempdir(), '{}server.{}.json'.format(
+                    cache_prefix, hashlib.sha1(root.encode('UTF-8')).hexdigest()))
+            base_url = server.get_viewer_url(root, os.path.basename(file), state_file, server_timeout)
+            urls.extend(get_urls(base_url, file, mime))
 
-        # extract zip contents to dest_dir if not done yet
-        hash = util.checksum(file)
-        dest_prefix = cache_prefix + hash + '_'
-        for entry in os.listdir(temp_dir):
-            if entry.startswith(dest_prefix):
-                dest_dir = os.path.join(temp_dir, entry)
-
-                # update atime
-                atime = time_ns()
-                stat = os.stat(dest_dir)
-                os.utime(dest_dir, ns=(atime, stat.st_mtime_ns))
-                break
-        else:
-            dest_dir = tempfile.mkdtemp(prefix=dest_prefix)
-            with zipfile.ZipFile(file) as zip:
-                zip.extractall(dest_dir)
-                zip.close()
+    else:
+        cache = util.ZipExtractCache(tempfile.gettempdir(), cache_prefix)
+
+        # extract zip contents to cache directories if not done yet
+        with ThreadPoolExecutor(os.cpu_count() or 1) as executor:
+            dest_dirs = list(executor.map(cache.get, [file for file, _ in entries]))
 
         # get URL of every index page
-        base_url = 'file:' + pathname2url(dest_dir) + '/'
-        if mime == "application/html+zip":
-            urls.append(base_url + 'index.html')
-        elif mime == "application/x-maff":
-            urls.extend([base_url + f.indexfilename for f in util.get_maff_pages(file)])
+        for (file, mime), dest_dir in zip(entries, dest_dirs):
+            base_url = 'file:' + pathname2url(dest_dir) + '/'
+            urls.extend(get_urls(base_url, file, mime))
 
     # open pages in the browser
     for url in urls:
         browser.open(url)
 
     # remove stale caches
-    if not use_jar:
-        t = time_ns()
-        for entry in os.listdir(temp_dir):
-            if entry.startswith(cache_prefix):
-                cache_dir = os.path.join(temp_dir, entry)
-                atime = os.stat(cache_dir).st_atime_ns
-                if t > atime + cache_expire:
-                    # cache may be created by another user and undeletable
-                    try:
-                        shutil.rmtree(cache_dir)
-                    except:
-                        traceback.print_exc()
+    if not use_jar and not use_server:
+        cache.prune(cache_expire)
+        cache.save()
 
 
 def view():
@@ -307,6 +399,53 @@ sha224, sha256, sha384, sha512, sha3_224, sha3_256, sha3_384, and sha3_512.
         choices=['config'],
         help="""detailed help topic.""")
 
+    # subcommand: cache
+    parser_cache = subparsers.add_parser('cache',
+        help=cmd_cache.__doc__, description=cmd_cache.__doc__)
+    parser_cache.set_defaults(func=cmd_cache)
+    parser_cache.add_argument('--maff', default=False, action='store_true',
+        help="""cache page lists of all MAFF files.""")
+
+    # subcommand: compact
+    parser_compact = subparsers.add_parser('compact',
+        help=cmd_compact.__doc__, description=cmd_compact.__doc__)
+    parser_compact.set_defaults(func=cmd_compact)
+    parser_compact.add_argument('files', nargs='+',
+        help="""archive files to compact.""")
+    parser_compact.add_argument('-r', '--ratio', default=0.0, type=float, action='store',
+        help="""compact only if the ratio of dead space to the file size is
+at least this value. An archive file without dead space is always skipped.
+(default: %(default)s)""")
+
+    # subcommand: pack
+    parser_pack = subparsers.add_parser('pack',
+        help=cmd_pack.__doc__, description=cmd_pack.__doc__)
+    parser_pack.set_defaults(func=cmd_pack)
+    parser_pack.add_argument('dir',
+        help="""the directory to pack.""")
+    parser_pack.add_argument('-o', '--output', default=None, action='store',
+        help="""the output file, whose extension determines the format.
+(default: <dir>.htz)""")
+    parser_pack.add_argument('-f', '--force', default=False, action='store_true',
+        help="""overwrite the output file if it exists.""")
+    parser_pack.add_argument('-l', '--level', default=6, type=int, choices=range(10), metavar='LEVEL',
+        help="""compression level from 0 (store) to 9. (default: %(default)s)""")
+    parser_pack.add_argument('-j', '--jobs', default=None, type=int, action='store',
+        help="""number of compression threads, 0 to compress serially.
+(default: number of CPUs)""")
+
+    # subcommand: repack
+    parser_repack = subparsers.add_parser('repack',
+        help=cmd_repack.__doc__, description=cmd_repack.__doc__)
+    parser_repack.set_defaults(func=cmd_repack)
+    parser_repack.add_argument('files', nargs='+',
+        help="""archive files to repack.""")
+    parser_repack.add_argument('-l', '--level', default=6, type=int, choices=range(10), metavar='LEVEL',
+        help="""compression level from 0 (store) to 9. (default: %(default)s)""")
+    parser_repack.add_argument('-j', '--jobs', default=None, type=int, action='store',
+        help="""number of compression threads, 0 to compress serially.
+(default: number of CPUs)""")
+
     # subcommand: view
     parser_view = subparsers.add_parser('view',
         help=cmd_view.__doc__, description=cmd_view.__doc__)
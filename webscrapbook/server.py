@@ -1,19 +1,35 @@
 #!/usr/bin/env python3
 """Server backend of WebScrapBook toolkit.
 """
+import sys
 import os
+import io
 import time
+import json
+import tempfile
+import subprocess
+import mimetypes
 import webbrowser
-from threading import Thread
+from threading import Thread, Lock
+from urllib.parse import parse_qs, quote
+from urllib.request import urlopen, Request
 
 # dependency
 from werkzeug.serving import WSGIRequestHandler, make_server
+from werkzeug.wsgi import ClosingIterator, FileWrapper
+from werkzeug.datastructures import Headers
+
+try:
+    # private, and may be renamed or removed in a later werkzeug
+    from werkzeug.wsgi import _RangeWrapper
+except ImportError:
+    _RangeWrapper = None
 
 # this package
 from . import *
 from . import Config
 from .app import make_app
-from .util import is_nullhost
+from .util import is_nullhost, token_urlsafe, FileSlice
 
 def serve(root, **kwargs):
     config = Config()
@@ -48,9 +64,10 @@ def serve(root, **kwargs):
     srv = make_server(
         host=host,
         port=port,
-        app=make_app(root, config),
+        app=SendfileMiddleware(make_app(root, config)),
         threaded=True,
         processes=1,
+        request_handler=SendfileRequestHandler,
         ssl_context=((ssl_cert, ssl_key) if ssl_cert and ssl_key
                 else 'adhoc' if ssl_on else None),
         )
@@ -80,3 +97,324 @@ def serve(root, **kwargs):
         while True: time.sleep(100)
     except (KeyboardInterrupt, SystemExit):
         print('Keyboard interrupt received, shutting down server.')
+
+
+class SendfileWrapper(FileWrapper):
+    """The wsgi.file_wrapper of SendfileRequestHandler.
+
+    It's iterated like werkzeug's FileWrapper, unless the response is sent
+    by SendfileMiddleware.
+    """
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """A request handler that provides the socket for SendfileMiddleware.
+    """
+    def make_environ(self):
+        environ = super().make_environ()
+        environ['wsgi.file_wrapper'] = SendfileWrapper
+        environ['webscrapbook.socket'] = self.connection
+        return environ
+
+
+class SendfileMiddleware():
+    """Send a file response with os.sendfile, which copies the data from the
+    file to the socket in the kernel.
+
+    A response is sent this way if it's a SendfileWrapper of a file with a
+    file descriptor, such as a static file or a stored member of a ZIP file
+    (FileSlice), or a range of it as werkzeug wraps it with _RangeWrapper for
+    a 206 response, and has Content-Length. Other responses, such as a
+    compressed one, are passed through, and so is a range if _RangeWrapper
+    is not available in the installed werkzeug.
+
+    Must be served with SendfileRequestHandler.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        sock = environ.get('webscrapbook.socket')
+        if sock is None:
+            return self.app(environ, start_response)
+
+        headers = None
+
+        def _start_response(status, response_headers, exc_info=None):
+            nonlocal headers
+            headers = Headers(response_headers)
+            return start_response(status, response_headers, exc_info)
+
+        app_iter = self.app(environ, _start_response)
+
+        length = headers.get('Content-Length', type=int) if headers is not None else None
+        if length is None:
+            return app_iter
+
+        if isinstance(app_iter, SendfileWrapper):
+            file, start = app_iter.file, None
+        elif (_RangeWrapper is not None and isinstance(app_iter, _RangeWrapper) and
+                isinstance(getattr(app_iter, 'iterable', None), SendfileWrapper) and
+                isinstance(getattr(app_iter, 'start_byte', None), int)):
+            file, start = app_iter.iterable.file, app_iter.start_byte
+        else:
+            return app_iter
+
+        # get the real file and the offset of the data in it
+        try:
+            if start is None:
+                start = file.tell()
+            if isinstance(file, FileSlice):
+                file, start = file.fh, file.offset + start
+            if not isinstance(file, (io.BufferedReader, io.FileIO)):
+                return app_iter
+            file.fileno()
+        except (AttributeError, OSError, ValueError):
+            return app_iter
+
+        def gen():
+            # let the server send the headers before the data
+            yield b''
+            sock.sendfile(file, start, length)
+
+        return ClosingIterator(gen(), getattr(app_iter, 'close', None))
+
+
+class ViewerMiddleware():
+    """Restrict an app to read-only viewing of registered archive files.
+
+    An archive file directly under root is registered with a POST request to
+    the secret path, whose body is the file name, and the response is a
+    token of it. Only GET and HEAD requests to /<token>/<name>!/... of a
+    registered archive file, or for the static files of the theme, are passed
+    to the app, so that a script in an archived page cannot read other files
+    under root. Requests to other paths or hosts, to a directory, or with
+    actions that are not for viewing are rejected.
+    """
+    ALLOWED_ACTIONS = {'view', 'source', 'static'}
+    ARCHIVE_TYPES = {'application/html+zip', 'application/x-maff'}
+
+    def __init__(self, app, root, token):
+        self.app = app
+        self.root = root
+        self.prefix = '/' + token
+        self.hosts = set()
+        self.archives = {}
+        self.archive_tokens = {}
+        self.active = 0
+        self.last_active = time.monotonic()
+        self._lock = Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_HOST') not in self.hosts:
+            return self._respond(start_response, '404 Not Found')
+
+        path = environ.get('PATH_INFO', '')
+        if path == self.prefix:
+            with self._lock:
+                self.last_active = time.monotonic()
+            if environ['REQUEST_METHOD'] != 'POST':
+                return self._respond(start_response, '405 Method Not Allowed')
+            return self._register(environ, start_response)
+
+        token, _, rest = path.partition('/')[2].partition('/')
+        name = self.archives.get(token)
+        if name is None:
+            return self._respond(start_response, '404 Not Found')
+        rest = '/' + rest
+
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return self._respond(start_response, '405 Method Not Allowed')
+
+        query = parse_qs(environ.get('QUERY_STRING', ''))
+        actions = query.get('a', []) + query.get('action', [])
+        if any(a not in self.ALLOWED_ACTIONS for a in actions):
+            return self._respond(start_response, '403 Forbidden')
+
+        # theme static files are not under root
+        if not (actions and all(a == 'static' for a in actions)):
+            base = '/' + name + '!/'
+            if (not rest.startswith(base) or rest.endswith('/') or
+                    '..' in rest[len(base):].replace('\\', '/').split('/')):
+                return self._respond(start_response, '403 Forbidden')
+
+        with self._lock:
+            self.active += 1
+            self.last_active = time.monotonic()
+
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + token
+        environ['PATH_INFO'] = rest
+        try:
+            return ClosingIterator(self.app(environ, start_response), self._done)
+        except:
+            self._done()
+            raise
+
+    def _register(self, environ, start_response):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            name = environ['wsgi.input'].read(min(length, 4096)).decode('UTF-8')
+        except (ValueError, OSError):
+            return self._respond(start_response, '400 Bad Request')
+
+        if (not name or name in ('.', '..') or '/' in name or os.sep in name or
+                (os.altsep and os.altsep in name) or
+                mimetypes.guess_type(name)[0] not in self.ARCHIVE_TYPES or
+                not os.path.isfile(os.path.join(self.root, name))):
+            return self._respond(start_response, '400 Bad Request')
+
+        with self._lock:
+            token = self.archive_tokens.get(name)
+            if token is None:
+                token = self.archive_tokens[name] = token_urlsafe()
+                self.archives[token] = name
+
+        body = token.encode('UTF-8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+            ])
+        return [body]
+
+    def idle_time(self):
+        """Get seconds since the last request, or 0 if any is being served.
+        """
+        with self._lock:
+            if self.active:
+                return 0
+            return time.monotonic() - self.last_active
+
+    def _done(self):
+        with self._lock:
+            self.active -= 1
+            self.last_active = time.monotonic()
+
+    def _respond(self, start_response, status):
+        start_response(status, [('Content-Length', '0')])
+        return []
+
+
+def serve_viewer(root, state_file, timeout=600):
+    """Serve registered archive files under root for viewing on a loopback
+    port.
+
+    The PID, port, and secret token of the server are written to state_file,
+    and the server shuts down after being idle for timeout seconds. Caches
+    are kept in a temporary directory rather than under root. Authorization,
+    offloading, and compression settings of root are not applied.
+    """
+    config = Config()
+    config.load(root)
+    config['app']['root'] = '.'
+    config['app']['base'] = ''
+
+    # The viewer is accessed directly by the browser of the current user and
+    # is guarded by the token, rather than behind a reverse proxy like the
+    # configured app.
+    config.subsections.pop('auth', None)
+    config['app']['offload'] = ''
+    config['app']['offload_zip'] = 'false'
+    config['app']['compress'] = 'false'
+
+    cache_dir = tempfile.TemporaryDirectory(prefix='webscrapbook.viewer.')
+
+    token = token_urlsafe()
+    app = ViewerMiddleware(SendfileMiddleware(make_app(root, config, cache_dir=cache_dir.name)), root, token)
+
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    srv = make_server(host='127.0.0.1', port=0, app=app, threaded=True, processes=1,
+            request_handler=SendfileRequestHandler)
+    port = srv.server_port
+    app.hosts.update({'127.0.0.1:{}'.format(port), 'localhost:{}'.format(port)})
+
+    # write the state file atomically, readable only by the current user
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(state_file))
+    with open(fd, 'w', encoding='UTF-8') as f:
+        json.dump({'pid': os.getpid(), 'port': port, 'token': token, 'root': root}, f)
+    os.replace(temp_path, state_file)
+
+    thread = Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        while app.idle_time() < timeout:
+            time.sleep(min(timeout, 5))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+    srv.shutdown()
+    cache_dir.cleanup()
+
+    # remove the state file unless taken over by another server
+    try:
+        with open(state_file, 'r', encoding='UTF-8') as f:
+            if json.load(f)['pid'] == os.getpid():
+                os.remove(state_file)
+    except (OSError, ValueError, KeyError):
+        pass
+
+
+def get_viewer_url(root, name, state_file, timeout=600):
+    """Get the base URL for viewing the archive file name under root.
+
+    The archive file is registered to the viewer server of root, which is
+    started as a detached process if needed and reused by later calls until
+    it shuts down for being idle.
+    """
+    def read_state():
+        try:
+            stat = os.stat(state_file)
+            # the state file may be forged by another user in a shared
+            # temporary directory
+            if hasattr(os, 'getuid') and stat.st_uid != os.getuid():
+                return None
+            with open(state_file, 'r', encoding='UTF-8') as f:
+                state = json.load(f)
+            return 'http://127.0.0.1:{}'.format(state['port']), quote(state['token']), state['pid']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def register(state):
+        server_url, token, _ = state
+        try:
+            req = Request(server_url + '/' + token, data=name.encode('UTF-8'), method='POST')
+            with urlopen(req, timeout=2) as r:
+                archive_token = r.read().decode('UTF-8')
+        except (OSError, UnicodeDecodeError):
+            return None
+        return server_url + '/' + quote(archive_token) + '/' + quote(name) + '!/'
+
+    state = read_state()
+    if state:
+        url = register(state)
+        if url:
+            return url
+
+    kwargs = {}
+    if os.name == 'nt':
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+
+    proc = subprocess.Popen(
+            [sys.executable, '-m', __name__, root, state_file, str(timeout)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            **kwargs)
+
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            break
+        state = read_state()
+        if state and state[2] == proc.pid:
+            url = register(state)
+            if url:
+                return url
+        time.sleep(0.05)
+
+    raise RuntimeError('Unable to start the viewer server for "{}".'.format(root))
+
+
+if __name__ == '__main__':
+    serve_viewer(sys.argv[1], sys.argv[2], int(sys.argv[3]))
@@ -22,6 +22,7 @@ document.addEventListener("DOMContentLoaded", function (event) {
 
   /* Data table */
   document.getElementById("data-table").tBodies[0].addEventListener("click", onDataTableClick, false);
+  loadNextPages();
 
   /* Media viewers */
   browseHtmlFolder();
@@ -48,6 +49,20 @@ document.addEventListener("DOMContentLoaded", function (event) {
 }, false);
 
 function orderBy(column, order) {
+  // a paginated listing is sorted by the server
+  if (dataTable.hasAttribute("data-paginated")) {
+    var keys = ["name", "name", "mtime", "size"];
+    var params = new URLSearchParams(location.search);
+    if (typeof order === "undefined") {
+      order = (params.get("sort") === keys[column] && params.get("order") !== "desc") ? -1 : 1;
+    }
+    params.set("sort", keys[column]);
+    params.set("order", order === -1 ? "desc" : "asc");
+    params.delete("cursor");
+    location.search = params.toString();
+    return;
+  }
+
   if (typeof order === "undefined") {
     order = (dataTable.getAttribute("data-order") == 1) ? -1 : 1;
   }
@@ -85,6 +100,52 @@ function orderBy(column, order) {
   }
 }
 
+/**
+ * Append rows of the next pages of a paginated listing when scrolled to
+ * near the bottom.
+ */
+function loadNextPages() {
+  var loading = false;
+
+  var onScroll = async function () {
+    if (loading) { return; }
+
+    const url = dataTable.getAttribute("data-next");
+    if (!url) {
+      window.removeEventListener("scroll", onScroll, false);
+      return;
+    }
+
+    const root = document.documentElement;
+    if (window.scrollY + window.innerHeight * 2 < root.scrollHeight) { return; }
+
+    loading = true;
+    try {
+      const response = await fetch(url, {credentials: 'same-origin'});
+      if (!response.ok) {
+        throw new Error(`Bad status: ${response.status}`);
+      }
+      const doc = new DOMParser().parseFromString(await response.text(), 'text/html');
+      const table = doc.getElementById("data-table");
+      const tbody = dataTable.tBodies[0];
+      for (const row of Array.from(table.tBodies[0].rows)) {
+        tbody.appendChild(document.importNode(row, true));
+      }
+      dataTable.setAttribute("data-next", table.getAttribute("data-next") || "");
+    } catch (ex) {
+      console.error(ex);
+      dataTable.removeAttribute("data-next");
+    }
+    loading = false;
+
+    // load more if the page is still not filled
+    onScroll();
+  };
+
+  window.addEventListener("scroll", onScroll, false);
+  onScroll();
+}
+
 function onDataTableClick(event) {
   var elem = event.target;
   if (elem.tagName.toLowerCase() !== 'tr') {
@@ -117,6 +178,37 @@ function getTypeFromUrl(url) {
   }
 }
 
+/**
+ * Get the anchor, media type, and source URL of each entry in the table.
+ *
+ * The media class and the meta refresh target of each entry are provided
+ * by the server, so that no request is needed to determine them.
+ */
+function getMediaEntries() {
+  return Array.prototype.map.call(dataTable.querySelectorAll('tr:not(.extra)'), (tr) => {
+    const a = tr.querySelector('a[href]');
+    if (!a) { return {a}; }
+
+    if (tr.classList.contains('dir')) { return {a, type: 'dir'}; }
+
+    const target = tr.getAttribute('data-target');
+    const src = target ? new URL(target, a.href).href : a.href;
+
+    let type = tr.getAttribute('data-media');
+    if (!['image', 'audio', 'video'].includes(type)) {
+      if (tr.hasAttribute('data-media')) {
+        type = tr.classList.contains('link') ? 'link' : 'file';
+      } else {
+        // a table from a theme that doesn't provide the media class
+        type = getTypeFromUrl(a.href);
+        if (type === 'unknown') { type = 'file'; }
+      }
+    }
+
+    return {a, type, src};
+  });
+}
+
 function browseHtmlFolder() {
   var path = document.getElementById('data-table').getAttribute('data-path');
 
@@ -183,26 +275,38 @@ async function viewerGallery() {
     return figure;
   };
 
-  const addImage = (a) => {
+  // thumbnails for the 200px high figures, doubled for a high DPI screen
+  const thumbnailSize = window.devicePixelRatio > 1 ? 400 : 200;
+
+  const addImage = (a, src) => {
     const figure = addFigure();
 
     const anchor = figure.appendChild(document.createElement('a'));
     anchor.href = a.href;
     anchor.target = "_blank";
 
+    // use a downscaled image generated by the server if it's ours
+    const u = new URL(src);
+    if (u.origin === location.origin) {
+      u.searchParams.set('a', 'thumbnail');
+      u.searchParams.set('size', thumbnailSize);
+      src = u.href;
+    }
+
     const img = anchor.appendChild(document.createElement('img'));
-    img.src = a.href;
+    img.src = src;
+    img.loading = 'lazy';
     img.alt = img.title = a.textContent;
     img.style = 'margin: 0; border: 0; padding: 0; max-width: 100%; max-height: 200px;';
 
     return figure;
   };
 
-  const addAudio = (a) => {
+  const addAudio = (a, src) => {
     const figure = addFigure();
 
     const audio = figure.appendChild(document.createElement('audio'));
-    audio.src = a.href;
+    audio.src = src;
     audio.setAttribute("controls", "");
     audio.title = a.textContent;
     audio.style = 'margin: 0; border: 0; padding: 0; max-width: 100%; max-height: 200px;';
@@ -210,11 +314,11 @@ async function viewerGallery() {
     return figure;
   };
 
-  const addVideo = (a) => {
+  const addVideo = (a, src) => {
     const figure = addFigure();
 
     const video = figure.appendChild(document.createElement('video'));
-    video.src = a.href;
+    video.src = src;
     video.setAttribute("controls", "");
     video.title = a.textContent;
     video.style = 'margin: 0; border: 0; padding: 0; max-width: 100%; max-height: 200px;';
@@ -222,41 +326,22 @@ async function viewerGallery() {
     return figure;
   };
 
-  const tasks = await Promise.all(Array.prototype.map.call(dataTable.querySelectorAll('tr:not(.extra)'), (tr) => {
-    let type = tr.classList.contains('dir') ? 'dir' : 'unknown';
-    const a = tr.querySelector('a[href]');
-    if (!a) { return {a, type}; }
-
-    if (type === 'dir') { return {a, type}; }
-
-    type = getTypeFromUrl(a.href);
-    if (type !== 'unknown') { return {a, type}; }
-
-    return fetch(a.href, {method: 'HEAD'}).then(r => {
-      type = getTypeFromUrl(r.url);
-      if (type !== 'unknown') { return {a, type}; }
-      type = 'file';
-      return {a, type};
-    }).catch(ex => {
-      type = 'link';
-      return {a, type};
-    });
-  }));
+  const tasks = getMediaEntries();
 
   const deferredElems = [];
 
-  for (const {a, type} of tasks) {
+  for (const {a, type, src} of tasks) {
     if (!a) { continue; }
 
     switch (type) {
       case 'image':
-        addImage(a);
+        addImage(a, src);
         break;
       case 'audio':
-        addAudio(a);
+        addAudio(a, src);
         break;
       case 'video':
-        addVideo(a);
+        addVideo(a, src);
         break;
       default:
         deferredElems.push(addAnchor(a, type));
@@ -297,7 +382,7 @@ async function viewerList() {
     return figure;
   };
 
-  const addImage = (a) => {
+  const addImage = (a, src) => {
     const figure = addFigure();
 
     const anchor = figure.appendChild(document.createElement('a'));
@@ -305,18 +390,18 @@ async function viewerList() {
     anchor.target = "_blank";
 
     const img = anchor.appendChild(document.createElement('img'));
-    img.src = a.href;
+    img.src = src;
     img.alt = img.title = a.textContent;
     img.style = 'max-width: 90vw; max-height: 90vh;';
 
     return figure;
   };
 
-  const addAudio = (a) => {
+  const addAudio = (a, src) => {
     const figure = addFigure();
 
     const audio = figure.appendChild(document.createElement('audio'));
-    audio.src = a.href;
+    audio.src = src;
     audio.setAttribute("controls", "");
     audio.title = a.textContent;
     audio.style = 'max-width: 90vw; max-height: 90vh;';
@@ -324,11 +409,11 @@ async function viewerList() {
     return figure;
   };
 
-  const addVideo = (a) => {
+  const addVideo = (a, src) => {
     const figure = addFigure();
 
     const video = figure.appendChild(document.createElement('video'));
-    video.src = a.href;
+    video.src = src;
     video.setAttribute("controls", "");
     video.title = a.textContent;
     video.style = 'max-width: 90vw; max-height: 90vh;';
@@ -336,41 +421,22 @@ async function viewerList() {
     return figure;
   };
 
-  const tasks = await Promise.all(Array.prototype.map.call(dataTable.querySelectorAll('tr:not(.extra)'), (tr) => {
-    let type = tr.classList.contains('dir') ? 'dir' : 'unknown';
-    const a = tr.querySelector('a[href]');
-    if (!a) { return {a, type}; }
-
-    if (type === 'dir') { return {a, type}; }
-
-    type = getTypeFromUrl(a.href);
-    if (type !== 'unknown') { return {a, type}; }
-
-    return fetch(a.href, {method: 'HEAD'}).then(r => {
-      type = getTypeFromUrl(r.url);
-      if (type !== 'unknown') { return {a, type}; }
-      type = 'file';
-      return {a, type};
-    }).catch(ex => {
-      type = 'link';
-      return {a, type};
-    });
-  }));
+  const tasks = getMediaEntries();
 
   const deferredElems = [];
 
-  for (const {a, type} of tasks) {
+  for (const {a, type, src} of tasks) {
     if (!a) { continue; }
 
     switch (type) {
       case 'image':
-        addImage(a);
+        addImage(a, src);
         break;
       case 'audio':
-        addAudio(a);
+        addAudio(a, src);
         break;
       case 'video':
-        addVideo(a);
+        addVideo(a, src);
         break;
       default:
         deferredElems.push(addAnchor(a, type));
@@ -3,21 +3,63 @@
 """
 import sys, os
 import subprocess
+import shutil
+import stat
+import tempfile
+import traceback
 from collections import namedtuple
 from lxml import etree
 import zipfile
 import math
 import re
 import hashlib
+import json
 import time
+import copy
+import struct
+import bisect
+import heapq
+import base64
+import zlib
+import gzip
+import mimetypes
+import posixpath
+import io
+import threading
+import atexit
+import weakref
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import quote, unquote
 from ipaddress import IPv6Address, AddressValueError
 
+# this package
+from . import WSB_DIR
+
 try:
     from secrets import token_urlsafe
 except ImportError:
     from .lib.shim.secrets import token_urlsafe
 
+try:
+    from time import time_ns
+except ImportError:
+    from .lib.shim.time import time_ns
+
+# optional dependency
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 #########################################################################
 # URL and string
@@ -166,27 +208,298 @@ def file_info(file, base=None):
     return FileInfo(name=name, type=type, size=size, last_modified=last_modified)
 
 
-def listdir(base, recursive=False):
+def listdir(base, recursive=False, executor=None, workers=1):
     """Generates FileInfo(s) and omit invalid entries.
+
+    Information of each entry is read from the os.DirEntry with a single
+    lstat call, plus a stat call for a symbolic link. Entries are generated
+    in the same order as os.walk in recursive mode.
+
+    Args:
+        executor: an Executor to scan subdirectories concurrently with in
+            recursive mode, which saves round trips on a network filesystem.
+            The order of entries is the same.
+        workers: the number of workers of executor
     """
     if not recursive:
-        for entry in os.scandir(base):
-            info = file_info(entry.path)
+        with os.scandir(base) as it:
+            for entry in it:
+                info, _, _ = _dir_entry_info(entry, entry.name)
+                if info.type is None: continue
+                yield info
+        return
+
+    def scan(path, prefix):
+        dirs = []
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    info, is_dir, walk_into = _dir_entry_info(entry, prefix + entry.name)
+                    if is_dir:
+                        dirs.append(info)
+                        if walk_into:
+                            subdirs.append((entry.path, info.name + '/'))
+                    else:
+                        files.append(info)
+        except OSError:
+            # ignore an unreadable directory like os.walk does
+            return [], []
+
+        return dirs + files, subdirs
+
+    for infos in walk_dirs(base, scan, executor, workers):
+        for info in infos:
             if info.type is None: continue
             yield info
 
-    else:
-        for root, dirs, files in os.walk(base):
-            for dir in dirs:
-                file = os.path.join(root, dir)
-                info = file_info(file, base)
-                if info.type is None: continue
-                yield info
-            for file in files:
-                file = os.path.join(root, file)
-                info = file_info(file, base)
-                if info.type is None: continue
-                yield info
+
+def walk_dirs(base, scan, executor=None, workers=1):
+    """Generate results of scanning base and its subdirectories depth-first.
+
+    Args:
+        scan: a function that takes (path, prefix) of a directory and returns
+            a tuple (result, subdirs), where subdirs is a list of (path,
+            prefix) of the subdirectories to walk into, in order
+        executor: an Executor to run scan in. The directories next to be
+            walked are scanned concurrently, while the results are still
+            generated in order.
+        workers: the number of workers of executor
+    """
+    if executor is None:
+        stack = [(base, '')]
+        while stack:
+            path, prefix = stack.pop()
+            result, subdirs = scan(path, prefix)
+            stack.extend(reversed(subdirs))
+            yield result
+        return
+
+    # number of directories to scan in advance
+    prefetch = max(workers, 1) * 2
+
+    stack = [[base, '', None]]
+    try:
+        while stack:
+            count = 0
+            for item in reversed(stack):
+                if count >= prefetch:
+                    break
+                if item[2] is None:
+                    item[2] = executor.submit(scan, item[0], item[1])
+                count += 1
+
+            _, _, future = stack.pop()
+            result, subdirs = future.result()
+            stack.extend([path, prefix, None] for path, prefix in reversed(subdirs))
+            yield result
+    finally:
+        for item in stack:
+            if item[2] is not None:
+                item[2].cancel()
+
+
+def _dir_entry_info(entry, name):
+    """Read FileInfo of an os.DirEntry like file_info.
+
+    Returns:
+        a tuple (FileInfo, is_dir, walk_into), where is_dir tells whether the
+        entry is a directory or a link to a directory, and walk_into tells
+        whether it's a real directory
+    """
+    try:
+        statinfo = entry.stat(follow_symlinks=False)
+    except OSError:
+        return FileInfo(name=name, type=None, size=None, last_modified=None), False, False
+
+    if stat.S_ISLNK(statinfo.st_mode):
+        try:
+            statinfo = os.stat(entry.path)
+        except OSError:
+            # broken link
+            return FileInfo(name=name, type='link', size=None, last_modified=None), False, False
+
+        is_dir = stat.S_ISDIR(statinfo.st_mode)
+        return FileInfo(name=name, type='link', size=None, last_modified=statinfo.st_mtime), is_dir, False
+
+    if stat.S_ISDIR(statinfo.st_mode):
+        return FileInfo(name=name, type='dir', size=None, last_modified=statinfo.st_mtime), True, True
+
+    if stat.S_ISREG(statinfo.st_mode):
+        return FileInfo(name=name, type='file', size=statinfo.st_size, last_modified=statinfo.st_mtime), False, False
+
+    return FileInfo(name=name, type='unknown', size=None, last_modified=statinfo.st_mtime), False, False
+
+
+LISTING_SORT_KEYS = {
+    'name': lambda info: (info.name.lower(), info.name),
+    'mtime': lambda info: (info.last_modified or 0, info.name),
+    'size': lambda info: (info.size or 0, info.name),
+    }
+
+# types of the values of each sort key, for validating a cursor
+LISTING_SORT_KEY_TYPES = {
+    'name': (str, str),
+    'mtime': ((int, float), str),
+    'size': ((int, float), str),
+    }
+
+
+def filter_listing(infos, name=None, types=None):
+    """Generate FileInfo(s) whose name contains name (case-insensitive) and
+    whose type is in types.
+    """
+    if name:
+        name = name.lower()
+    for info in infos:
+        if name and name not in info.name.lower():
+            continue
+        if types and info.type not in types:
+            continue
+        yield info
+
+
+def paginate_listing(infos, limit=None, cursor=None, sort=None, order=None):
+    """Sort FileInfo(s) and take a page of them.
+
+    Only a heap of limit + 1 entries is kept when limit is provided, so that
+    taking the first page of a huge directory doesn't sort all entries.
+
+    Args:
+        sort: 'name' (default), 'mtime', or 'size'. Entries are generated
+            as-is if none of limit, cursor, sort, and order is provided.
+        order: 'asc' (default) or 'desc'
+        cursor: an opaque string to take the page after, as returned by a
+            previous call
+
+    Returns:
+        a tuple (infos, next_cursor), where next_cursor is None if there
+        are no more entries.
+
+    Raises:
+        ValueError: if any argument is invalid
+    """
+    if limit is None and cursor is None and sort is None and order is None:
+        return infos, None
+
+    sort = sort or 'name'
+    order = order or 'asc'
+    try:
+        keyfunc = LISTING_SORT_KEYS[sort]
+    except KeyError:
+        raise ValueError('Unsupported sort key "{}".'.format(sort)) from None
+
+    if order not in ('asc', 'desc'):
+        raise ValueError('Unsupported order "{}".'.format(order))
+    reverse = order == 'desc'
+
+    if limit is not None and limit <= 0:
+        raise ValueError('Limit must be a positive integer.')
+
+    if cursor:
+        try:
+            csort, corder, ckey = json.loads(base64.urlsafe_b64decode(cursor.encode('ASCII')))
+            ckey = tuple(ckey)
+        except Exception:
+            raise ValueError('Invalid cursor.') from None
+        types = LISTING_SORT_KEY_TYPES[sort]
+        if (len(ckey) != len(types) or
+                not all(isinstance(v, t) and not isinstance(v, bool) for v, t in zip(ckey, types))):
+            raise ValueError('Invalid cursor.')
+        if csort != sort or corder != order:
+            raise ValueError('The cursor does not match the sort order.')
+
+        if reverse:
+            infos = (i for i in infos if keyfunc(i) < ckey)
+        else:
+            infos = (i for i in infos if keyfunc(i) > ckey)
+
+    if limit is None:
+        return sorted(infos, key=keyfunc, reverse=reverse), None
+
+    select = heapq.nlargest if reverse else heapq.nsmallest
+    page = select(limit + 1, infos, key=keyfunc)
+    if len(page) <= limit:
+        return page, None
+
+    page = page[:limit]
+    next_cursor = base64.urlsafe_b64encode(
+            json.dumps([sort, order, keyfunc(page[-1])]).encode('ASCII')).decode('ASCII')
+    return page, next_cursor
+
+
+def dir_fingerprint(base):
+    """Compute a fingerprint of a directory for validating its listing.
+
+    Only the directory itself is stat'ed and its entries are counted, without
+    an lstat of each entry, so that a listing can be validated cheaply. A
+    change of an entry in place, which doesn't touch the mtime of the
+    directory, is not detected.
+
+    Returns:
+        a tuple (fingerprint, last_modified)
+    """
+    statinfo = os.stat(base)
+    with os.scandir(base) as it:
+        count = sum(1 for _ in it)
+    fingerprint = '{:x}-{:x}-{:x}'.format(statinfo.st_mtime_ns, statinfo.st_ino, count)
+    return fingerprint, statinfo.st_mtime
+
+
+def iter_chunks(gen, size=65536):
+    """Join small strings generated by gen into chunks of about size.
+
+    This reduces the overhead of writing each string to the client.
+    """
+    chunk = []
+    length = 0
+    for data in gen:
+        chunk.append(data)
+        length += len(data)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+ARCHIVE_MIMETYPES = {
+    'application/html+zip',
+    'application/x-maff',
+    'application/zip',
+    'application/x-zip-compressed',
+    'application/epub+zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-tar',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    }
+
+
+def media_class(mimetype):
+    """Classify a mimetype as 'image', 'audio', 'video', 'html', 'archive',
+    or None.
+    """
+    if not mimetype:
+        return None
+
+    major = mimetype.partition('/')[0]
+    if major in ('image', 'audio', 'video'):
+        return major
+
+    if mimetype in ('text/html', 'application/xhtml+xml'):
+        return 'html'
+
+    if mimetype in ARCHIVE_MIMETYPES:
+        return 'archive'
+
+    return None
 
 
 def format_filesize(bytes, si=False):
@@ -219,43 +532,360 @@ class ZipDirNotFoundError(Exception):
     pass
 
 
-def zip_file_info(zip, subpath, check_missing_dir=False):
-    """Read basic file information from ZIP.
+class ZipCacheEntry():
+    """An opened ZipFile object held by ZipCache.
+    """
+    def __init__(self, key, zip, size):
+        self.key = key
+        self.zip = zip
+        self.size = size
+        self.refs = 0
+        self.evicted = False
 
-    Args:
-        subpath: 'dir' and 'dir/' are both supported
+
+class ZipCache():
+    """A thread-safe LRU cache of opened ZipFile objects.
+
+    An entry is keyed by (realpath, inode, size, mtime_ns) of the archive
+    file, so that a modified archive file is never served from a stale entry.
+    Evicted or invalidated ZipFile objects are closed as soon as they are no
+    longer leased.
     """
-    if not isinstance(zip, zipfile.ZipFile):
-        zip = zipfile.ZipFile(zip)
+    def __init__(self, max_entries=32, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(file):
+        realpath = os.path.realpath(file)
+        stat = os.stat(realpath)
+        return (realpath, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def estimate_size(zip):
+        """Estimate the memory cost of a parsed ZipFile object.
+
+        Memory held along with it later, such as its ZipIndex and inflation
+        checkpoints, is counted by add_size().
+        """
+        return sum(
+            len(i.filename) + len(i.extra) + len(i.comment) + ZipCache.ENTRY_OVERHEAD
+            for i in zip.infolist()
+            )
 
-    subpath = subpath.rstrip('/')
-    basename = os.path.basename(subpath)
+    @contextmanager
+    def open(self, file):
+        """Lease a ZipFile object for reading.
 
-    try:
-        info = zip.getinfo(subpath)
-    except KeyError:
-        pass
-    else:
+        The yielded ZipFile object must not be closed by the caller. Member
+        files opened during the lease remain readable after the lease ends.
+        """
+        entry = self.acquire(file)
+        try:
+            yield entry.zip
+        finally:
+            self.release(entry)
+
+    def is_cached(self, zip):
+        """Check whether a ZipFile object is held by the cache.
+        """
+        with self._lock:
+            return self._find(zip) is not None
+
+    def add_size(self, zip, size):
+        """Count additional memory held along with a cached ZipFile object.
+
+        Least recently used entries are evicted if max_size is exceeded. Does
+        nothing if zip is not held by the cache.
+        """
+        with self._lock:
+            entry = self._find(zip)
+            if entry is None:
+                return
+            entry.size += size
+            self.size += size
+            self._shrink()
+
+    def invalidate(self, file):
+        """Drop all cached versions of the given archive file.
+        """
+        realpath = os.path.realpath(file)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == realpath]:
+                self._evict(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+    def acquire(self, file):
+        """Lease a ZipCacheEntry, which must be passed to release() later.
+        """
+        key = self.get_key(file)
+
+        if self.max_entries <= 0:
+            entry = ZipCacheEntry(key, zipfile.ZipFile(key[0]), 0)
+            entry.refs += 1
+            entry.evicted = True
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry.refs += 1
+                return entry
+
+        # parse the archive outside of the lock
+        zip = zipfile.ZipFile(key[0])
+        size = self.estimate_size(zip)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                # another thread has cached the same archive version
+                zip.close()
+                self._entries.move_to_end(key)
+                entry.refs += 1
+                return entry
+
+            # drop outdated versions of the same archive file
+            for k in [k for k in self._entries if k[0] == key[0]]:
+                self._evict(k)
+
+            entry = ZipCacheEntry(key, zip, size)
+            entry.refs += 1
+            self._entries[key] = entry
+            self.size += size
+            self._shrink()
+
+            return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            if entry.evicted and entry.refs <= 0:
+                entry.zip.close()
+
+    def _find(self, zip):
+        for entry in self._entries.values():
+            if entry.zip is zip:
+                return entry
+        return None
+
+    def _shrink(self):
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self.size > self.max_size):
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+        entry.evicted = True
+        if entry.refs <= 0:
+            entry.zip.close()
+
+    ENTRY_OVERHEAD = 520  # estimated bytes for a ZipInfo object
+
+zip_cache = ZipCache()
+
+
+class ZipIndex():
+    """A directory tree index of a ZipFile.
+
+    Maps each directory path (without trailing slash, '' for the root) to its
+    children, with type, size and last modified time of every member
+    precomputed, so that looking up or listing a path doesn't need to scan
+    through the whole namelist.
+    """
+    ENTRY_OVERHEAD = 256  # estimated bytes for the FileInfo and dict items of a member
+
+    def __init__(self, zip):
+        self.files = {}
+        self.dirs = {}
+        self.children = {'': OrderedDict()}
+        self.size = 0
+
+        epochs = {}
+        for info in zip.infolist():
+            filename = info.filename
+            parts = filename.split('/')
+            self.size += self.ENTRY_OVERHEAD + len(filename)
+
+            # register each ancestor-child pair, e.g. 'a/b/c' as ('', 'a'),
+            # ('a', 'b'), ('a/b', 'c'), and 'a/b/' as ('', 'a'), ('a', 'b')
+            for i in range(len(parts) - 1 if filename.endswith('/') else len(parts)):
+                parent = '/'.join(parts[:i])
+                self.children.setdefault(parent, OrderedDict())[parts[i]] = True
+
+            lm = info.date_time
+            try:
+                epoch = epochs[lm]
+            except KeyError:
+                epoch = epochs[lm] = int(time.mktime((lm[0], lm[1], lm[2], lm[3], lm[4], lm[5], 0, 0, -1)))
+
+            if filename.endswith('/'):
+                path = filename[:-1]
+                self.children.setdefault(path, OrderedDict())
+                self.dirs[path] = FileInfo(name=parts[-2], type='dir', size=None, last_modified=epoch)
+            else:
+                self.files[filename] = FileInfo(name=parts[-1], type='file', size=info.file_size, last_modified=epoch)
+
+    def has_dir(self, path):
+        """Check whether a path (without trailing slash) is a directory.
+        """
+        return path in self.children
+
+    def file_info(self, path, check_missing_dir=False):
+        """Get FileInfo of a path (without trailing slash).
+        """
+        try:
+            return self.files[path]
+        except KeyError:
+            pass
+
+        try:
+            return self.dirs[path]
+        except KeyError:
+            pass
+
+        basename = os.path.basename(path)
+
+        if check_missing_dir and path and path in self.children:
+            return FileInfo(name=basename, type='dir', size=None, last_modified=None)
+
+        return FileInfo(name=basename, type=None, size=None, last_modified=None)
+
+    def listdir(self, path):
+        """Generate FileInfo(s) of children of a path (without trailing slash).
+
+        Raise ZipDirNotFoundError if the directory does not exist.
+        """
+        try:
+            children = self.children[path]
+        except KeyError:
+            raise ZipDirNotFoundError('Directory "{}/" does not exist in the zip.'.format(path)) from None
+
+        base = path + '/' if path else ''
+        for name in children:
+            subpath = base + name
+            info = self.files.get(subpath) or self.dirs.get(subpath)
+            if info is None:
+                yield FileInfo(name=name, type='dir', size=None, last_modified=None)
+            else:
+                yield info
+
+
+class ZipScanIndex():
+    """A ZipIndex-like lookup of a ZipFile without building an index.
+
+    Each lookup or listing scans the members as needed, which is cheaper
+    than building a ZipIndex for a ZipFile object used only once.
+    """
+    def __init__(self, zip):
+        self.zip = zip
+
+    def has_dir(self, path):
+        if not path:
+            return True
+        base = path + '/'
+        return any(name.startswith(base) for name in self.zip.NameToInfo)
+
+    def file_info(self, path, check_missing_dir=False):
+        if path:
+            info = self.zip.NameToInfo.get(path)
+            if info is not None:
+                return self._file_info(info)
+
+            info = self.zip.NameToInfo.get(path + '/')
+            if info is not None:
+                return self._file_info(info)
+
+        basename = os.path.basename(path)
+
+        if check_missing_dir and path and self.has_dir(path):
+            return FileInfo(name=basename, type='dir', size=None, last_modified=None)
+
+        return FileInfo(name=basename, type=None, size=None, last_modified=None)
+
+    def listdir(self, path):
+        base = path + '/' if path else ''
+        children = OrderedDict()
+        found = not path
+        for name in self.zip.NameToInfo:
+            if not name.startswith(base):
+                continue
+            found = True
+            child = name[len(base):].split('/', 1)[0]
+            if child:
+                children[child] = True
+
+        if not found:
+            raise ZipDirNotFoundError('Directory "{}/" does not exist in the zip.'.format(path))
+
+        for name in children:
+            subpath = base + name
+            info = self.zip.NameToInfo.get(subpath) or self.zip.NameToInfo.get(subpath + '/')
+            if info is None:
+                yield FileInfo(name=name, type='dir', size=None, last_modified=None)
+            else:
+                yield self._file_info(info)
+
+    @staticmethod
+    def _file_info(info):
         lm = info.date_time
         epoch = int(time.mktime((lm[0], lm[1], lm[2], lm[3], lm[4], lm[5], 0, 0, -1)))
-        return FileInfo(name=basename, type='file', size=info.file_size, last_modified=epoch)
+        if info.filename.endswith('/'):
+            return FileInfo(name=info.filename.split('/')[-2], type='dir', size=None, last_modified=epoch)
+        return FileInfo(name=info.filename.split('/')[-1], type='file', size=info.file_size, last_modified=epoch)
+
+
+_zip_indexes = weakref.WeakKeyDictionary()
+_zip_indexes_lock = threading.Lock()
+
+def zip_index(zip):
+    """Get the index of a ZipFile.
 
+    A ZipIndex is built once for a ZipFile object held by zip_cache, and its
+    memory is counted in the cache size. Any other ZipFile object, e.g. when
+    the cache is disabled, gets a ZipScanIndex instead.
+    """
     try:
-        info = zip.getinfo(subpath + '/')
+        return _zip_indexes[zip]
     except KeyError:
         pass
-    else:
-        lm = info.date_time
-        epoch = int(time.mktime((lm[0], lm[1], lm[2], lm[3], lm[4], lm[5], 0, 0, -1)))
-        return FileInfo(name=basename, type='dir', size=None, last_modified=epoch)
 
-    if check_missing_dir:
-        base = subpath + '/'
-        for entry in zip.namelist():
-            if entry.startswith(base):
-                return FileInfo(name=basename, type='dir', size=None, last_modified=None)
+    if not zip_cache.is_cached(zip):
+        return ZipScanIndex(zip)
+
+    index = ZipIndex(zip)
+    with _zip_indexes_lock:
+        existing = _zip_indexes.get(zip)
+        if existing is not None:
+            return existing
+        _zip_indexes[zip] = index
+    zip_cache.add_size(zip, index.size)
+    return index
 
-    return FileInfo(name=basename, type=None, size=None, last_modified=None)
+
+def zip_file_info(zip, subpath, check_missing_dir=False):
+    """Read basic file information from ZIP.
+
+    Args:
+        subpath: 'dir' and 'dir/' are both supported
+    """
+    if not isinstance(zip, zipfile.ZipFile):
+        with zip_cache.open(zip) as zip:
+            return zip_file_info(zip, subpath, check_missing_dir)
+
+    return zip_index(zip).file_info(subpath.rstrip('/'), check_missing_dir)
 
 
 def zip_listdir(zip, subpath):
@@ -264,39 +894,1517 @@ def zip_listdir(zip, subpath):
     Raise ZipDirNotFoundError if subpath does not exist. 
 
     NOTE: It is possible that entry mydir/ does not exist while
-    mydir/foo.bar exists. Check for matching subentries to make sure whether
-    the directory exists.
+    mydir/foo.bar exists. Such directory is also taken as existent.
     """
     if not isinstance(zip, zipfile.ZipFile):
-        zip = zipfile.ZipFile(zip)
-
-    base = subpath.rstrip('/')
-    if base: base += '/'
-    base_len = len(base)
-    dir_exist = not base
-    entries = {}
-    for filename in zip.namelist():
-        if not filename.startswith(base):
-            continue
+        with zip_cache.open(zip) as zip:
+            yield from zip_listdir(zip, subpath)
+        return
+
+    yield from zip_index(zip).listdir(subpath.rstrip('/'))
 
-        if filename == base:
-            dir_exist = True
-            continue
 
-        subpath = filename[base_len:]
-        entry, _, _ = subpath.partition('/')
-        entries.setdefault(entry, True)
+# indexes of fields in a local file header unpacked with
+# zipfile.structFileHeader
+_ZIP_FH_SIGNATURE = 0
+_ZIP_FH_FILENAME_LENGTH = 10
+_ZIP_FH_EXTRA_FIELD_LENGTH = 11
 
-    if not len(entries) and not dir_exist:
-        raise ZipDirNotFoundError('Directory "{}/" does not exist in the zip.'.format(base))
+# private attributes of a ZipFile that are updated when writing a member
+# without zipfile, which are available in CPython 3.6 - 3.13
+_ZIP_WRITE_ATTRS = ('_writing', '_seekable', 'start_dir', '_didModify')
 
-    for entry in entries:
-        info = zip_file_info(zip, base + entry)
 
-        if info.type is None:
-            yield FileInfo(name=entry, type='dir', size=None, last_modified=None)
+def _zip_check_write(zip):
+    """Check that a member can be written to a ZipFile without zipfile.
+
+    Raises:
+        RuntimeError: if the ZipFile of this Python doesn't have the expected
+            private attributes
+        ValueError: if the ZipFile is being written by another handle
+    """
+    missing = [a for a in _ZIP_WRITE_ATTRS if not hasattr(zip, a)]
+    if missing:
+        raise RuntimeError('Writing raw ZIP data is not supported by zipfile of this Python (missing {}).'.format(
+                ', '.join(missing)))
+
+    if zip._writing:
+        raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+
+
+def _zip_set_compresslevel(zinfo, level):
+    """Set the compression level for zipfile to write a member with.
+
+    It's ignored by zipfile before Python 3.7, whose ZipInfo doesn't have
+    the attribute.
+    """
+    if hasattr(zipfile.ZipInfo, '_compresslevel'):
+        zinfo._compresslevel = level
+
+
+def _zip_strip_extra(extra, xids):
+    """Remove extra fields with the given header IDs.
+    """
+    result = []
+    i = 0
+    while i + 4 <= len(extra):
+        xid, size = struct.unpack('<HH', extra[i:i + 4])
+        j = i + 4 + size
+        if xid not in xids:
+            result.append(extra[i:j])
+        i = j
+    return b''.join(result)
+
+
+def _zip_read_file_header(fh, info):
+    """Read the local file header of a member at the current position.
+
+    Returns:
+        a tuple (header, filename_length, extra_length), where header is the
+        fixed-size part
+    """
+    header = fh.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipFile('Truncated file header of "{}".'.format(info.filename))
+    fheader = struct.unpack(zipfile.structFileHeader, header)
+    if fheader[_ZIP_FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad magic number for file header of "{}".'.format(info.filename))
+    return header, fheader[_ZIP_FH_FILENAME_LENGTH], fheader[_ZIP_FH_EXTRA_FIELD_LENGTH]
+
+
+def zip_copy(zsrc, zdst, info, arcname=None, fsrc=None):
+    """Copy a member from zsrc to zdst without decompressing or recompressing.
+
+    The local file header and the compressed data are copied verbatim, and the
+    central directory record is regenerated when zdst is closed. The local
+    file header is regenerated only if the member is renamed or uses a data
+    descriptor, which is dropped since the CRC and sizes are known.
+
+    Args:
+        zsrc: a ZipFile opened for reading
+        zdst: a ZipFile opened for writing
+        info: a ZipInfo of zsrc
+        arcname: the new name of the member in zdst
+        fsrc: a file object of the archive file of zsrc to read from, which
+            is opened on demand if not provided
+
+    Returns:
+        the ZipInfo of zdst
+    """
+    gen = zip_copy_iter(zsrc, zdst, info, arcname, fsrc)
+    while True:
+        try:
+            next(gen)
+        except StopIteration as exc:
+            return exc.value
+
+
+def zip_copy_iter(zsrc, zdst, info, arcname=None, fsrc=None, chunk_size=1048576):
+    """Generator version of zip_copy, which yields after each written chunk.
+
+    This is for writing to a stream, such as a StreamBuffer, chunk by chunk.
+    """
+    if fsrc is None:
+        with open(zsrc.filename, 'rb') as fsrc:
+            return (yield from zip_copy_iter(zsrc, zdst, info, arcname, fsrc, chunk_size))
+
+    fsrc.seek(info.header_offset)
+    header, filename_length, extra_length = _zip_read_file_header(fsrc, info)
+    header += fsrc.read(filename_length + extra_length)
+
+    zinfo = copy.copy(info)
+    if arcname is not None:
+        zinfo.filename = zinfo.orig_filename = arcname
+
+    if arcname is not None or zinfo.flag_bits & 0x08:
+        zinfo.flag_bits &= ~0x08
+        zinfo.extra = _zip_strip_extra(zinfo.extra, (1,))
+        header = zinfo.FileHeader(
+                zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT)
+
+    _zip_check_write(zdst)
+
+    fdst = zdst.fp
+    if zdst._seekable:
+        fdst.seek(zdst.start_dir)
+    zinfo.header_offset = fdst.tell()
+    zdst._writing = True
+    try:
+        fdst.write(header)
+        yield
+
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fsrc.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError('Unexpected end of data for "{}".'.format(info.filename))
+            fdst.write(chunk)
+            remaining -= len(chunk)
+            yield
+    finally:
+        zdst._writing = False
+
+    zdst.start_dir = fdst.tell()
+    zdst.filelist.append(zinfo)
+    zdst.NameToInfo[zinfo.filename] = zinfo
+    zdst._didModify = True
+    return zinfo
+
+
+def zip_open_data(zip, info):
+    """Open the archive file of a ZipFile, positioned at the data of a member.
+
+    The returned file object is independent of the ZipFile, and should be
+    closed by the caller.
+
+    Returns:
+        a file object in binary mode
+    """
+    fh = open(zip.filename, 'rb')
+    try:
+        fh.seek(info.header_offset)
+        _, filename_length, extra_length = _zip_read_file_header(fh, info)
+        fh.seek(filename_length + extra_length, 1)
+    except:
+        fh.close()
+        raise
+    return fh
+
+
+def zip_gzip_size(info):
+    """Get the size of the stream generated by zip_gzip_stream.
+    """
+    return len(GZIP_HEADER) + info.compress_size + 8
+
+
+def zip_gzip_stream(fh, info, chunk_size=65536):
+    """Generate a gzip stream of a deflated member without decompression.
+
+    The raw deflate data is wrapped with a gzip header and a trailer built
+    from the CRC and size recorded in the ZIP file.
+
+    Args:
+        fh: a file object positioned at the data of the member, as returned
+            by zip_open_data
+        info: the ZipInfo of a ZIP_DEFLATED member
+    """
+    try:
+        yield GZIP_HEADER
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fh.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError('Unexpected end of data for "{}".'.format(info.filename))
+            remaining -= len(chunk)
+            yield chunk
+        yield struct.pack('<LL', info.CRC, info.file_size & 0xFFFFFFFF)
+    finally:
+        fh.close()
+
+
+# magic, method (deflate), flags, mtime, extra flags, OS (unknown)
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+class FileSlice():
+    """A read-only seekable file object for a part of another file.
+
+    The position of the underlying file is kept in sync, so that fileno() can
+    be used along with tell() for sendfile.
+    """
+    def __init__(self, fh, offset, length):
+        self.fh = fh
+        self.offset = offset
+        self.length = length
+        self.pos = 0
+        fh.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self.length - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.fh.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.pos = min(max(offset, 0), self.length)
+        self.fh.seek(self.offset + self.pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        self.fh.close()
+
+
+class ZipCheckpoints():
+    """Inflation checkpoints of a deflated ZIP member.
+
+    Each checkpoint is a tuple (uncompressed offset, compressed offset,
+    decompressor snapshot). Checkpoints are added lazily by ZipDeflatedReader
+    as the member is inflated.
+    """
+    CHECKPOINT_SIZE = 40960  # estimated bytes of a decompressor snapshot
+
+    def __init__(self, interval, on_add=None):
+        """
+        Args:
+            on_add: a function called with the estimated size of each added
+                checkpoint
+        """
+        self.interval = interval
+        self.on_add = on_add
+        self.offsets = [0]
+        self.checkpoints = [(0, 0, zlib.decompressobj(-zlib.MAX_WBITS))]
+        self.lock = threading.Lock()
+
+    def get(self, pos):
+        """Get the last checkpoint at or before pos.
+        """
+        with self.lock:
+            return self.checkpoints[bisect.bisect_right(self.offsets, pos) - 1]
+
+    def add(self, out_pos, in_pos, decompressor):
+        with self.lock:
+            if out_pos < self.offsets[-1] + self.interval:
+                return
+            self.offsets.append(out_pos)
+            self.checkpoints.append((out_pos, in_pos, decompressor.copy()))
+
+        if self.on_add:
+            self.on_add(self.CHECKPOINT_SIZE)
+
+
+_zip_checkpoints = weakref.WeakKeyDictionary()
+_zip_checkpoints_lock = threading.Lock()
+
+def zip_checkpoints(zip, info):
+    """Get ZipCheckpoints of a member, which are kept along with the ZipFile.
+
+    Memory of the checkpoints is counted in the size of zip_cache.
+    """
+    with _zip_checkpoints_lock:
+        members = _zip_checkpoints.setdefault(zip, {})
+        try:
+            return members[info.filename]
+        except KeyError:
+            pass
+
+        # don't keep the ZipFile alive by the value of the weak dict
+        ref = weakref.ref(zip)
+
+        def on_add(size):
+            zip = ref()
+            if zip is not None:
+                zip_cache.add_size(zip, size)
+
+        checkpoints = members[info.filename] = ZipCheckpoints(ZipDeflatedReader.CHECKPOINT_INTERVAL, on_add)
+        return checkpoints
+
+
+class ZipDeflatedReader():
+    """A read-only seekable file object for a deflated ZIP member.
+
+    Unlike ZipExtFile, which inflates from the beginning of the member for a
+    backward seek, seeking resumes inflation from the nearest checkpoint.
+    """
+    def __init__(self, fh, info, checkpoints):
+        """
+        Args:
+            fh: a file object positioned at the data of the member, as
+                returned by zip_open_data
+            info: the ZipInfo of a ZIP_DEFLATED member
+            checkpoints: the ZipCheckpoints of the member
+        """
+        self.fh = fh
+        self.info = info
+        self.checkpoints = checkpoints
+        self.data_offset = fh.tell()
+        self.pos = 0
+        self._restore(checkpoints.get(0))
+
+    def _restore(self, checkpoint):
+        out_pos, in_pos, decompressor = checkpoint
+        self.decompressor = decompressor.copy()
+        self.out_pos = out_pos
+        self.in_pos = in_pos
+        self.tail = b''
+        self.fh.seek(self.data_offset + in_pos)
+
+    def _eof(self):
+        return self.in_pos >= self.info.compress_size and not self.tail
+
+    def _inflate(self, size):
+        """Inflate up to size bytes from the current state.
+        """
+        data = self.tail
+        if not data:
+            data = self.fh.read(min(self.CHUNK_SIZE, self.info.compress_size - self.in_pos))
+            if not data:
+                raise EOFError('Unexpected end of data for "{}".'.format(self.info.filename))
+            self.in_pos += len(data)
+
+        chunk = self.decompressor.decompress(data, size)
+        self.tail = self.decompressor.unconsumed_tail
+        self.out_pos += len(chunk)
+        self.checkpoints.add(self.out_pos, self.in_pos - len(self.tail), self.decompressor)
+        return chunk
+
+    def _skip_to(self, pos):
+        if pos < self.out_pos or pos - self.out_pos > self.checkpoints.interval:
+            checkpoint = self.checkpoints.get(pos)
+            if pos < self.out_pos or checkpoint[0] > self.out_pos:
+                self._restore(checkpoint)
+
+        while self.out_pos < pos and not self._eof():
+            self._inflate(min(pos - self.out_pos, self.CHUNK_SIZE))
+
+    def read(self, size=-1):
+        remaining = self.info.file_size - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+
+        if self.out_pos != self.pos:
+            self._skip_to(self.pos)
+
+        chunks = []
+        while size > 0 and not self._eof():
+            chunk = self._inflate(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        data = b''.join(chunks)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.info.file_size
+        self.pos = min(max(offset, 0), self.info.file_size)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.fh.close()
+
+    CHUNK_SIZE = 65536
+    CHECKPOINT_INTERVAL = 8 * 1024 * 1024
+
+
+@contextmanager
+def zip_rewrite(file, exclude=None):
+    """Rewrite a ZIP file via a temporary file.
+
+    Members of the original ZIP file are copied with zip_copy, and the
+    yielded ZipFile can be used to write additional members. The original
+    file is replaced when the context exits successfully, and the temporary
+    file is removed otherwise.
+
+    Args:
+        exclude: a function that takes a ZipInfo and returns True if the
+            member should not be copied
+    """
+    temp_path = file + '.' + str(time_ns())
+    with zipfile.ZipFile(file) as zsrc:
+        zdst = zipfile.ZipFile(temp_path, 'w')
+        try:
+            for info in zsrc.infolist():
+                if exclude is not None and exclude(info):
+                    continue
+                zip_copy(zsrc, zdst, info, fsrc=zsrc.fp)
+
+            yield zdst
+        except:
+            # remove the generated zip file if writing fails
+            zdst.close()
+            os.remove(temp_path)
+            raise
         else:
-            yield info
+            zdst.close()
+
+    # replace the original file with the generated zip file
+    zip_cache.invalidate(file)
+    temp_path2 = file + '.' + str(time_ns() + 1)
+    os.rename(file, temp_path2)
+    os.rename(temp_path, file)
+    os.remove(temp_path2)
+
+
+def is_compressed_mimetype(mimetype):
+    """Determine if data of the mimetype is generally compressed already.
+
+    Such data is hardly made smaller by compressing it again.
+    """
+    if not mimetype:
+        return False
+
+    if mimetype in COMPRESSED_MIMETYPES:
+        return True
+
+    major, _, minor = mimetype.partition('/')
+    if major in ('image', 'audio', 'video'):
+        return mimetype not in UNCOMPRESSED_MEDIA_MIMETYPES
+
+    return False
+
+COMPRESSED_MIMETYPES = {
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/vnd.rar',
+    'application/html+zip',
+    'application/x-maff',
+    'application/epub+zip',
+    'application/java-archive',
+    'application/pdf',
+    'font/woff',
+    'font/woff2',
+    'application/font-woff',
+    }
+
+UNCOMPRESSED_MEDIA_MIMETYPES = {
+    'image/svg+xml',
+    'image/bmp',
+    'image/x-ms-bmp',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+    'image/tiff',
+    'image/x-portable-pixmap',
+    'audio/wav',
+    'audio/x-wav',
+    }
+
+
+def zip_date_time(timestamp):
+    """Get the date_time of a ZipInfo for a timestamp.
+
+    It's clamped to the range a ZIP file can represent (1980-2107), like
+    ZipInfo.from_file() with strict_timestamps=False.
+    """
+    date_time = time.localtime(timestamp)[:6]
+    if date_time[0] < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    if date_time[0] > 2107:
+        return (2107, 12, 31, 23, 59, 59)
+    return date_time
+
+
+class StreamBuffer():
+    """A write-only file object that buffers written data until popped.
+
+    A ZipFile writing to it uses data descriptors since it's not seekable.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ZipStream():
+    """Generate a ZIP file as a stream of bytes.
+
+    Each add_*() and close() method returns a generator of the produced
+    bytes, so that no temporary file or buffer of the whole ZIP file is
+    needed. Data of already compressed types are stored without deflating.
+    """
+    def __init__(self, compresslevel=6):
+        self.compresslevel = compresslevel
+        self.buffer = StreamBuffer()
+        self.zip = zipfile.ZipFile(self.buffer, 'w')
+
+    def add_dir(self, arcname, date_time=None):
+        info = zipfile.ZipInfo(arcname.rstrip('/') + '/', date_time or zip_date_time(time.time()))
+        info.external_attr = 0o40775 << 16 | 0x10
+        self.zip.writestr(info, b'')
+        yield from self._flush()
+
+    def add_file(self, file, arcname, chunk_size=65536):
+        """Add a file from the filesystem.
+
+        The file is opened before returning the generator, so that an OSError
+        for a missing or unreadable file is raised before anything of the
+        member is generated and the file can be skipped.
+        """
+        fh = open(file, 'rb')
+        try:
+            stat = os.fstat(fh.fileno())
+        except:
+            fh.close()
+            raise
+
+        info = zipfile.ZipInfo(arcname, zip_date_time(stat.st_mtime))
+        info.file_size = stat.st_size
+        info.external_attr = (stat.st_mode & 0xFFFF) << 16
+
+        mimetype, _ = mimetypes.guess_type(arcname)
+        if self.compresslevel == 0 or is_compressed_mimetype(mimetype):
+            info.compress_type = zipfile.ZIP_STORED
+        else:
+            info.compress_type = zipfile.ZIP_DEFLATED
+            _zip_set_compresslevel(info, self.compresslevel)
+
+        return self._add_file(fh, info, chunk_size)
+
+    def _add_file(self, fh, info, chunk_size):
+        with fh, self.zip.open(info, 'w') as fp:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    break
+                fp.write(chunk)
+                yield from self._flush()
+        yield from self._flush()
+
+    def add_zip_member(self, zsrc, info, arcname, fsrc=None):
+        """Add a member of another ZipFile as-is.
+        """
+        for _ in zip_copy_iter(zsrc, self.zip, info, arcname, fsrc):
+            yield from self._flush()
+
+    def close(self):
+        self.zip.close()
+        yield from self._flush()
+
+    def _flush(self):
+        data = self.buffer.pop()
+        if data:
+            yield data
+
+
+def _zip_deflate_block(data, level, zdict, last):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 8, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return data, compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+_zip_pack_executor = None
+_zip_pack_executor_lock = threading.Lock()
+_zip_pack_workers = os.cpu_count() or 1
+
+def _get_zip_pack_executor():
+    global _zip_pack_executor
+    with _zip_pack_executor_lock:
+        if _zip_pack_executor is None:
+            _zip_pack_executor = ThreadPoolExecutor(_zip_pack_workers)
+        return _zip_pack_executor
+
+
+class ZipPacker():
+    """Write members to a ZipFile with data deflated concurrently.
+
+    Data of each member is split into blocks, which are deflated in a thread
+    pool (zlib releases the GIL) and written to the ZipFile in order by the
+    calling thread. Like pigz, each block is primed with the last 32 KiB of
+    the previous block and ended with a sync flush, so that the blocks form a
+    single deflate stream with nearly the same ratio as a serial one.
+
+    Members of already compressed types are stored. Written members are
+    available in the ZipFile after flush() or close().
+    """
+    BLOCK_SIZE = 1048576
+    WINDOW_SIZE = 32768
+
+    def __init__(self, zip, compresslevel=6, workers=None, block_size=None):
+        """
+        Args:
+            zip: a ZipFile opened for writing
+            compresslevel: 0 to store all members, or 1-9
+            workers: number of threads to use, None for a shared pool of the
+                process, or 0 to compress in the calling thread
+        """
+        self.zip = zip
+        self.compresslevel = compresslevel
+        self.block_size = block_size or self.BLOCK_SIZE
+
+        if workers is None:
+            self.executor = _get_zip_pack_executor()
+            self.own_executor = False
+            workers = _zip_pack_workers
+        elif workers > 0:
+            self.executor = ThreadPoolExecutor(workers)
+            self.own_executor = True
+        else:
+            self.executor = None
+            self.own_executor = False
+
+        # number of blocks to keep in flight before writing
+        self.max_pending = max(workers, 1) * 4
+
+        self._queue = deque()
+        self._pending = 0
+        self._current = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_dir(self, zinfo):
+        """Add a directory member.
+
+        Args:
+            zinfo: a ZipInfo or a name ending with '/'
+        """
+        self._drain()
+        self.zip.writestr(zinfo, b'', compress_type=zipfile.ZIP_STORED)
+
+    def add_file(self, file, arcname=None, compress_type=None, compresslevel=None):
+        """Add a file or directory from the filesystem.
+        """
+        zinfo = zipfile.ZipInfo.from_file(file, arcname)
+        if zinfo.is_dir():
+            self.add_dir(zinfo)
+            return
+
+        with open(file, 'rb') as fh:
+            self.add_stream(zinfo, fh, compress_type, compresslevel)
+
+    def add_data(self, zinfo, data, compress_type=None, compresslevel=None):
+        """Add a member with the given bytes.
+        """
+        zinfo.file_size = len(data)
+        self.add_stream(zinfo, io.BytesIO(data), compress_type, compresslevel)
+
+    def add_stream(self, zinfo, fh, compress_type=None, compresslevel=None, force_zip64=False):
+        """Add a member with data read from a file object.
+
+        Args:
+            zinfo: a ZipInfo, whose file_size is used to determine whether
+                ZIP64 extension is required
+            compress_type: None to deflate unless the member is of an already
+                compressed type
+            force_zip64: True if the data may exceed 2 GiB while file_size of
+                zinfo is not known
+        """
+        level = self.compresslevel if compresslevel is None else compresslevel
+        if compress_type is None:
+            mimetype, _ = mimetypes.guess_type(zinfo.filename)
+            if level == 0 or is_compressed_mimetype(mimetype):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+
+        zinfo.compress_type = compress_type
+        _zip_set_compresslevel(zinfo, level)
+
+        if compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # not supported by the pool; write with zipfile in this thread
+            self._drain()
+            with self.zip.open(zinfo, 'w', force_zip64=force_zip64) as fp:
+                while True:
+                    chunk = fh.read(self.block_size)
+                    if not chunk:
+                        break
+                    fp.write(chunk)
+            return
+
+        # file_size is not initialized by ZipInfo() before Python 3.7
+        zip64 = force_zip64 or getattr(zinfo, 'file_size', 0) * 1.05 > zipfile.ZIP64_LIMIT
+        self._queue.append(('begin', (zinfo, zip64)))
+
+        deflate = compress_type == zipfile.ZIP_DEFLATED
+        zdict = None
+        data = fh.read(self.block_size)
+        while True:
+            next_data = fh.read(self.block_size) if data else b''
+            last = not next_data
+            if not deflate:
+                self._queue.append(('block', (data, data)))
+            elif self.executor is None:
+                self._queue.append(('block', _zip_deflate_block(data, level, zdict, last)))
+            else:
+                self._queue.append(('block', self.executor.submit(_zip_deflate_block, data, level, zdict, last)))
+            self._pending += 1
+
+            if last:
+                break
+
+            zdict = data[-self.WINDOW_SIZE:]
+            data = next_data
+            self._drain(self.max_pending)
+
+        self._queue.append(('end', None))
+        self._drain(self.max_pending)
+
+    def add_zip_member(self, zsrc, info, arcname=None, fsrc=None):
+        """Copy a member from another ZipFile as-is.
+        """
+        self._drain()
+        zip_copy(zsrc, self.zip, info, arcname, fsrc)
+
+    def flush(self):
+        """Write all pending members to the ZipFile.
+        """
+        self._drain()
+
+    def close(self):
+        """Write all pending members and release the thread pool.
+
+        The ZipFile is not closed.
+        """
+        try:
+            self._drain()
+        finally:
+            if self.own_executor:
+                self.executor.shutdown()
+
+    def abort(self):
+        """Discard pending members.
+
+        A partially written member is left in the file as dead space.
+        """
+        for kind, value in self._queue:
+            if isinstance(value, Future):
+                value.cancel()
+        self._queue.clear()
+        self._pending = 0
+        if self._current is not None:
+            # release the ZipFile from the partially written member
+            self._current = None
+            self.zip._writing = False
+        if self.own_executor:
+            self.executor.shutdown()
+
+    def _drain(self, keep=0):
+        """Write queued items until no more than keep blocks are pending.
+        """
+        queue = self._queue
+        while queue and (keep == 0 or self._pending > keep):
+            kind, value = queue.popleft()
+            if kind == 'block':
+                self._pending -= 1
+                data, cdata = value.result() if isinstance(value, Future) else value
+                self._write_block(data, cdata)
+            elif kind == 'begin':
+                self._begin(*value)
+            elif kind == 'end':
+                self._end()
+
+    def _begin(self, zinfo, zip64):
+        zip = self.zip
+        _zip_check_write(zip)
+
+        zinfo.flag_bits = 0x00
+        zinfo.file_size = 0
+        zinfo.compress_size = 0
+        zinfo.CRC = 0
+        if not zip._seekable:
+            zinfo.flag_bits |= 0x08
+
+        fp = zip.fp
+        if zip._seekable:
+            fp.seek(zip.start_dir)
+        zinfo.header_offset = fp.tell()
+        zip._writing = True
+        fp.write(zinfo.FileHeader(zip64))
+        self._current = [zinfo, zip64, 0, 0, 0]
+
+    def _write_block(self, data, cdata):
+        current = self._current
+        current[2] = zlib.crc32(data, current[2])
+        current[3] += len(data)
+        current[4] += len(cdata)
+        self.zip.fp.write(cdata)
+
+    def _end(self):
+        zip = self.zip
+        fp = zip.fp
+        zinfo, zip64, crc, file_size, compress_size = self._current
+        self._current = None
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+
+        if not zip64 and (file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT):
+            raise RuntimeError('File size too large, try using force_zip64')
+
+        if zinfo.flag_bits & 0x08:
+            fmt = '<LLQQ' if zip64 else '<LLLL'
+            fp.write(struct.pack(fmt, 0x08074b50, crc, compress_size, file_size))
+        else:
+            pos = fp.tell()
+            fp.seek(zinfo.header_offset)
+            fp.write(zinfo.FileHeader(zip64))
+            fp.seek(pos)
+
+        zip.start_dir = fp.tell()
+        zip._writing = False
+        zip.filelist.append(zinfo)
+        zip.NameToInfo[zinfo.filename] = zinfo
+        zip._didModify = True
+
+
+@contextmanager
+def zip_append(file, exclude=None):
+    """Modify a ZIP file in place.
+
+    New members written to the yielded ZipFile are appended after the last
+    member, and a new central directory is written. Excluded members are only
+    dropped from the central directory, with their data left in the file as
+    dead space, which can be reclaimed with zip_compact later.
+
+    If an exception is raised in the block, the original central directory
+    is written back in place of any partially appended data, so that no
+    member is lost.
+
+    Args:
+        exclude: a function that takes a ZipInfo and returns True if the
+            member should be dropped
+    """
+    try:
+        with open(file, 'r+b') as fh:
+            with zipfile.ZipFile(fh, 'a') as zip:
+                _zip_check_write(zip)
+                filelist = zip.filelist
+                name_to_info = zip.NameToInfo
+                start_dir = zip.start_dir
+
+                if exclude is not None:
+                    zip.filelist = [i for i in zip.filelist if not exclude(i)]
+                    zip.NameToInfo = {i.filename: i for i in zip.filelist}
+                    zip._didModify = True
+
+                try:
+                    yield zip
+                except BaseException:
+                    # the central directory is rewritten at start_dir on
+                    # close
+                    zip.filelist = filelist
+                    zip.NameToInfo = name_to_info
+                    zip.start_dir = start_dir
+                    zip._writing = False
+                    zip._didModify = True
+                    raise
+                finally:
+                    zip.close()
+
+                    # zipfile < 3.8 doesn't truncate the file after the
+                    # written central directory, which may be shorter than
+                    # the original one
+                    if zip._didModify:
+                        fh.truncate()
+    finally:
+        zip_cache.invalidate(file)
+
+
+def zip_dead_space(zip, fh=None):
+    """Count bytes of a ZIP file not taken by members in the central directory.
+
+    The space of each member is measured from its local file header, whose
+    extra field may differ from the one in the central directory, and its
+    data descriptor if any.
+
+    Args:
+        fh: a file object of the archive file of zip to read the local file
+            headers from, which is opened on demand if not provided, so
+            that the ZipFile may have been closed
+    """
+    if fh is None:
+        with open(zip.filename, 'rb') as fh:
+            return zip_dead_space(zip, fh)
+
+    used = 0
+    for info in zip.filelist:
+        fh.seek(info.header_offset)
+        _, filename_length, extra_length = _zip_read_file_header(fh, info)
+        used += zipfile.sizeFileHeader + filename_length + extra_length + info.compress_size
+
+        if info.flag_bits & 0x08:
+            fh.seek(filename_length, 1)
+            extra = fh.read(extra_length)
+            fh.seek(info.compress_size, 1)
+
+            # CRC and sizes, which are 8 bytes each for a ZIP64 member,
+            # optionally preceded by a signature
+            zip64 = _zip_strip_extra(extra, (1,)) != extra
+            used += 4 + (16 if zip64 else 8)
+            if fh.read(4) == b'PK\x07\x08':
+                used += 4
+
+    return max(zip.start_dir - used, 0)
+
+
+def zip_compact(file):
+    """Rewrite a ZIP file to reclaim the dead space.
+
+    Returns:
+        the number of reclaimed bytes
+    """
+    with zip_write_lock(file):
+        size = os.stat(file).st_size
+        with zip_rewrite(file):
+            pass
+        return size - os.stat(file).st_size
+
+
+def zip_repack(file, compresslevel=6, workers=None):
+    """Recompress all members of a ZIP file with a ZipPacker.
+
+    Returns:
+        the number of reduced bytes
+    """
+    with zip_write_lock(file):
+        size = os.stat(file).st_size
+        with zip_rewrite(file, exclude=lambda i: True) as zdst:
+            with zipfile.ZipFile(file) as zsrc, ZipPacker(zdst, compresslevel, workers) as packer:
+                zdst.comment = zsrc.comment
+                for info in zsrc.infolist():
+                    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+                    zinfo.external_attr = info.external_attr
+                    zinfo.create_system = info.create_system
+                    zinfo.comment = info.comment
+                    if info.is_dir():
+                        packer.add_dir(zinfo)
+                        continue
+
+                    zinfo.file_size = info.file_size
+                    with zsrc.open(info) as fh:
+                        packer.add_stream(zinfo, fh)
+        return size - os.stat(file).st_size
+
+
+_zip_write_locks = {}
+_zip_write_locks_lock = threading.Lock()
+
+def zip_write_lock(file):
+    """Get a lock for writing the given ZIP file in this process.
+    """
+    realpath = os.path.realpath(file)
+    with _zip_write_locks_lock:
+        try:
+            return _zip_write_locks[realpath]
+        except KeyError:
+            lock = _zip_write_locks[realpath] = threading.RLock()
+            return lock
+
+
+class ZipExtractCache():
+    """A thread-safe index of ZIP files extracted to cache directories.
+
+    A ZIP file is keyed by its real path and validated by (inode, size,
+    mtime_ns), so that it's hashed only when new or changed, to reuse a cache
+    directory extracted from an identical ZIP file. The index is persisted
+    to a JSON file in the cache root, so that stale cache directories can be
+    pruned without scanning the whole root.
+
+    Cache directories are named <prefix><sha1>_<random>.
+    """
+    def __init__(self, root, prefix):
+        self.root = root
+        self.prefix = prefix
+        self.file = os.path.join(root, prefix + 'index.json')
+        self._files = {}
+        self._dirs = {}
+        self._removed = set()
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, file):
+        """Get the cache directory of a ZIP file, extracting it if needed.
+        """
+        realpath = os.path.realpath(file)
+        stat = os.stat(realpath)
+        key = [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+        with self._lock:
+            entry = self._files.get(realpath)
+            if entry is not None and entry[:3] == key and self._touch(entry[3]):
+                return os.path.join(self.root, entry[3])
+
+        hash = checksum(realpath, chunk_size=1048576)
+
+        with self._lock:
+            for dir, (dir_hash, _) in self._dirs.items():
+                if dir_hash == hash and self._touch(dir):
+                    self._files[realpath] = key + [dir]
+                    return os.path.join(self.root, dir)
+
+        dest_dir = tempfile.mkdtemp(prefix=self.prefix + hash + '_', dir=self.root)
+        try:
+            with zipfile.ZipFile(realpath) as zip:
+                zip.extractall(dest_dir)
+        except:
+            shutil.rmtree(dest_dir, ignore_errors=True)
+            raise
+
+        dir = os.path.basename(dest_dir)
+        with self._lock:
+            self._dirs[dir] = [hash, time_ns()]
+            self._files[realpath] = key + [dir]
+            self._removed.discard(dir)
+        return dest_dir
+
+    def prune(self, expire):
+        """Remove cache directories not accessed for expire nanoseconds.
+
+        Returns:
+            the number of removed cache directories
+        """
+        t = time_ns()
+        count = 0
+        with self._lock:
+            for dir, (_, atime) in list(self._dirs.items()):
+                if t <= atime + expire:
+                    continue
+
+                # cache may be created by another user and undeletable
+                try:
+                    shutil.rmtree(os.path.join(self.root, dir))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    traceback.print_exc()
+                    continue
+
+                self._remove(dir)
+                count += 1
+        return count
+
+    def save(self):
+        """Persist the index, merged with changes by other processes.
+        """
+        with self._lock:
+            files, dirs, removed = self._files, self._dirs, self._removed
+            self._load()
+            for dir, entry in dirs.items():
+                other = self._dirs.get(dir)
+                if other is None or other[1] < entry[1]:
+                    self._dirs[dir] = entry
+            self._files.update(files)
+            for dir in removed:
+                self._remove(dir)
+            self._removed = set()
+
+            data = {'files': self._files, 'dirs': self._dirs}
+
+        temp_path = self.file + '.' + str(os.getpid()) + '.' + str(time_ns())
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self.file)
+
+    def _load(self):
+        try:
+            with open(self.file, 'r', encoding='UTF-8') as f:
+                data = json.load(f)
+            self._files = data['files']
+            self._dirs = data['dirs']
+        except FileNotFoundError:
+            self._files = {}
+            self._dirs = {}
+            self._adopt()
+        except (OSError, ValueError, KeyError):
+            print('Warning: Unable to load cache index from "{}".'.format(self.file), file=sys.stderr)
+            self._files = {}
+            self._dirs = {}
+            self._adopt()
+
+    def _adopt(self):
+        """Index cache directories created before the index exists.
+        """
+        regex = re.compile(r'^' + re.escape(self.prefix) + r'([0-9a-f]{40})_')
+        for entry in os.scandir(self.root):
+            m = regex.search(entry.name)
+            if m and entry.is_dir(follow_symlinks=False):
+                self._dirs[entry.name] = [m.group(1), entry.stat(follow_symlinks=False).st_atime_ns]
+
+    def _touch(self, dir):
+        if dir not in self._dirs:
+            return False
+
+        if not os.path.isdir(os.path.join(self.root, dir)):
+            self._remove(dir)
+            return False
+
+        self._dirs[dir][1] = time_ns()
+        return True
+
+    def _remove(self, dir):
+        self._dirs.pop(dir, None)
+        self._removed.add(dir)
+        for file in [k for k, v in self._files.items() if v[3] == dir]:
+            del self._files[file]
+
+
+#########################################################################
+# Thumbnail
+#########################################################################
+
+THUMBNAIL_MIMETYPES = {
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/bmp',
+    'image/webp',
+    'image/tiff',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+    }
+
+
+def make_thumbnail(file, dest, size, member=None):
+    """Write a thumbnail of an image file, or of an image member of a ZIP
+    file, fitting in a size x size box.
+
+    The thumbnail is saved as dest + ".png" if the image has transparency,
+    and as dest + ".jpg" otherwise.
+
+    Returns:
+        the path of the thumbnail file
+    """
+    with ExitStack() as stack:
+        if member is not None:
+            # read the member as a stream rather than loading it in memory
+            zip = stack.enter_context(zipfile.ZipFile(file))
+            fh = stack.enter_context(zip.open(member))
+        else:
+            fh = stack.enter_context(open(file, 'rb'))
+        im = stack.enter_context(Image.open(fh))
+
+        # let the JPEG decoder scale down by a power of 2, which is much
+        # faster than decoding the full image
+        im.draft('RGB', (size, size))
+
+        im = ImageOps.exif_transpose(im)
+        alpha = im.mode in ('RGBA', 'LA', 'PA') or 'transparency' in im.info
+        if im.mode not in ('RGBA' if alpha else 'RGB', 'L'):
+            im = im.convert('RGBA' if alpha else 'RGB')
+        im.thumbnail((size, size))
+
+        if alpha:
+            dest += '.png'
+            format, params = 'PNG', {'optimize': True}
+        else:
+            dest += '.jpg'
+            format, params = 'JPEG', {'quality': 85}
+
+        temp_path = dest + '.' + str(time_ns())
+        try:
+            im.save(temp_path, format, **params)
+            os.replace(temp_path, dest)
+        except:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    return dest
+
+
+class ThumbnailCache():
+    """A thread-safe cache of thumbnails generated in a process pool.
+
+    A thumbnail is keyed by the real path, size, and mtime_ns of the image
+    file, or by the real path of the ZIP file and the name, CRC, size, and
+    date_time of the image member, plus the thumbnail size. A modified image
+    thus gets a new thumbnail file, and concurrent requests for the same
+    thumbnail wait for a single generation.
+
+    Thumbnail files are named <root>/<sha1[:2]>/<sha1>.<jpg|png>. Once they
+    take more than max_size bytes, those not accessed for expire seconds and
+    then the least recently accessed ones are pruned in the background.
+
+    Worker processes are started with the "forkserver" or "spawn" method
+    where supported, rather than forked from the multithreaded server, which
+    may have a lock held by another thread. If a worker process dies
+    abruptly, e.g. killed for running out of memory on a huge image, the
+    broken pool is replaced with a new one.
+    """
+    FILENAME_PATTERN = re.compile(r'^[0-9a-f]{40}\.(?:jpg|png)$')
+
+    def __init__(self, root, workers=2, max_size=None, expire=None):
+        self.root = root
+        self.workers = workers
+        self.max_size = max_size
+        self.expire = expire
+        self._executor = None
+        self._pending = {}
+        self._size = None
+        self._pruning = False
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return Image is not None and self.workers > 0
+
+    def get(self, file, size, member=None):
+        """Get the path of the thumbnail of an image, generating it if needed.
+
+        Args:
+            member: a ZipInfo of the image member if file is a ZIP file
+        """
+        realpath = os.path.realpath(file)
+        if member is not None:
+            key = [realpath, member.filename, member.CRC, member.file_size, member.date_time, size]
+        else:
+            stat = os.stat(realpath)
+            key = [realpath, stat.st_size, stat.st_mtime_ns, size]
+
+        hash = hashlib.sha1(json.dumps(key).encode('UTF-8')).hexdigest()
+        dest = os.path.join(self.root, hash[:2], hash)
+        for ext in ('.jpg', '.png'):
+            if os.path.isfile(dest + ext):
+                return dest + ext
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        with self._lock:
+            entry = self._pending.get(hash)
+            if entry is None:
+                args = (make_thumbnail, realpath, dest, size,
+                        member.filename if member is not None else None)
+                executor = self._get_executor()
+                try:
+                    future = executor.submit(*args)
+                except BrokenProcessPool:
+                    # broken by a former task
+                    self._reset_executor(executor)
+                    executor = self._get_executor()
+                    future = executor.submit(*args)
+                entry = self._pending[hash] = (future, executor)
+
+        future, executor = entry
+        try:
+            thumbnail = future.result()
+        except BrokenProcessPool:
+            with self._lock:
+                self._reset_executor(executor)
+            raise
+        finally:
+            with self._lock:
+                if self._pending.get(hash) is entry:
+                    del self._pending[hash]
+
+        self._add_size(thumbnail)
+        return thumbnail
+
+    def prune(self, max_size=None, expire=None):
+        """Remove thumbnails not accessed for expire seconds, and then the
+        least recently accessed ones until they take at most max_size bytes.
+
+        The access time of a thumbnail is taken from its atime, or its mtime
+        if later, e.g. on a filesystem mounted with noatime.
+
+        Args:
+            max_size: the maximum total size, or None for self.max_size
+            expire: the seconds, or None for self.expire
+
+        Returns:
+            the number of removed thumbnails
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if expire is None:
+            expire = self.expire
+
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not self.FILENAME_PATTERN.search(filename):
+                    continue
+                file = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(file)
+                except OSError:
+                    continue
+                entries.append((max(st.st_atime, st.st_mtime), st.st_size, file))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        deadline = time.time() - expire if expire is not None else None
+        count = 0
+        for atime, size, file in entries:
+            if not ((deadline is not None and atime < deadline) or
+                    (max_size is not None and total > max_size)):
+                break
+
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                traceback.print_exc()
+                continue
+
+            total -= size
+            count += 1
+
+        with self._lock:
+            self._size = total
+
+        return count
+
+    def _add_size(self, thumbnail):
+        if self.max_size is None:
+            return
+
+        try:
+            size = os.stat(thumbnail).st_size
+        except OSError:
+            return
+
+        with self._lock:
+            # unknown until the first prune
+            if self._size is None:
+                return
+            self._size += size
+            if self._size <= self.max_size or self._pruning:
+                return
+            self._pruning = True
+
+        threading.Thread(target=self._prune_background, daemon=True).start()
+
+    def _prune_background(self):
+        try:
+            self.prune()
+        finally:
+            with self._lock:
+                self._pruning = False
+
+    def _get_executor(self):
+        if self._executor is None:
+            kwargs = {}
+            if sys.version_info >= (3, 7):
+                methods = multiprocessing.get_all_start_methods()
+                method = 'forkserver' if 'forkserver' in methods else 'spawn'
+                kwargs['mp_context'] = multiprocessing.get_context(method)
+            self._executor = ProcessPoolExecutor(self.workers, **kwargs)
+        return self._executor
+
+    def _reset_executor(self, executor):
+        if self._executor is not executor:
+            # already replaced
+            return
+        print('Warning: A thumbnail worker process terminated abruptly. Restarting the process pool.', file=sys.stderr)
+        self._executor = None
+        executor.shutdown(wait=False)
+
+
+#########################################################################
+# Static assets
+#########################################################################
+
+# etag: a hash of data, which also serves as the version in a fingerprinted URL
+# encodings: a list of (encoding, data) of precompressed variants, preferred first
+StaticAsset = namedtuple('StaticAsset', ['data', 'mimetype', 'etag', 'last_modified', 'encodings'])
+
+_static_css_ref_pattern = re.compile(r"""url\(\s*(["']?)([^"'()?]+)\?a=static\1\s*\)""")
+
+
+def load_static_assets(dirs, max_size=1048576):
+    """Load static files of a theme into memory.
+
+    A file in a former directory overrides the same one in a latter
+    directory. References like url("<file>?a=static") in a CSS file are
+    fingerprinted as url("<file>?a=static&v=<etag>"), so that the referenced
+    files can be cached as long as the CSS file. Files larger than max_size
+    are not loaded.
+
+    Returns:
+        a dict of StaticAsset(s) keyed by the URL path below the static
+        directory
+    """
+    files = {}
+    for dir in reversed(dirs):
+        for root, _, filenames in os.walk(dir):
+            for filename in filenames:
+                file = os.path.join(root, filename)
+                name = os.path.relpath(file, dir).replace(os.sep, '/')
+                files[name] = file
+
+    assets = {}
+
+    def load(name, file):
+        try:
+            if os.stat(file).st_size > max_size:
+                return
+            with open(file, 'rb') as fh:
+                data = fh.read()
+            last_modified = os.stat(file).st_mtime
+        except OSError:
+            return
+
+        mimetype, _ = mimetypes.guess_type(name)
+        mimetype = mimetype or 'application/octet-stream'
+
+        if mimetype == 'text/css':
+            def fingerprint(m):
+                ref = posixpath.normpath(posixpath.join(posixpath.dirname(name), m.group(2)))
+                asset = assets.get(ref)
+                if asset is None:
+                    return m.group(0)
+                return 'url({0}{1}?a=static&v={2}{0})'.format(m.group(1), m.group(2), asset.etag)
+
+            try:
+                text = data.decode('UTF-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                text = _static_css_ref_pattern.sub(fingerprint, text)
+                data = text.encode('UTF-8')
+
+        etag = hashlib.sha256(data).hexdigest()[:16]
+
+        encodings = []
+        if not is_compressed_mimetype(mimetype):
+            if brotli is not None:
+                encodings.append(('br', brotli.compress(data)))
+            encodings.append(('gzip', gzip.compress(data, 9)))
+            encodings = [(e, d) for e, d in encodings if len(d) < len(data)]
+
+        assets[name] = StaticAsset(data, mimetype, etag, last_modified, encodings)
+
+    # load CSS files last so that their references can be fingerprinted
+    for name, file in sorted(files.items(), key=lambda x: x[0].lower().endswith('.css')):
+        load(name, file)
+
+    return assets
 
 
 #########################################################################
@@ -346,7 +2454,7 @@ def get_maff_pages(file):
     """Get a list of pages (MaffPageInfo).
     """
     pages = []
-    with zipfile.ZipFile(file) as zip:
+    with zip_cache.open(file) as zip:
         # get top folders and their content files
         topdirs = {}
         for entry in zip.namelist():
@@ -415,6 +2523,361 @@ def parse_maff_index_rdf(fh):
             )
 
 
+# persisted MaffPagesCache instances to flush at exit, held weakly so that a
+# discarded one can be collected
+_maff_pages_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_maff_pages_caches():
+    for cache in list(_maff_pages_caches):
+        cache.flush()
+
+
+class MaffPagesCache():
+    """A thread-safe cache of get_maff_pages results.
+
+    An entry is keyed by the real path of the MAFF file and validated by its
+    size and mtime_ns. Entries are also persisted to file as JSON, if
+    provided, so that they survive a restart.
+
+    The least recently used entries are dropped when there are more than
+    max_entries entries or max_pages pages in total. Entries added by get()
+    are persisted in a batch save_delay seconds later, and at exit.
+    """
+    def __init__(self, file=None, max_entries=65536, max_pages=262144, save_delay=5):
+        self.file = file
+        self.max_entries = max_entries
+        self.max_pages = max_pages
+        self.save_delay = save_delay
+        self._entries = OrderedDict()
+        self._pages = 0
+        self._dirty = False
+        self._timer = None
+        self._lock = threading.Lock()
+        self._loaded = file is None
+        if file is not None:
+            _maff_pages_caches.add(self)
+
+    def get(self, file):
+        """Get a list of pages (MaffPageInfo) of a MAFF file.
+        """
+        pages, modified = self._get(file)
+        if modified:
+            self._schedule_save()
+        return pages
+
+    def prewarm(self, root):
+        """Cache pages of all MAFF files under root.
+
+        Returns:
+            the number of cached MAFF files
+        """
+        count = 0
+        modified = False
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root:
+                dirnames[:] = [d for d in dirnames if d != WSB_DIR]
+
+            for filename in filenames:
+                if not filename.lower().endswith('.maff'):
+                    continue
+
+                try:
+                    _, mod = self._get(os.path.join(dirpath, filename))
+                except (OSError, zipfile.BadZipFile):
+                    continue
+
+                modified = modified or mod
+                count += 1
+
+        if modified:
+            self.save()
+
+        return count
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def save(self):
+        """Persist the entries to file.
+        """
+        if self.file is None:
+            return
+
+        with self._lock:
+            self._dirty = False
+            data = {k: [v[0], v[1], [list(p) for p in v[2]]] for k, v in self._entries.items()}
+
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        temp_path = self.file + '.' + str(time_ns())
+        with open(temp_path, 'w', encoding='UTF-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self.file)
+
+    def flush(self):
+        """Persist the entries to file if modified since the last save.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+        try:
+            self.save()
+        except OSError:
+            print('Warning: Unable to save MAFF cache to "{}".'.format(self.file), file=sys.stderr)
+
+    def _schedule_save(self):
+        if self.file is None:
+            return
+
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                return
+            self._timer = threading.Timer(self.save_delay, self._save_scheduled)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _save_scheduled(self):
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def _load(self):
+        if self._loaded:
+            return
+
+        self._loaded = True
+        try:
+            with open(self.file, 'r', encoding='UTF-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print('Warning: Unable to load MAFF cache from "{}".'.format(self.file), file=sys.stderr)
+            return
+
+        for key, (size, mtime, pages) in data.items():
+            self._set(key, (size, mtime, [MaffPageInfo(*p) for p in pages]))
+
+    def _set(self, key, entry):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._pages -= len(old[2])
+        self._entries[key] = entry
+        self._pages += len(entry[2])
+        while len(self._entries) > self.max_entries or (self._pages > self.max_pages and len(self._entries) > 1):
+            _, old = self._entries.popitem(last=False)
+            self._pages -= len(old[2])
+
+    def _get(self, file):
+        realpath = os.path.realpath(file)
+        stat = os.stat(realpath)
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get(realpath)
+            if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                self._entries.move_to_end(realpath)
+                return entry[2], False
+
+        pages = get_maff_pages(realpath)
+
+        with self._lock:
+            self._set(realpath, (stat.st_size, stat.st_mtime_ns, pages))
+
+        return pages, True
+
+
+#########################################################################
+# Markdown
+#########################################################################
+
+class MarkdownCache():
+    """A thread-safe cache of markdown files rendered as HTML fragments.
+
+    A fragment is keyed by the path, mtime_ns, and size of the markdown
+    file, like the ETag of the rendered page, and kept in an LRU in memory
+    up to max_size. Fragments are also persisted to files under root, if
+    provided, so that they survive a restart. Concurrent misses for the same
+    file wait for a single rendering.
+
+    A persisted fragment is named by the hash of the path and starts with a
+    line of the key, so that a newer version replaces the former one, and
+    fragments of removed or changed files can be pruned.
+    """
+    def __init__(self, root=None, max_size=16777216, render=None):
+        self.root = root
+        self.max_size = max_size
+        self.render = render
+        self._entries = OrderedDict()
+        self._size = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, file, stat=None):
+        """Get the rendered HTML fragment of a markdown file.
+
+        Args:
+            stat: the os.stat_result of file if already got
+        """
+        if stat is None:
+            stat = os.stat(file)
+        key = (file, stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                return html
+
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return future.result()
+
+        try:
+            html = self._load(key)
+            cacheable = True
+            if html is None:
+                with open(file, 'r', encoding='UTF-8') as f:
+                    html = self.render(f.read())
+
+                # don't cache if the file is modified during reading
+                stat = os.stat(file)
+                cacheable = (stat.st_mtime_ns, stat.st_size) == key[1:]
+                if cacheable:
+                    self._save(key, html)
+            future.set_result(html)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._pending[key]
+
+        if cacheable:
+            with self._lock:
+                self._put(key, html)
+
+        return html
+
+    def prune(self):
+        """Remove persisted fragments of removed or changed markdown files,
+        and empty subdirectories.
+
+        Returns:
+            the number of removed fragments
+        """
+        if self.root is None:
+            return 0
+
+        count = 0
+        try:
+            subdirs = os.listdir(self.root)
+        except OSError:
+            return 0
+
+        for subdir in subdirs:
+            dir = os.path.join(self.root, subdir)
+            try:
+                names = os.listdir(dir)
+            except OSError:
+                continue
+
+            for name in names:
+                # skip a temporary file being written
+                if not name.endswith('.html'):
+                    continue
+
+                cache_file = os.path.join(dir, name)
+                try:
+                    with open(cache_file, 'r', encoding='UTF-8') as f:
+                        key = self._parse_key(f.readline())
+                    stat = os.stat(key[0])
+                    if (stat.st_mtime_ns, stat.st_size) == key[1:]:
+                        continue
+                except (OSError, ValueError):
+                    pass
+
+                try:
+                    os.remove(cache_file)
+                except OSError:
+                    continue
+                count += 1
+
+            try:
+                os.rmdir(dir)
+            except OSError:
+                # not empty
+                pass
+
+        return count
+
+    def _put(self, key, html):
+        if len(html) > self.max_size:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._entries[key] = html
+        self._size += len(html)
+        while self._size > self.max_size:
+            _, old = self._entries.popitem(last=False)
+            self._size -= len(old)
+
+    def _get_cache_file(self, key):
+        hash = hashlib.sha1(key[0].encode('UTF-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.root, hash[:2], hash + '.html')
+
+    @staticmethod
+    def _parse_key(line):
+        path, mtime_ns, size = json.loads(line)
+        if not isinstance(path, str) or not isinstance(mtime_ns, int) or not isinstance(size, int):
+            raise ValueError('Invalid key.')
+        return (path, mtime_ns, size)
+
+    def _load(self, key):
+        if self.root is None:
+            return None
+
+        cache_file = self._get_cache_file(key)
+        try:
+            with open(cache_file, 'r', encoding='UTF-8', errors='surrogateescape') as f:
+                if self._parse_key(f.readline()) != key:
+                    return None
+                html = f.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            print('Warning: Unable to load markdown cache of "{}".'.format(key[0]), file=sys.stderr)
+            return None
+
+        return html
+
+    def _save(self, key, html):
+        if self.root is None:
+            return
+
+        cache_file = self._get_cache_file(key)
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            temp_path = cache_file + '.' + str(time_ns())
+            with open(temp_path, 'w', encoding='UTF-8', errors='surrogateescape') as f:
+                f.write(json.dumps(list(key)) + '\n')
+                f.write(html)
+            os.replace(temp_path, cache_file)
+        except OSError:
+            print('Warning: Unable to save markdown cache of "{}".'.format(key[0]), file=sys.stderr)
+
+
 #########################################################################
 # Encrypt and security
 #########################################################################